@@ -25,6 +25,39 @@ Options:
 -a/--minfds NUM -- the minimum number of file descriptors for start success
 -t/--strip_ansi -- strip ansi escape codes from process output
 --minprocs NUM  -- the minimum number of processes available for start success
+--script_pool_size NUM -- the maximum number of status/query scripts run at once
+--script_timeout SECS -- kill status/query scripts running longer than SECS
+--script_cache_ttl SECS -- reuse status/query script results for SECS
+--subreaper -- reap run_detached programs directly (Linux child subreaper)
+--watchdog_threshold SECS -- log the stack when one pass of the main loop
+                             takes longer than SECS (0, the default,
+                             disables it)
+--dependency_startup -- start processes as soon as the processes they depend
+                        on are running instead of in priority order
+--startup_parallelism NUM -- the maximum number of processes dependency_startup
+                             lets start at once (0 for no limit)
+--spawn_max_starting NUM -- queue automatic starts while NUM processes are
+                            STARTING (0, the default, for no limit)
+--spawn_max_rate NUM -- start at most NUM processes automatically per second
+                        (0, the default, for no limit)
+--spawn_max_load LOAD -- hold automatic starts while the load average is at
+                         least LOAD (0 to disable)
+--spawn_min_memory BYTES -- hold automatic starts while less than BYTES of
+                            memory is available (0 to disable)
+--shell_launch -- start run_detached programs under cgexec, nice, bash and
+                  numactl instead of applying their settings natively
+--config_watch MODE -- reread the config files when they change and apply
+                       the changes (true), or only report them (dryrun)
+--config_watch_delay SECS -- wait until the config files have been left
+                             alone for SECS before rereading them
+--childlog_flush_interval SECS -- write process output to the child logs
+                                  every SECS (0 for every main loop pass)
+--childlog_buffer_size BYTES -- write process output to the child logs as
+                                soon as BYTES of it are waiting
+--async_logging POLICY -- write the logs on a thread of their own; when its
+                          queue is full block, drop-oldest or drop-debug
+--async_log_queue NUM -- the maximum number of records queued for the log
+                         writer thread
 --profile_options OPTIONS -- run adminserviced under profiler and output
                              results based on OPTIONS, which  is a comma-sep'd
                              list of 'cumulative', 'calls', and/or 'callers',
@@ -42,19 +75,30 @@ from adminservice.medusa import asyncore_25 as asyncore
 from adminservice.options import ServerOptions
 from adminservice.options import signame
 from adminservice import events
+from adminservice.loopstats import LoopStats
+from adminservice.watchdog import Watchdog
+from adminservice.configwatch import ConfigWatcher
+from adminservice.shutdown import TieredStop
 from adminservice.states import AdminServiceStates
 from adminservice.states import getProcessStateDescription
+from adminservice.states import ALL_STOPPED_STATES
 
 class AdminService:
     stopping = False # set after we detect that we are handling a stop request
     lastshutdownreport = 0 # throttle for delayed process error reports at stop
     process_groups = None # map of process group name to process group object
-    stop_groups = None # list used for priority ordered shutdown
+    stop_tiers = None # TieredStop used for priority ordered shutdown
+    process_map = None # map of fd to process dispatcher, rebuilt when they change
+    process_map_serial = None # options.dispatcher_serial when process_map was built
+    poll_interval = 1 # longest poll; this cannot be fewer than the smallest TickEvent (5)
 
     def __init__(self, options):
         self.options = options
         self.process_groups = {}
         self.ticks = {}
+        self.loop_stats = LoopStats()
+        self.watchdog = Watchdog(options)
+        self.config_watcher = ConfigWatcher(self)
 
     def main(self):
         if not self.options.first:
@@ -79,7 +123,7 @@ class AdminService:
 
     def run(self):
         self.process_groups = {} # clear
-        self.stop_groups = None # clear
+        self.stop_tiers = None # clear
         events.clear()
         try:
             for config in self.options.process_group_configs:
@@ -92,8 +136,16 @@ class AdminService:
             # writing pid file needs to come *after* daemonizing or pid
             # will be wrong
             self.options.write_pidfile()
+            self.options.make_subreaper()
+            # threads don't survive daemonizing
+            self.options.start_log_writer()
+            self.watchdog.start()
+            self.config_watcher.start()
             self.runforever()
         finally:
+            self.options.child_log_batcher.flush()
+            self.config_watcher.stop()
+            self.watchdog.stop()
             self.options.cleanup()
 
     def diff_to_active(self, new=None):
@@ -117,6 +169,7 @@ class AdminService:
         if name not in self.process_groups:
             config.after_setuid()
             self.process_groups[name] = config.make_group()
+            self.options.dispatchers_changed()
             events.notify(events.ProcessGroupAddedEvent(name))
             return True
         return False
@@ -126,15 +179,19 @@ class AdminService:
             return False
         self.process_groups[name].before_remove()
         del self.process_groups[name]
+        self.options.dispatchers_changed()
         events.notify(events.ProcessGroupRemovedEvent(name))
         return True
 
     def get_process_map(self):
-        process_map = {}
-        pgroups = self.process_groups.values()
-        for group in pgroups:
-            process_map.update(group.get_dispatchers())
-        return process_map
+        if self.process_map_serial != self.options.dispatcher_serial:
+            process_map = {}
+            pgroups = self.process_groups.values()
+            for group in pgroups:
+                process_map.update(group.get_dispatchers())
+            self.process_map = process_map
+            self.process_map_serial = self.options.dispatcher_serial
+        return self.process_map
 
     def shutdown_report(self):
         unstopped = []
@@ -158,43 +215,47 @@ class AdminService:
         return unstopped
 
     def ordered_stop_groups_phase_1(self):
-        if self.stop_groups:
-            # stop the last group (the one with the "highest" priority)
-            self.stop_groups[-1].stop_all()
+        if self.stop_tiers is not None:
+            # stop every group of the tier with the "highest" priority
+            self.stop_tiers.step()
 
     def ordered_stop_groups_phase_2(self):
-        # after phase 1 we've transitioned and reaped, let's see if we
-        # can remove the group we stopped from the stop_groups queue.
-        if self.stop_groups:
-            # pop the last group (the one with the "highest" priority)
-            group = self.stop_groups.pop()
-            if group.get_unstopped_processes():
-                # if any processes in the group aren't yet in a
-                # stopped state, we're not yet done shutting this
-                # group down, so push it back on to the end of the
-                # stop group queue
-                self.stop_groups.append(group)
+        # after phase 1 we've transitioned and reaped, let's see if the
+        # current tier is done, and if so start stopping the next one
+        if self.stop_tiers is not None:
+            self.stop_tiers.step()
 
     def runforever(self):
         events.notify(events.AdminServiceRunningEvent())
-        timeout = 1 # this cannot be fewer than the smallest TickEvent (5)
 
         socket_map = self.options.get_socket_map()
+        signal_map = self.options.get_signal_map()
+        timers = self.options.timers
+        poller = self.options.poller
+        tracked_map = {} # fd -> dispatcher whose interest changes are tracked
+        tracked_serial = None # options.dispatcher_serial when it was built
+        registered = {} # fd -> tracked dispatcher the poller holds interest for
+        socket_registered = {} # the same for the HTTP channels
+        stats = self.loop_stats
+        watchdog = self.watchdog
 
         while 1:
-            combined_map = {}
-            combined_map.update(socket_map)
-            combined_map.update(self.get_process_map())
-
+            stats.begin()
             pgroups = self.process_groups.values()
             pgroups.sort()
+            stats.mark('map')
 
             if self.options.mood < AdminServiceStates.RUNNING:
                 if not self.stopping:
                     # first time, set the stopping flag, do a
-                    # notification and set stop_groups
+                    # notification and set stop_tiers
                     self.stopping = True
-                    self.stop_groups = pgroups[:]
+                    members = []
+                    for group in pgroups:
+                        for process in group.processes.values():
+                            if process.get_state() not in ALL_STOPPED_STATES:
+                                members.append((group, process))
+                    self.stop_tiers = TieredStop(self.options, 'shutdown', members)
                     events.notify(events.AdminServiceStoppingEvent())
 
                 self.ordered_stop_groups_phase_1()
@@ -203,58 +264,158 @@ class AdminService:
                     # if there are no unstopped processes (we're done
                     # killing everything), it's OK to shutdown or reload
                     raise asyncore.ExitNow
-
-            for fd, dispatcher in combined_map.items():
+                stats.mark('stop')
+
+            # registrations persist between passes; drop the ones for fds
+            # that were closed or now belong to a different dispatcher
+            for fd, dispatcher in socket_registered.items():
+                if socket_map.get(fd) is not dispatcher:
+                    poller.forget(fd)
+                    del socket_registered[fd]
+
+            # the process, pidfd, inotify and signal dispatchers say when
+            # they come and go (dispatchers_changed) and when they may
+            # want different events (interest_changed), so only those are
+            # asked what they want, not every dispatcher every pass
+            if tracked_serial != self.options.dispatcher_serial:
+                tracked_serial = self.options.dispatcher_serial
+                tracked_map = {}
+                tracked_map.update(signal_map)
+                tracked_map.update(self.get_process_map())
+                tracked_map.update(self.options.detached_monitor.get_dispatchers())
+                tracked_map.update(self.config_watcher.get_dispatchers())
+                for fd, dispatcher in registered.items():
+                    if tracked_map.get(fd) is not dispatcher:
+                        poller.forget(fd)
+                        del registered[fd]
+                self.options.get_interest_changes()
+                changed = tracked_map.values()
+            else:
+                changed = self.options.get_interest_changes()
+            for dispatcher in changed:
+                fd = dispatcher.fd
+                if tracked_map.get(fd) is not dispatcher:
+                    continue
+                readable = dispatcher.readable()
+                writable = dispatcher.writable()
+                if readable or writable:
+                    poller.set_interest(fd, readable, writable)
+                    registered[fd] = dispatcher
+                elif registered.has_key(fd):
+                    poller.forget(fd)
+                    del registered[fd]
+
+            # the HTTP channels' interest depends on medusa's buffers and
+            # producers, so they're asked every pass; there are only as
+            # many of them as there are clients connected
+            for fd, dispatcher in socket_map.items():
                 if dispatcher.readable():
-                    self.options.poller.register_readable(fd)
+                    poller.register_readable(fd)
+                    socket_registered[fd] = dispatcher
                 if dispatcher.writable():
-                    self.options.poller.register_writable(fd)
+                    poller.register_writable(fd)
+                    socket_registered[fd] = dispatcher
+
+            stats.mark('map')
 
-            r, w = self.options.poller.poll(timeout)
+            watchdog.idle()
+            r, w = poller.poll(self.get_poll_timeout(socket_map))
+            watchdog.busy()
+            stats.mark('poll')
+            stats.events(r, w)
 
             for fd in r:
-                if combined_map.has_key(fd):
-                    try:
-                        dispatcher = combined_map[fd]
-                        self.options.logger.blather(
-                            'read event caused by %(dispatcher)r',
-                            dispatcher=dispatcher)
-                        dispatcher.handle_read_event()
-                        if not dispatcher.readable():
-                            self.options.poller.unregister_readable(fd)
-                    except asyncore.ExitNow:
-                        raise
-                    except:
-                        combined_map[fd].handle_error()
+                dispatcher = tracked_map.get(fd)
+                tracked = dispatcher is not None
+                if not tracked:
+                    dispatcher = socket_map.get(fd)
+                    if dispatcher is None:
+                        continue
+                try:
+                    self.options.logger.blather(
+                        'read event caused by %(dispatcher)r',
+                        dispatcher=dispatcher)
+                    dispatcher.handle_read_event()
+                    if not tracked and not dispatcher.readable():
+                        poller.unregister_readable(fd)
+                except asyncore.ExitNow:
+                    raise
+                except:
+                    dispatcher.handle_error()
+                if tracked:
+                    self.options.interest_changed(dispatcher)
+            stats.mark('read')
 
             for fd in w:
-                if combined_map.has_key(fd):
-                    try:
-                        dispatcher = combined_map[fd]
-                        self.options.logger.blather(
-                            'write event caused by %(dispatcher)r',
-                            dispatcher=dispatcher)
-                        dispatcher.handle_write_event()
-                        if not dispatcher.writable():
-                            self.options.poller.unregister_writable(fd)
-                    except asyncore.ExitNow:
-                        raise
-                    except:
-                        combined_map[fd].handle_error()
-
+                dispatcher = tracked_map.get(fd)
+                tracked = dispatcher is not None
+                if not tracked:
+                    dispatcher = socket_map.get(fd)
+                    if dispatcher is None:
+                        continue
+                try:
+                    self.options.logger.blather(
+                        'write event caused by %(dispatcher)r',
+                        dispatcher=dispatcher)
+                    dispatcher.handle_write_event()
+                    if not tracked and not dispatcher.writable():
+                        poller.unregister_writable(fd)
+                except asyncore.ExitNow:
+                    raise
+                except:
+                    dispatcher.handle_error()
+                if tracked:
+                    self.options.interest_changed(dispatcher)
+            stats.mark('write')
+
+            self.config_watcher.check()
+            self.options.conditional_configs.check()
+            stats.mark('checks')
+
+            # only transition the groups whose timers ran out or whose
+            # processes changed state; everything is transitioned while
+            # we're stopping
+            timers.run()
+            due = timers.pop_due()
             for group in pgroups:
-                group.transition()
+                if (self.stopping or group.transition_every_pass or
+                    due.has_key(id(group))):
+                    group.transition()
+                    group.schedule()
+            stats.mark('transition')
 
             self.reap()
+            stats.mark('reap')
+            self.options.detached_monitor.check()
+            self.options.script_runner.check()
+            self.options.child_log_batcher.check()
+            stats.mark('checks')
             self.handle_signal()
+            stats.mark('signal')
             self.tick()
+            stats.mark('tick')
 
             if self.options.mood < AdminServiceStates.RUNNING:
                 self.ordered_stop_groups_phase_2()
+                stats.mark('stop')
+            stats.end()
 
             if self.options.test:
                 break
 
+    def get_poll_timeout(self, socket_map):
+        """ Sleep until the nearest process deadline, but no longer than
+        poll_interval so ticks and the periodic checks still run, and no
+        longer than the delay of any deferred RPC waiting to be retried or
+        the time queued child log output is due to be written """
+        timeout = self.options.timers.get_timeout(self.poll_interval)
+        timeout = self.options.child_log_batcher.get_timeout(timeout)
+        for dispatcher in socket_map.values():
+            delay = getattr(dispatcher, 'delay', 0)
+            if delay and delay < timeout:
+                timeout = delay
+        return timeout
+
     def tick(self, now=None):
         """ Send one or more 'tick' events when the timeslice related to
         the period for the event type rolls over """
@@ -272,25 +433,30 @@ class AdminService:
                 self.ticks[period] = this_tick
                 events.notify(event(this_tick, self))
 
-    def reap(self, once=False, recursionguard=0):
-        if recursionguard == 100:
-            return
-        pid, sts = self.options.waitpid()
-        if pid:
+    def reap(self, once=False):
+        """ Reap exited children until there are none left (just one if
+        once is true) and finish the processes they belong to.  Returns the
+        number of children reaped. """
+        reaped = 0
+        while 1:
+            pid, sts = self.options.waitpid()
+            if not pid:
+                break
+            reaped += 1
             process = self.options.pidhistory.get(pid, None)
             if process is None:
-                self.options.logger.info('reaped unknown pid %s' % pid)
+                if not self.options.detached_monitor.reaped(pid, sts):
+                    self.options.logger.info('reaped unknown pid %s' % pid)
             else:
                 process.finish(pid, sts)
                 del self.options.pidhistory[pid]
-            if not once:
-                # keep reaping until no more kids to reap, but don't recurse
-                # infintely
-                self.reap(once=False, recursionguard=recursionguard+1)
+            if once:
+                break
+        return reaped
 
     def handle_signal(self):
-        sig = self.options.get_signal()
-        if sig:
+        """ Handle every signal received since the last pass """
+        for sig in self.options.get_signals():
             if sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
                 self.options.logger.warn(
                     'received %s indicating exit request' % signame(sig))
@@ -0,0 +1,249 @@
+import heapq
+import time
+
+from adminservice.loopstats import Histogram
+from adminservice.states import ProcessStates
+
+class SpawnAdmission:
+    """ Keeps a storm of automatic starts from overwhelming the machine.
+
+    Every spawn that transition() wants to make (autostart, including of
+    detached programs found not running, autorestart, backoff retries and
+    dependency_startup requests) has to be admitted first.  A process that
+    isn't admitted right away joins a queue ordered by group priority,
+    then process priority, then arrival, and is handed a ticket, and its
+    group woken, when its turn comes.  Tickets are handed out while:
+
+    - fewer than spawn_max_starting processes are STARTING,
+    - fewer than spawn_max_rate processes were spawned in the last second,
+    - the 1 minute load average from /proc/loadavg is below spawn_max_load
+      and MemAvailable from /proc/meminfo is above spawn_min_memory.
+
+    The load and memory checks only hold a process back while something
+    else is STARTING, so a loaded machine still starts its processes one
+    at a time.  Each limit is off when set to 0, as they all are by
+    default.  Starts requested directly over RPC aren't queued, but do
+    count against the limits.
+    """
+
+    window = 1.0 # seconds spawn_max_rate counts spawns over
+    recheck = 1.0 # seconds between load/memory checks while held back
+    ticket_ttl = 5.0 # seconds before an unused ticket is taken back
+
+    def __init__(self, options):
+        self.options = options
+        self.queue = [] # heap of (group priority, priority, sequence, id(Subprocess))
+        self.queued = {} # id(Subprocess) -> (Subprocess, time queued, sequence)
+        self.tickets = {} # id(Subprocess) -> (Subprocess, time queued, time granted)
+        self.starting = {} # id(Subprocess) -> Subprocess in the STARTING state
+        self.spawns = [] # times of recent spawns, oldest first
+        self.sequence = 0
+        self.waits = Histogram()
+        self.admitted = 0
+        self.held = {} # limit -> number of times it held the queue back
+        self.resources = (0, None, None) # (time read, load average, MemAvailable)
+
+    def admit(self, process, now=None):
+        """ Return true if process may spawn now, otherwise queue it """
+        if now is None:
+            now = time.time()
+        key = id(process)
+        if not self.tickets.has_key(key) and not self.queued.has_key(key):
+            self.enqueue(process, now)
+        self.grant(now)
+        ticket = self.tickets.pop(key, None)
+        if ticket is None:
+            return False
+        self.admitted += 1
+        self.waits.add(max(0, now - ticket[1]))
+        self.options.timeline.admitted(process, ticket[1], now)
+        return True
+
+    def withdraw(self, process):
+        """ Forget process, it was removed or won't start after all """
+        self.queued.pop(id(process), None)
+        self.tickets.pop(id(process), None)
+        self.starting.pop(id(process), None)
+
+    def state_changed(self, process, old_state, new_state):
+        key = id(process)
+        if new_state == ProcessStates.STARTING:
+            self.starting[key] = process
+            self.spawns.append(time.time())
+            # it got going some other way (e.g. startProcess)
+            self.queued.pop(key, None)
+            self.tickets.pop(key, None)
+        elif old_state == ProcessStates.STARTING:
+            self.starting.pop(key, None)
+            if self.queued:
+                self.grant()
+        elif new_state in (ProcessStates.STOPPED, ProcessStates.FATAL,
+                           ProcessStates.DISABLED):
+            # stopped or given up on while waiting its turn
+            self.withdraw(process)
+
+    def get_available(self, now):
+        """ Return (how many more spawns the limits allow now, the limit
+        that allows the fewest, seconds until a rate slot frees up) """
+        options = self.options
+        available = None
+        limit = None
+        retry = None
+        outstanding = len(self.tickets)
+
+        if options.spawn_max_starting:
+            available = options.spawn_max_starting - len(self.starting) - outstanding
+            limit = 'starting'
+
+        if options.spawn_max_rate:
+            spawns = self.spawns
+            while spawns and spawns[0] <= now - self.window:
+                del spawns[0]
+            rate_left = options.spawn_max_rate - len(spawns) - outstanding
+            if available is None or rate_left < available:
+                available = rate_left
+                limit = 'rate'
+                if spawns:
+                    retry = spawns[0] + self.window - now
+
+        if available is None or available > 0:
+            if self.starting or outstanding:
+                reason = self.check_resources(now)
+                if reason is not None:
+                    available = 0
+                    limit = reason
+                    retry = self.recheck
+        if available is None:
+            available = len(self.queued)
+        return max(0, available), limit, retry
+
+    def check_resources(self, now):
+        """ Return the name of the resource that is too scarce to spawn
+        anything else, or None """
+        options = self.options
+        if not options.spawn_max_load and not options.spawn_min_memory:
+            return None
+        if now - self.resources[0] >= self.recheck or now < self.resources[0]:
+            self.resources = (now, read_loadavg(), read_memavailable())
+        when, load, memory = self.resources
+        if options.spawn_max_load and load is not None and load >= options.spawn_max_load:
+            return 'load'
+        if options.spawn_min_memory and memory is not None and memory < options.spawn_min_memory:
+            return 'memory'
+        return None
+
+    def grant(self, now=None):
+        """ Hand out tickets to the head of the queue while the limits allow
+        and wake the groups of the processes that got them """
+        if now is None:
+            now = time.time()
+        for key, (process, queued, granted) in self.tickets.items():
+            if now - granted > self.ticket_ttl or now < granted:
+                # its group never came back for it
+                del self.tickets[key]
+                self.enqueue(process, queued)
+
+        timers = self.options.timers
+        available, limit, retry = self.get_available(now)
+        while self.queue and available > 0:
+            group_priority, priority, sequence, key = heapq.heappop(self.queue)
+            entry = self.queued.get(key)
+            if entry is None or entry[2] != sequence:
+                continue # withdrawn or requeued
+            del self.queued[key]
+            process, queued = entry[0], entry[1]
+            self.tickets[key] = (process, queued, now)
+            timers.wake(process.group)
+            available -= 1
+
+        self.clean()
+        if self.queue:
+            self.held[limit] = self.held.get(limit, 0) + 1
+            if retry is None and self.tickets:
+                retry = self.ticket_ttl
+            if retry is not None:
+                # nothing else is going to wake the queue up
+                owner = self.queued[self.queue[0][3]][0].group
+                timers.set_timer('spawn-admission', owner, retry)
+
+    def enqueue(self, process, queued):
+        self.sequence += 1
+        group = process.group
+        if group is None:
+            group_priority = process.config.priority
+        else:
+            group_priority = group.config.priority
+        heapq.heappush(self.queue, (group_priority, process.config.priority,
+                                    self.sequence, id(process)))
+        self.queued[id(process)] = (process, queued, self.sequence)
+
+    def clean(self):
+        """ Drop withdrawn entries from the head of the queue """
+        queue = self.queue
+        while queue:
+            entry = self.queued.get(queue[0][3])
+            if entry is not None and entry[2] == queue[0][2]:
+                break
+            heapq.heappop(queue)
+
+    def get_info(self, now=None):
+        if now is None:
+            now = time.time()
+        options = self.options
+        queue = []
+        for group_priority, priority, sequence, key in sorted(self.queue):
+            entry = self.queued.get(key)
+            if entry is None or entry[2] != sequence:
+                continue
+            process = entry[0]
+            group = process.group
+            queue.append({'name': process.config.name,
+                          'group': group is not None and group.config.name or '',
+                          'waited': max(0, now - entry[1]),
+                          })
+        available, limit, retry = self.get_available(now)
+        when, load, memory = self.resources
+        held = []
+        for name, count in self.held.items():
+            held.append({'limit': name or '', 'count': count})
+        return {'max_starting': options.spawn_max_starting,
+                'max_rate': options.spawn_max_rate,
+                'max_load': float(options.spawn_max_load),
+                'min_memory': float(options.spawn_min_memory),
+                'starting': len(self.starting),
+                'tickets': len(self.tickets),
+                'available': available,
+                'limit': limit or '',
+                'load': load is not None and load or 0.0,
+                'memory': float(memory or 0),
+                'depth': len(queue),
+                'queue': queue,
+                'admitted': self.admitted,
+                'held': held,
+                'waits': self.waits.get_info(),
+                }
+
+def read_loadavg(path='/proc/loadavg'):
+    """ Return the 1 minute load average, or None if it can't be read """
+    try:
+        f = open(path)
+        try:
+            return float(f.read().split()[0])
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def read_memavailable(path='/proc/meminfo'):
+    """ Return MemAvailable in bytes, or None if it can't be read """
+    try:
+        f = open(path)
+        try:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
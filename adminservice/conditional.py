@@ -0,0 +1,152 @@
+import os
+import re
+import weakref
+
+from adminservice import events
+
+_patterns = {} # enable pattern -> compiled regex, shared by every file
+
+def compile_pattern(pattern):
+    compiled = _patterns.get(pattern)
+    if compiled is None:
+        # We read in the entire file with \n's, re.MULTILINE allows ^$ to match the \n line instead of the whole string
+        compiled = _patterns[pattern] = re.compile(pattern, re.MULTILINE)
+    return compiled
+
+class ConditionalFile:
+    """ One conditional_config file and the enable patterns evaluated
+    against its current contents """
+
+    stamp = None # (device, inode, mtime, size) when the file was last read
+    data = None # contents of the file; None if it couldn't be read
+    loaded = False # true once the file has been read (or found missing)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.results = {} # enable pattern -> True/False
+        self.patterns = {} # every enable pattern asked about -> True
+
+    def get_stamp(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+    def refresh(self):
+        """ Reread the file if it has changed since it was last read.
+        Returns True if it was reread. """
+        stamp = self.get_stamp()
+        if self.loaded and stamp == self.stamp:
+            return False
+        self.loaded = True
+        self.stamp = stamp
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                self.data = f.read()
+            finally:
+                f.close()
+        except (OSError, IOError):
+            self.data = None
+        self.results = {}
+        return True
+
+    def matches(self, pattern):
+        self.patterns[pattern] = True
+        if self.data is None:
+            raise ValueError('FAILED')
+        result = self.results.get(pattern)
+        if result is None:
+            result = compile_pattern(pattern).search(self.data) is not None
+            self.results[pattern] = result
+        return result
+
+class ConditionalConfigCache:
+    """ Shared cache of the conditional_config files that decide whether
+    processes with an enable pattern are enabled.
+
+    Each file is read once and every pattern is evaluated against it once;
+    all processes using the same file and pattern share the result.  The
+    main loop calls check() to stat the files, and a file is only reread
+    when its inode or mtime changes.  When an edit flips the result for a
+    pattern, a ProcessEnablementChangedEvent is sent for each process that
+    uses it.  While a ConfigWatcher watches the files (watched), they're
+    only stat()ed after it has seen one change (stale).
+    """
+
+    watched = False # true while a ConfigWatcher reports changes to the files
+
+    def __init__(self, options):
+        self.options = options
+        self.files = {} # filename -> ConditionalFile
+        self.processes = weakref.WeakValueDictionary() # id -> Subprocess
+        self.stale = True # true if a file may have changed since check()
+
+    def get_file(self, filename):
+        f = self.files.get(filename)
+        if f is None:
+            f = self.files[filename] = ConditionalFile(filename)
+            f.refresh()
+        return f
+
+    def is_enabled(self, filename, pattern):
+        return self.get_file(filename).matches(pattern)
+
+    def watch(self, process):
+        """ Send enablement change events for process """
+        self.processes[id(process)] = process
+
+    def check(self):
+        """ Called from the main loop; rereads changed files and reports
+        processes whose enablement flipped """
+        if self.watched and not self.stale:
+            return
+        self.stale = False
+        for f in self.files.values():
+            previous = f.results
+            was_unreadable = f.data is None
+            if not f.refresh():
+                continue
+            if f.data is None:
+                self.options.logger.warn(
+                    'conditional config %s could not be read' % f.filename)
+                # compare against what we knew once it's readable again
+                f.results = previous
+                continue
+            self.options.logger.debug(
+                'conditional config %s changed, reevaluating' % f.filename)
+
+            flipped = {}
+            if was_unreadable:
+                # previous is what was known before it became unreadable;
+                # a pattern first asked about since then has no result
+                # yet, so it counts as changed
+                for pattern in f.patterns.keys():
+                    result = f.matches(pattern)
+                    if previous.get(pattern) != result:
+                        flipped[pattern] = result
+            else:
+                for pattern, result in previous.items():
+                    if f.matches(pattern) != result:
+                        flipped[pattern] = not result
+            if flipped:
+                self.notify(f.filename, flipped)
+
+    def notify(self, filename, flipped):
+        for process in self.processes.values():
+            config = process.config
+            if config.conditional_config != filename:
+                continue
+            if not isinstance(config.enable, basestring):
+                continue
+            if not flipped.has_key(config.enable):
+                continue
+            enabled = flipped[config.enable]
+            self.options.logger.info(
+                '%s is now %s by %s' % (config.name,
+                                        enabled and 'enabled' or 'disabled',
+                                        filename))
+            events.notify(
+                events.ProcessEnablementChangedEvent(process, enabled))
+            self.options.timers.wake(process.group)
@@ -0,0 +1,365 @@
+import os
+import re
+import errno
+import copy
+import stat
+import inspect
+import select
+import tempfile
+import threading
+import traceback
+import cPickle
+
+try:
+    from hashlib import sha1
+except ImportError:  # Python 2.4 or earlier
+    from sha import new as sha1
+
+RH_SECTION_TYPES = ('domain', 'node', 'waveform')
+
+SNAPSHOT_VERSION = 1 # bumped whenever what a snapshot holds changes
+
+# an environment expansion, %(ENV_NAME)s, in a config file
+EXPANSION_RE = re.compile(r'%\((ENV_[^)]*)\)')
+
+# fewest .ini files worth giving a worker process of their own to parse
+FILES_PER_WORKER = 50
+
+# paths whose directories existing_dirpath() checked when a config was read
+PATH_PARAM_NAMES = ('pid_file', 'logfile', 'stdout_logfile', 'stderr_logfile')
+
+def get_stamp(filename):
+    """ Return (mtime, size) of filename, or None if it can't be stat()ed """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def read_file(filename):
+    """ Return (stamp, contents, sha1 of the contents) of filename """
+    f = open(filename, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    finally:
+        f.close()
+    return (st.st_mtime, st.st_size), data, sha1(data).hexdigest()
+
+def source_stamp(module):
+    """ Stamp of the source of module, whose classes a snapshot holds """
+    filename = module.__file__
+    if filename.endswith('.pyc') or filename.endswith('.pyo'):
+        filename = filename[:-1]
+    return get_stamp(filename)
+
+def get_expansions(text, environ, names=()):
+    """ (name, value) of the environment expansions text uses, and of
+    names, sorted; what's in the environment besides those doesn't change
+    the configs made from text """
+    found = dict.fromkeys(EXPANSION_RE.findall(text))
+    found.update(dict.fromkeys(names))
+    expansions = [ (name, environ.get(name)) for name in found.keys() ]
+    expansions.sort()
+    return expansions
+
+def name_file(message, filename):
+    """ message, saying which file it's about if it doesn't already """
+    if filename in message:
+        return message
+    return '%s (file: %r)' % (message, filename)
+
+def cpu_count():
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+def threads_running():
+    """ True if threads other than this one are running, like the
+    watchdog or the log writer.  A forked child only has the thread that
+    forked it, and any lock another thread held stays locked in it. """
+    return threading.activeCount() > 1
+
+def fingerprint(config_type, params):
+    """ sha1 of a config's type and its (name, value) params, made so the
+    same settings always hash the same however they were read """
+    return sha1(repr((config_type, stable_value(params)))).hexdigest()
+
+def stable_value(value):
+    """ value in a form whose repr() doesn't depend on dict order or on
+    where objects happen to be in memory """
+    if isinstance(value, dict):
+        items = [ (k, stable_value(v)) for k, v in value.items() ]
+        items.sort()
+        return ('dict', tuple(items))
+    if isinstance(value, (list, tuple)):
+        return tuple([ stable_value(v) for v in value ])
+    if isinstance(value, (basestring, int, long, float, bool, type(None))):
+        return value
+    if inspect.isclass(value):
+        return 'class %s.%s' % (value.__module__, value.__name__)
+    if hasattr(value, '__dict__'):
+        return (stable_value(value.__class__), stable_value(vars(value)))
+    return repr(value)
+
+def split_rh_section(section):
+    """ Return (type, name) of a [domain:...], [node:...] or
+    [waveform:...] section, or None for any other section """
+    parts = section.split(':', 1)
+    if len(parts) != 2 or parts[0] not in RH_SECTION_TYPES:
+        return None
+    return parts[0], parts[1].strip()
+
+def clone_groups(groups):
+    """ Copies of the group configs, so merging groups of the same name
+    doesn't change the cached ones; the process configs are shared """
+    clones = []
+    for group in groups:
+        clone = copy.copy(group)
+        clone.process_configs = list(group.process_configs)
+        clones.append(clone)
+    return clones
+
+class DirectoryRead:
+    """ One read of a domains, nodes or waveforms directory, from when
+    scan_rh_configs looks at its files until finish_rh_configs makes its
+    groups """
+
+    def __init__(self, defaults_file, config_dir, config_class, cache):
+        self.defaults_file = defaults_file
+        self.config_dir = config_dir
+        self.config_class = config_class
+        self.cache = cache # the directory's ConfigDirCache
+        self.text = None # contents of the defaults file
+        self.basis = None
+        self.snapshot = None # basis, environment and stamps of the files
+        self.defaults = None # (parser, default config) once needed
+        self.filenames = [] # the *.ini files, sorted
+        self.entries = {} # filename -> IniFile, kept or newly parsed
+        self.pending = [] # (filename, stamp, digest, expansions, data) to parse
+        self.parsed = 0 # files parsed
+        self.reread = False # true if any file had to be read again
+        self.whole = False # true if the directory must be read as a whole
+        self.groups = None # the groups, if they're known without parsing
+        self.infos = [] # parse_infos and parse_warnings to report
+        self.warnings = []
+
+class IniFile:
+    """ The group configs made from one .ini file """
+
+    def __init__(self, filename, stamp, digest, basis, expansions, sections,
+                 groups):
+        self.filename = filename
+        self.stamp = stamp # (mtime, size) when it was last read
+        self.digest = digest # sha1 of its contents
+        self.basis = basis # identifies the defaults it was read with
+        self.expansions = expansions # get_expansions() of its contents
+        self.sections = sections
+        self.groups = groups
+
+    def is_current(self, stamp, basis, environ):
+        if self.basis != basis or self.stamp != stamp:
+            return False
+        for name, value in self.expansions:
+            if environ.get(name) != value:
+                return False
+        return True
+
+class ConfigDirCache:
+    """ What was made from the .ini files of one domains, nodes or
+    waveforms directory the last time it was read.
+
+    A file whose mtime and size haven't changed, or whose contents hash
+    the same as before, keeps the group and process configs made from it
+    last time, so a reload only parses and builds configs for files that
+    are new or changed, or that use an environment expansion whose value
+    changed.  Everything is made again if the defaults file or anything
+    else the configs are made from (the basis) changes.  If the directory
+    had to be read as a whole, merged holds (snapshot, groups) and is
+    reused only while no file and nothing in the environment has changed.
+
+    The caches are saved in the config snapshot, so a daemon that starts
+    or restarts with the same files needn't parse any of them.
+    """
+
+    dirty = False # true if changed since it was last saved in a snapshot
+
+    def __init__(self):
+        self.files = {} # filename -> IniFile
+        self.basis = None # basis the files were read with
+        self.merged = None # (basis and file stamps, groups)
+
+    def get_groups(self):
+        groups = []
+        for entry in self.files.values():
+            groups.extend(entry.groups)
+        if self.merged is not None:
+            groups.extend(self.merged[1])
+        return groups
+
+    def dirs_exist(self):
+        """ False if a directory the configs name has gone since they were
+        read, which would make them invalid now """
+        dirs = {}
+        for group in self.get_groups():
+            for pconfig in group.process_configs:
+                for name in PATH_PARAM_NAMES:
+                    path = getattr(pconfig, name, None)
+                    if isinstance(path, basestring):
+                        dirs[os.path.dirname(path)] = True
+        for path in dirs.keys():
+            if path and not os.path.isdir(path):
+                return False
+        return True
+
+def make_pickler(f, options, dropped=()):
+    """ A pickler writing configs to f.  The options the configs refer to
+    belong to the running daemon, so only a reference to them is kept.
+    Instances of the dropped classes, like launch plans that are made
+    again when configs are loaded, are loaded as None. """
+    def persistent_id(obj):
+        if obj is options:
+            return 'options'
+        if isinstance(obj, dropped):
+            return 'dropped'
+        return None
+
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    return pickler
+
+def make_unpickler(f, options):
+    """ An unpickler reading configs make_pickler() wrote to f, which
+    refer to options """
+    def persistent_load(pid):
+        if pid == 'options':
+            return options
+        return None # dropped
+
+    unpickler = cPickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    return unpickler
+
+def set_options(groups, options):
+    """ Point groups and their process configs at options """
+    for group in groups:
+        group.options = options
+        for pconfig in group.process_configs:
+            pconfig.options = options
+
+def parallel_map(function, items, workers):
+    """ map(function, items), with the items split between workers forked
+    processes.  Each sends back what function returned for its items
+    pickled, so it mustn't refer to anything that can't be.  function
+    should return the errors it expects rather than raise them; anything
+    else a worker raises is raised here as a RuntimeError.  The workers
+    run Python after the fork, so don't call this while threads_running(). """
+    children = [] # (pid, fd of the pipe from it), in the order forked
+    try:
+        for start in range(workers):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    os.close(r)
+                    out = os.fdopen(w, 'wb')
+                    try:
+                        results = map(function, items[start::workers])
+                        outcome = (None, results)
+                    except:
+                        outcome = (traceback.format_exc(), None)
+                    cPickle.dump(outcome, out, cPickle.HIGHEST_PROTOCOL)
+                    out.close()
+                    code = 0
+                finally:
+                    os._exit(code)
+            os.close(w)
+            children.append((pid, r))
+
+        chunks = {} # fd -> data read from it
+        pending = [ fd for _, fd in children ]
+        while pending:
+            try:
+                ready, _, _ = select.select(pending, [], [])
+            except select.error, why:
+                if why.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 1 << 16)
+                if data:
+                    chunks.setdefault(fd, []).append(data)
+                else:
+                    pending.remove(fd)
+
+        results = [None] * len(items)
+        for start in range(workers):
+            pid, fd = children[start]
+            data = ''.join(chunks.get(fd, []))
+            try:
+                error, found = cPickle.loads(data)
+            except Exception:
+                raise RuntimeError('config worker %d died' % pid)
+            if error is not None:
+                raise RuntimeError('config worker %d failed: %s'
+                                   % (pid, error))
+            results[start::workers] = found
+        return results
+    finally:
+        for pid, fd in children:
+            os.close(fd)
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except OSError, why:
+                    if why.args[0] != errno.EINTR:
+                        break
+
+def save_snapshot(filename, key, caches, options, dropped=()):
+    """ Write caches, {config directory: ConfigDirCache}, to filename for
+    load_snapshot() to read back, pickled with make_pickler().  The file
+    is replaced atomically and only its owner can read it. """
+    fd, tmp = tempfile.mkstemp(prefix='.snapshot',
+                               dir=os.path.dirname(filename) or '.')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            make_pickler(f, options, dropped).dump(
+                (SNAPSHOT_VERSION, key, caches))
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def load_snapshot(filename, key, options):
+    """ The caches save_snapshot() wrote to filename with the same key,
+    their configs referring to options, or None if there's no such
+    snapshot.  A snapshot only this user could have written is trusted,
+    since loading one runs code. """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        st = os.fstat(f.fileno())
+        if (st.st_uid != os.getuid() or
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            return None
+        try:
+            version, snapshot_key, caches = make_unpickler(f, options).load()
+        except Exception:
+            # a damaged snapshot, or one holding classes that have changed
+            return None
+    finally:
+        f.close()
+    if version != SNAPSHOT_VERSION or snapshot_key != key:
+        return None
+    return caches
@@ -0,0 +1,502 @@
+import os
+import errno
+import struct
+import traceback
+
+from adminservice import events
+from adminservice.timers import monotonic
+from adminservice.states import AdminServiceStates
+from adminservice.states import ALL_STOPPED_STATES
+from adminservice.shutdown import stop_process
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len of the name
+
+class ConfigWatcher:
+    """ Rereads the configuration when its files change.
+
+    With config_watch set, the directory of the config file, the defaults
+    directory, the domains, nodes and waveforms directories and the
+    directories of the conditional_config files are watched with inotify,
+    or swept every poll_interval seconds where inotify isn't available.
+    A burst of changes, like an editor saving a file or an installer
+    dropping a dozen waveforms, is gathered until nothing has changed for
+    config_watch_delay seconds and then reread once; only the files that
+    changed are parsed again.
+
+    The reread configuration is applied the way 'rhadmin update' would
+    apply it, except that only the processes whose configs changed are
+    touched: added groups are added, changed groups are updated in place
+    and removed groups are stopped and removed once they're down.  A
+    ConfigChangedEvent names what changed.  With config_watch=dryrun the
+    configuration is reread and the event sent, but nothing is applied,
+    as with 'rhadmin reread'.
+
+    While inotify reports changes to the conditional_config files, the
+    ConditionalConfigCache only rereads them when told to, instead of
+    stat()ing each of them on every pass of the main loop.
+    """
+
+    poll_interval = 2 # seconds between sweeps without inotify
+
+    def __init__(self, adminserviced):
+        self.adminserviced = adminserviced
+        self.options = adminserviced.options
+        self.inotify = None # Inotify once started, if it's available
+        self.dispatchers = {} # inotify fd -> InotifyDispatcher
+        self.dirs = {} # watched directory -> wd, or None if it isn't
+        self.wds = {} # wd -> watched directory
+        self.stamps = {} # path -> stamp of each file swept, when polling
+        self.conditional_count = None # conditional files when last synced
+        self.changes = {} # paths changed since the last reread -> True
+        self.last_change = None # monotonic time of the latest change
+        # removed group name -> None, or its config if it came back
+        self.removing = {}
+        self.lastcheck = 0
+
+    def is_enabled(self):
+        return self.options.config_watch is not None
+
+    def is_dry_run(self):
+        return self.options.config_watch == 'dryrun'
+
+    def start(self):
+        if not self.is_enabled():
+            return
+        try:
+            self.inotify = Inotify()
+        except OSError, why:
+            self.options.logger.info(
+                'inotify is not available, polling config files '
+                'instead (%s)' % why.args[1])
+        else:
+            dispatcher = InotifyDispatcher(self, self.inotify)
+            self.dispatchers[self.inotify.fd] = dispatcher
+            self.options.dispatchers_changed()
+        self.sync()
+        if self.inotify is None:
+            self.stamps = self.sweep()
+        mode = self.is_dry_run() and 'dry run' or 'applying changes'
+        self.options.logger.info(
+            'watching %d config directories (%s)' % (len(self.dirs), mode))
+
+    def stop(self):
+        for dispatcher in self.dispatchers.values():
+            dispatcher.close()
+        if self.dispatchers:
+            self.dispatchers = {}
+            self.options.dispatchers_changed()
+        self.inotify = None
+        self.options.conditional_configs.watched = False
+        self.dirs = {}
+        self.wds = {}
+
+    def get_dispatchers(self):
+        """ The dispatcher map of the inotify fd, for the main loop """
+        return self.dispatchers
+
+    def get_rh_dirs(self):
+        options = self.options
+        return [ options.domains_dir, options.nodes_dir,
+                 options.waveforms_dir ]
+
+    def get_conditional_files(self):
+        return self.options.conditional_configs.files.keys()
+
+    def get_dirs(self):
+        """ The directories to watch, absolute """
+        options = self.options
+        dirs = [ options.defaults_dir ] + self.get_rh_dirs()
+        if options.configfile:
+            dirs.append(os.path.dirname(os.path.abspath(options.configfile)))
+        for filename in self.get_conditional_files():
+            dirs.append(os.path.dirname(filename))
+        found = {}
+        for path in dirs:
+            found[os.path.abspath(path)] = True
+        return found.keys()
+
+    def is_relevant(self, path):
+        """ Whether a change to path can change the configuration """
+        options = self.options
+        dirname, basename = os.path.split(path)
+        if basename.startswith('.'):
+            return False # editor swap files and the like
+        if (options.configfile and
+            path == os.path.abspath(options.configfile)):
+            return True
+        if dirname == os.path.abspath(options.defaults_dir):
+            return basename.endswith('.defaults')
+        for rh_dir in self.get_rh_dirs():
+            if dirname == os.path.abspath(rh_dir):
+                return basename.endswith('.ini')
+        return False
+
+    def is_conditional(self, path):
+        return self.options.conditional_configs.files.has_key(path)
+
+    def sync(self):
+        """ Watch the directories get_dirs() gives, and only those """
+        conditional = self.options.conditional_configs
+        self.conditional_count = len(conditional.files)
+        wanted = self.get_dirs()
+        for path in self.dirs.keys():
+            if path not in wanted:
+                wd = self.dirs.pop(path)
+                if wd is not None:
+                    del self.wds[wd]
+                    self.inotify.remove_watch(wd)
+        added = False
+        for path in wanted:
+            if self.dirs.has_key(path):
+                continue
+            if self.inotify is None:
+                self.dirs[path] = None
+                continue
+            try:
+                wd = self.inotify.add_watch(path, WATCH_MASK)
+            except OSError, why:
+                if why.args[0] == errno.ENOENT:
+                    continue # check() tries again while it's missing
+                self.options.logger.warn(
+                    'unable to watch %s: %s' % (path, why.args[1]))
+                wd = None
+            else:
+                self.wds[wd] = path
+                added = True
+            self.dirs[path] = wd
+        # conditional files are stat()ed as before unless every directory
+        # they're in is watched
+        conditional.watched = (self.inotify is not None and
+                               len(self.dirs) == len(wanted) and
+                               None not in self.dirs.values())
+        if added:
+            # it may have changed before it was watched
+            conditional.stale = True
+
+    def sweep(self):
+        """ Return {path: stamp} of the files in the watched directories
+        that is_relevant() or are conditional_config files """
+        stamps = {}
+        for path in self.dirs.keys():
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                filename = os.path.join(path, name)
+                if not (self.is_relevant(filename) or
+                        self.is_conditional(filename)):
+                    continue
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                stamps[filename] = (st.st_ino, st.st_mtime, st.st_size)
+        return stamps
+
+    def changed(self, path):
+        """ path changed; None if what changed isn't known """
+        if path is not None and self.is_conditional(path):
+            self.options.conditional_configs.stale = True
+            if not self.is_relevant(path):
+                return
+        elif path is not None and not self.is_relevant(path):
+            return
+        self.options.logger.blather('config file %s changed' % path)
+        self.changes[path] = True
+        self.last_change = monotonic()
+
+    def handle_events(self):
+        """ Read the events inotify has for us """
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; assume everything changed
+                self.options.conditional_configs.stale = True
+                self.changed(None)
+                continue
+            path = self.wds.get(wd)
+            if path is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory is gone; check() watches it again when
+                # it comes back
+                del self.wds[wd]
+                del self.dirs[path]
+                self.changed(None)
+                continue
+            if name:
+                self.changed(os.path.join(path, name))
+
+    def check(self, now=None):
+        """ Called from the main loop; sweeps the directories when polling
+        and rereads the configuration once changes have settled """
+        if not self.is_enabled():
+            return
+        if now is None:
+            now = monotonic()
+
+        self.finish_removals()
+
+        conditional = self.options.conditional_configs
+        if (len(conditional.files) != self.conditional_count or
+            (self.inotify is not None and
+             len(self.dirs) != len(self.get_dirs()))):
+            self.sync()
+
+        if self.inotify is None and not (
+            self.lastcheck <= now < self.lastcheck + self.poll_interval):
+            self.lastcheck = now
+            stamps = self.sweep()
+            for path, stamp in stamps.items():
+                if self.stamps.get(path) != stamp:
+                    self.changed(path)
+            for path in self.stamps.keys():
+                if not stamps.has_key(path):
+                    self.changed(path)
+            self.stamps = stamps
+
+        if not self.changes:
+            return
+        if now < self.last_change + self.options.config_watch_delay:
+            return # wait for the burst to finish
+        if self.options.mood < AdminServiceStates.RUNNING:
+            return
+        paths = [ path for path in self.changes.keys() if path is not None ]
+        paths.sort()
+        self.changes = {}
+        self.reload(paths)
+
+    def reload(self, paths):
+        """ Reread the configuration and apply what changed """
+        options = self.options
+        adminserviced = self.adminserviced
+        options.logger.info('config changed: %s'
+                            % (', '.join(paths) or 'unknown files'))
+        try:
+            options.process_config(do_usage=False)
+        except ValueError, msg:
+            options.logger.error('could not reread config: %s' % msg)
+            return
+        for msg in options.parse_warnings:
+            options.logger.warn(msg)
+
+        added, changed, removed = adminserviced.diff_to_active()
+        processes = ([], [], []) # (added, changed, removed) process names
+        for config in added:
+            processes[0].extend([ '%s:%s' % (config.name, pconfig.name)
+                                  for pconfig in config.process_configs ])
+        for config in changed:
+            group = adminserviced.process_groups[config.name]
+            diff = group.diff_config(config)
+            for names, found in zip(processes, diff):
+                names.extend([ '%s:%s' % (config.name, name)
+                               for name in found ])
+        for config in removed:
+            group = adminserviced.process_groups[config.name]
+            processes[2].extend([ '%s:%s' % (config.name, name)
+                                  for name in group.processes.keys() ])
+        for names in processes:
+            names.sort()
+
+        dry_run = self.is_dry_run()
+        if not dry_run:
+            for config in options.process_group_configs:
+                if self.removing.has_key(config.name):
+                    # configured again before its old processes were down;
+                    # it's added back with this config once they are
+                    self.removing[config.name] = config
+        event = events.ConfigChangedEvent(paths,
+                                          [ c.name for c in added ],
+                                          [ c.name for c in changed ],
+                                          [ c.name for c in removed ],
+                                          processes, not dry_run)
+        if dry_run or not (added or changed or removed):
+            options.logger.info('config reread (%s)' % event.describe())
+            events.notify(event)
+            return
+
+        for config in removed:
+            group = adminserviced.process_groups[config.name]
+            self.stop_group(group)
+            self.removing[config.name] = None
+        for config in changed:
+            group = adminserviced.process_groups[config.name]
+            if self.removing.has_key(config.name):
+                continue # it's being removed and added back
+            if not group.update_in_place:
+                options.logger.warn(
+                    '%s was not updated; use rhadmin update to apply its '
+                    'new config' % config.name)
+                continue
+            group.update(config)
+        for config in added:
+            adminserviced.add_process_group(config)
+        options.logger.info('config applied (%s)' % event.describe())
+        events.notify(event)
+        self.finish_removals()
+
+    def stop_group(self, group):
+        processes = group.processes.values()
+        processes.sort()
+        processes.reverse() # stop in desc priority order
+        for process in processes:
+            if process.get_state() in ALL_STOPPED_STATES:
+                continue
+            self.options.logger.info('stopping %s, it is no longer '
+                                     'configured' % process.config.name)
+            msg = stop_process(group, process)
+            if msg is not None:
+                self.options.logger.warn('could not stop %s: %s'
+                                         % (process.config.name, msg))
+
+    def finish_removals(self):
+        """ Remove the groups reload() stopped once they're down, adding
+        back those whose config came back in the meantime """
+        process_groups = self.adminserviced.process_groups
+        for name in self.removing.keys():
+            if not process_groups.has_key(name):
+                del self.removing[name] # removed some other way
+            elif self.adminserviced.remove_process_group(name):
+                config = self.removing.pop(name)
+                if config is None:
+                    self.options.logger.info('removed process group %s'
+                                             % name)
+                else:
+                    self.adminserviced.add_process_group(config)
+                    self.options.logger.info('added process group %s back, '
+                                             'it is configured again' % name)
+
+class InotifyDispatcher:
+    """ Main loop dispatcher for the inotify fd; it becomes readable when
+    a watched directory changes """
+
+    closed = False
+
+    def __init__(self, watcher, inotify):
+        self.watcher = watcher
+        self.inotify = inotify
+        self.fd = inotify.fd
+
+    def __repr__(self):
+        return '<%s at %s for fd %s>' % (self.__class__.__name__, id(self),
+                                         self.fd)
+
+    def readable(self):
+        return not self.closed
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        self.watcher.handle_events()
+
+    def handle_error(self):
+        self.watcher.options.logger.critical(
+            'error handling config file changes:\n%s'
+            % traceback.format_exc())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.inotify.close()
+
+_libc = None
+
+def get_libc():
+    """ libc through ctypes, or None if it can't be loaded """
+    global _libc
+    if _libc is None:
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init1
+            _libc = (libc, ctypes.get_errno)
+        except (ImportError, OSError, AttributeError):
+            _libc = False
+    return _libc
+
+class Inotify:
+    """ An inotify instance (Linux 2.6.27 and later), through ctypes.
+    Raises OSError, with ENOSYS where it isn't available. """
+
+    def __init__(self):
+        libc = get_libc()
+        if not libc or not os.uname()[0] == 'Linux':
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        self.libc, self.get_errno = libc
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+        self.buffer = ''
+
+    def raise_errno(self):
+        code = self.get_errno()
+        raise OSError(code, os.strerror(code))
+
+    def add_watch(self, path, mask):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.raise_errno()
+        return wd
+
+    def remove_watch(self, wd):
+        # fails harmlessly if the watch went with its directory
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """ Return [(wd, mask, name)] of the events waiting """
+        chunks = [self.buffer]
+        while 1:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, why:
+                if why.args[0] == errno.EINTR:
+                    continue
+                if why.args[0] != errno.EAGAIN:
+                    raise
+                break
+            if not data:
+                break
+            chunks.append(data)
+        data = ''.join(chunks)
+        found = []
+        offset = 0
+        size = EVENT_HEADER.size
+        while offset + size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            if offset + size + length > len(data):
+                break
+            name = data[offset + size:offset + size + length].rstrip('\0')
+            found.append((wd, mask, name))
+            offset += size + length
+        self.buffer = data[offset:]
+        return found
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
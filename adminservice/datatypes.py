@@ -6,6 +6,7 @@ import socket
 import shlex
 import urlparse
 from adminservice.loggers import getLevelNumByDescription
+from adminservice.loggers import AsyncLogWriter
 
 def process_or_group_name(name_arr):
     """Ensures that a process or group name is not created with
@@ -35,6 +36,16 @@ def boolean(s):
     else:
         raise ValueError("not a valid boolean value: " + repr(s))
 
+def config_watch_mode(val):
+    """ None if config files aren't watched, 'dryrun' if changes are only
+    reported, else 'apply' """
+    ss = str(val).lower()
+    if ss == 'dryrun':
+        return 'dryrun'
+    if boolean(ss):
+        return 'apply'
+    return None
+
 def list_of_strings(arg):
     if not arg:
         return []
@@ -108,6 +119,22 @@ def logfile_name(val):
     else:
         return existing_dirpath(val)
 
+def snapshot_name(val):
+    if hasattr(val, 'lower') and val.lower() in LOGFILE_NONES + ('',):
+        return None
+    return existing_dirpath(val)
+
+def async_logging_policy(val):
+    """ None if logs are written synchronously, else the overflow policy
+    of the log writer thread """
+    ss = str(val).lower()
+    if ss in LOGFILE_NONES + ('', 'false', 'no'):
+        return None
+    if ss not in AsyncLogWriter.policies:
+        raise ValueError('not a valid async_logging value: %r (use off, %s)'
+                         % (val, ', '.join(AsyncLogWriter.policies)))
+    return ss
+
 class RangeCheckedConversion:
     """Conversion helper that range checks another conversion."""
 
@@ -0,0 +1,328 @@
+import os
+import time
+import errno
+
+class DetachedMonitor:
+    """ Tracks the liveness of run_detached programs from inside the main
+    loop.
+
+    Detached programs are not children of adminserviced, so they can't be
+    reaped.  Instead of keeping a forked copy of adminserviced around for
+    each of them, the owning Subprocess registers the program here once its
+    launcher has exited and the monitor checks every tracked program once
+    per interval, calling back into the Subprocess when it goes away.
+
+    When adminserviced is a child subreaper the programs it launches are
+    reparented to it, so they are reaped like any other child: reap()
+    passes their pids here and the owning Subprocess is finished with the
+    real exit status.  Those programs are left out of the sweep.
+
+    Other programs, such as those adopted from an earlier adminserviced,
+    are opened as pidfds (Linux 5.3 and later) that the main loop polls
+    along with its other descriptors; a pidfd becomes readable when its
+    program exits.  Only programs with a status_script, or any program
+    when pidfds aren't available, are swept.
+    """
+
+    interval = 1 # seconds between liveness sweeps
+
+    def __init__(self, options):
+        self.options = options
+        self.tracked = {} # id(Subprocess) -> (Subprocess, detached pid or None)
+        self.pids = {} # detached pid -> Subprocess
+        self.children = {} # detached pids that are our children, -> True
+        self.orphans = {} # pid -> (Subprocess, wait status), reaped before they were tracked
+        self.exited = [] # (Subprocess, pid, wait status) to finish next check
+        self.pidfds = {} # pidfd -> PidfdDispatcher
+        self.pidfd_fds = {} # detached pid -> pidfd
+        self.pidfd_supported = True # false once pidfd_open has failed with ENOSYS
+        self.lastcheck = 0
+
+    def track(self, process, pid=None):
+        """ Start watching a detached program.  pid is None when the pid
+        file doesn't hold a pid (waveforms), in which case the configured
+        status check decides liveness. """
+        self.untrack(process)
+        self.tracked[id(process)] = (process, pid)
+        process.config.invalidate_status()
+        if pid is None:
+            return
+        self.pids[pid] = process
+        if self.orphans.has_key(pid):
+            # it exited before its launcher did
+            self.exited.append((process, pid, self.orphans.pop(pid)[1]))
+        elif self.options.is_subreaper and get_ppid(pid) == os.getpid():
+            self.children[pid] = True
+        else:
+            self.open_pidfd(process, pid)
+
+    def launcher_failed(self, process):
+        """ The launcher of process failed, so the program it reaped
+        early won't be tracked; forget it """
+        for pid, (orphaned, sts) in self.orphans.items():
+            if orphaned is process:
+                del self.orphans[pid]
+
+    def untrack(self, process):
+        entry = self.tracked.pop(id(process), None)
+        if entry is None or entry[1] is None:
+            return
+        pid = entry[1]
+        if self.pids.get(pid) is process:
+            del self.pids[pid]
+        if self.children.has_key(pid):
+            del self.children[pid]
+        self.close_pidfd(pid)
+
+    def close(self):
+        """ Close every pidfd and forget what was tracked; called when
+        the daemon shuts down or restarts.  The programs keep running, and
+        the next run finds them again through their pid files. """
+        for dispatcher in self.pidfds.values():
+            dispatcher.close()
+        if self.pidfds:
+            self.options.dispatchers_changed()
+        self.tracked = {}
+        self.pids = {}
+        self.children = {}
+        self.orphans = {}
+        self.exited = []
+        self.pidfds = {}
+        self.pidfd_fds = {}
+
+    def open_pidfd(self, process, pid):
+        if not self.pidfd_supported:
+            return
+        try:
+            fd = pidfd_open(pid)
+        except OSError, why:
+            if why.args[0] in (errno.ENOSYS, errno.EPERM):
+                self.pidfd_supported = False
+                self.options.logger.info(
+                    'pidfds are not available, polling detached '
+                    'processes instead (%s)' % why.args[1])
+            elif why.args[0] != errno.ESRCH:
+                self.options.logger.warn(
+                    'unable to open a pidfd for %s (pid %s): %s'
+                    % (process.config.name, pid, why.args[1]))
+            # ESRCH: it's gone already; the next sweep will notice
+            return
+        self.pidfds[fd] = PidfdDispatcher(self, process, pid, fd)
+        self.pidfd_fds[pid] = fd
+        self.options.dispatchers_changed()
+
+    def close_pidfd(self, pid):
+        fd = self.pidfd_fds.pop(pid, None)
+        if fd is None:
+            return
+        self.pidfds[fd].close()
+        del self.pidfds[fd]
+        self.options.dispatchers_changed()
+
+    def pidfd_exited(self, dispatcher):
+        """ The program behind a pidfd has exited """
+        if self.pidfds.get(dispatcher.fd) is dispatcher:
+            self.close_pidfd(dispatcher.pid)
+        else:
+            dispatcher.close()
+        process = dispatcher.process
+        if self.get_pid(process) == dispatcher.pid:
+            process.config.alive = False
+            self.gone(process)
+
+    def get_dispatchers(self):
+        """ The dispatcher map of open pidfds, for the main loop """
+        return self.pidfds
+
+    def is_tracked(self, process):
+        return self.tracked.has_key(id(process))
+
+    def get_pid(self, process):
+        """ The pid being watched for process, None if there isn't one """
+        return self.tracked.get(id(process), (process, None))[1]
+
+    def get_tracked_count(self):
+        return len(self.tracked)
+
+    def check(self, now=None):
+        """ Called from the main loop; sweeps the tracked programs at most
+        once per interval and finishes the ones that have exited """
+        if now is None:
+            now = time.time()
+
+        exited, self.exited = self.exited, []
+        for process, pid, sts in exited:
+            if self.pids.get(pid) is process:
+                process.finish(pid, sts)
+
+        if self.lastcheck <= now < self.lastcheck + self.interval:
+            return
+        self.lastcheck = now
+
+        for process, pid in self.tracked.values():
+            if self.children.has_key(pid):
+                # reap() will tell us
+                continue
+            if (self.pidfd_fds.has_key(pid) and
+                process.config.status_script is None):
+                # the pidfd will tell us
+                continue
+            if pid is None or process.config.status_script is not None:
+                self.check_status(process)
+            elif not pid_exists(pid):
+                process.config.alive = False
+                self.gone(process)
+            else:
+                process.config.alive = True
+
+    def check_status(self, process):
+        """ Run the process' status check without blocking the loop """
+        entry = self.tracked[id(process)]
+
+        def onstatus(alive):
+            # the program may have been stopped or relaunched in the meantime
+            if not alive and self.tracked.get(id(process)) is entry:
+                self.gone(process)
+
+        process.config.check_status_async(onstatus)
+
+    def gone(self, process):
+        pid = self.get_pid(process)
+        self.untrack(process)
+        self.options.logger.debug(
+            'detached process %s (pid %s) is no longer running'
+            % (process.config.name, pid))
+        process.detached_exited()
+
+    def reaped(self, pid, sts):
+        """ reap() reaped a pid that isn't in pidhistory.  As a subreaper
+        that can be a detached program, found either by its tracked pid or
+        by the pid file of a process whose launcher is still running.
+        Returns True if the pid was expected. """
+        if not self.options.is_subreaper:
+            return False
+
+        process = self.pids.get(pid)
+        if process is not None:
+            self.options.logger.debug(
+                'reaped detached process %s (pid %s)'
+                % (process.config.name, pid))
+            process.finish(pid, sts)
+            return True
+
+        for launcher_pid, process in self.options.pidhistory.items():
+            if getattr(process, 'launcher_pid', 0) != launcher_pid:
+                continue
+            if process.config.get_pid() == pid:
+                self.options.logger.debug(
+                    'detached process %s (pid %s) exited before its '
+                    'launcher' % (process.config.name, pid))
+                self.orphans[pid] = (process, sts)
+                return True
+
+        # the launchers' intermediate forks and the orphaned children of
+        # the programs we launched end up here too
+        self.options.logger.blather('reaped orphaned pid %s' % pid)
+        return True
+
+class PidfdDispatcher:
+    """ Main loop dispatcher for the pidfd of a detached program; it
+    becomes readable once the program has exited """
+
+    closed = False
+
+    def __init__(self, monitor, process, pid, fd):
+        self.monitor = monitor
+        self.process = process
+        self.pid = pid
+        self.fd = fd
+
+    def __repr__(self):
+        return '<%s at %s for %s (pid %s)>' % (self.__class__.__name__,
+                                               id(self),
+                                               self.process.config.name,
+                                               self.pid)
+
+    def readable(self):
+        return not self.closed
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        self.monitor.pidfd_exited(self)
+
+    def handle_error(self):
+        import traceback
+        self.monitor.options.logger.critical(
+            'error handling exit of %s (pid %s):\n%s'
+            % (self.process.config.name, self.pid, traceback.format_exc()))
+        self.monitor.close_pidfd(self.pid)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+
+_syscall = None
+
+# pidfd_open's syscall number by os.uname() machine; 434 in the syscall
+# table most architectures share, but not everywhere (e.g. alpha, ia64,
+# and mips, whose number depends on the ABI, so it isn't listed)
+PIDFD_OPEN_NUMBERS = {
+    'x86_64': 434, 'i386': 434, 'i486': 434, 'i586': 434, 'i686': 434,
+    'aarch64': 434, 'aarch64_be': 434, 'armv6l': 434, 'armv7l': 434,
+    'armv8l': 434, 'ppc': 434, 'ppc64': 434, 'ppc64le': 434,
+    's390x': 434, 'riscv64': 434, 'sparc64': 434, 'parisc64': 434,
+    'alpha': 544, 'ia64': 1458,
+    }
+
+def pidfd_open(pid):
+    """ Return a pidfd (close-on-exec) for pid.  Raises OSError, with
+    ENOSYS where the kernel or platform doesn't have pidfd_open. """
+    global _syscall
+    if _syscall is None:
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _syscall = (libc.syscall, ctypes.get_errno)
+        except (ImportError, OSError, AttributeError):
+            _syscall = False
+    system, machine = os.uname()[0], os.uname()[4]
+    NR_pidfd_open = PIDFD_OPEN_NUMBERS.get(machine)
+    if not _syscall or system != 'Linux' or NR_pidfd_open is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    syscall, get_errno = _syscall
+    fd = syscall(NR_pidfd_open, pid, 0)
+    if fd < 0:
+        code = get_errno()
+        raise OSError(code, os.strerror(code))
+    return fd
+
+def get_ppid(pid):
+    """ Return the parent pid of pid, None if it can't be found """
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        # the command name is in parentheses and may contain spaces
+        return int(data[data.rindex(')') + 2:].split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def pid_exists(pid):
+    """ Return True if a process with the given pid exists """
+    try:
+        os.kill(pid, 0)
+    except OSError, why:
+        if why.args[0] == errno.EPERM:
+            # it exists, it's just not ours to signal
+            return True
+        return False
+    return True
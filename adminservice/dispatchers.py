@@ -58,6 +58,7 @@ class PDispatcher:
             self.process.config.options.logger.debug(
                 'fd %s closed, stopped monitoring %s' % (self.fd, self))
             self.closed = True
+            self.process.config.options.interest_changed(self)
 
     def flush(self):
         pass
@@ -100,7 +101,8 @@ class POutputDispatcher(PDispatcher):
                 fmt=fmt,
                 rotating=not not maxbytes, # optimization
                 maxbytes=maxbytes,
-                backups=backups)
+                backups=backups,
+                batcher=process.config.options.child_log_batcher)
 
         if capture_maxbytes:
             self.capturelog = self.process.config.options.getLogger(
@@ -280,7 +282,8 @@ class PEventListenerDispatcher(PDispatcher):
                 '%(message)s',
                 rotating=not not maxbytes, # optimization
                 maxbytes=maxbytes,
-                backups=backups)
+                backups=backups,
+                batcher=process.config.options.child_log_batcher)
 
     def removelogs(self):
         if self.childlog is not None:
@@ -158,6 +158,23 @@ class ProcessStateStoppedEvent(ProcessStateEvent):
     def get_extra_values(self):
         return [('pid', self.process.pid)]
 
+class ProcessEnablementChangedEvent(Event):
+    """ A change to a conditional_config file flipped whether a process
+    is enabled """
+    def __init__(self, process, enabled):
+        self.process = process
+        self.enabled = enabled
+
+    def __str__(self):
+        groupname = ''
+        if self.process.group is not None:
+            groupname = self.process.group.config.name
+        return 'processname:%s groupname:%s enabled:%s conditional_config:%s' % (
+            self.process.config.name,
+            groupname,
+            self.enabled,
+            self.process.config.conditional_config)
+
 class ProcessGroupEvent(Event):
     def __init__(self, group):
         self.group = group
@@ -170,6 +187,35 @@ class ProcessGroupAddedEvent(ProcessGroupEvent):
 class ProcessGroupRemovedEvent(ProcessGroupEvent):
     pass
 
+class ConfigChangedEvent(Event):
+    """ The config files changed and were reread; applied is false when
+    config_watch is dryrun and nothing was done about it """
+
+    def __init__(self, paths, added, changed, removed, processes, applied):
+        self.paths = paths
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.processes = processes # (added, changed, removed) group:name
+        self.applied = applied
+
+    def describe(self):
+        added, changed, removed = self.processes
+        return ('groups added %s, changed %s, removed %s; processes added '
+                '%s, changed %s, removed %s' % (self.added, self.changed,
+                                                self.removed, added, changed,
+                                                removed))
+
+    def __str__(self):
+        added, changed, removed = self.processes
+        return ('applied:%s added:%s changed:%s removed:%s '
+                'processes_added:%s processes_changed:%s '
+                'processes_removed:%s files:%s' % (
+                    self.applied, ','.join(self.added),
+                    ','.join(self.changed), ','.join(self.removed),
+                    ','.join(added), ','.join(changed), ','.join(removed),
+                    ','.join(self.paths)))
+
 class TickEvent(Event):
     """ Abstract """
     def __init__(self, when, adminserviced):
@@ -202,6 +248,7 @@ class EventTypes:
     PROCESS_STATE_FATAL = ProcessStateFatalEvent
     PROCESS_STATE_RUNNING = ProcessStateRunningEvent
     PROCESS_STATE_UNKNOWN = ProcessStateUnknownEvent
+    PROCESS_ENABLEMENT_CHANGED = ProcessEnablementChangedEvent
     PROCESS_COMMUNICATION = ProcessCommunicationEvent # abstract
     PROCESS_COMMUNICATION_STDOUT = ProcessCommunicationStdoutEvent
     PROCESS_COMMUNICATION_STDERR = ProcessCommunicationStderrEvent
@@ -219,6 +266,7 @@ class EventTypes:
     PROCESS_GROUP = ProcessGroupEvent # abstract
     PROCESS_GROUP_ADDED = ProcessGroupAddedEvent
     PROCESS_GROUP_REMOVED = ProcessGroupRemovedEvent
+    CONFIG_CHANGED = ConfigChangedEvent
 
 def getEventNameByType(requested):
     for name, typ in EventTypes.__dict__.items():
@@ -26,6 +26,8 @@ from adminservice.medusa import default_handler
 
 from adminservice.medusa.auth_handler import auth_handler
 
+from adminservice.launch import set_cloexec
+
 class NOT_DONE_YET:
     pass
 
@@ -480,8 +482,16 @@ class adminservice_http_server(http_server.http_server):
         self.handlers = []
 
         sock.setblocking(0)
+        set_cloexec(sock.fileno())
         self.set_reuse_addr()
 
+    def accept(self):
+        result = http_server.http_server.accept(self)
+        if result is not None:
+            # keep clients' connections out of the programs we spawn
+            set_cloexec(result[0].fileno())
+        return result
+
     def postbind(self):
         from adminservice.medusa.counter import counter
         from adminservice.medusa.http_server import VERSION_STRING
@@ -738,6 +748,7 @@ class logtail_handler:
             request.error(410) # gone
             return
 
+        self.adminserviced.options.child_log_batcher.flush()
         mtime = os.stat(logfile)[stat.ST_MTIME]
         request['Last-Modified'] = http_date.build_http_date(mtime)
         request['Content-Type'] = 'text/plain;charset=utf-8'
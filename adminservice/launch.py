@@ -0,0 +1,482 @@
+import os
+import re
+import sys
+import errno
+import fcntl
+import ctypes
+import shlex
+import resource
+import subprocess
+
+class NotNative(ValueError):
+    """ The settings can't be applied without the shell chain """
+
+# bash ulimit options: resource and the unit its values are given in.
+# resources Python doesn't name are given by their Linux numbers.
+ULIMITS = {
+    'c': (resource.RLIMIT_CORE, 1024),
+    'd': (resource.RLIMIT_DATA, 1024),
+    'e': (getattr(resource, 'RLIMIT_NICE', 13), 1),
+    'f': (resource.RLIMIT_FSIZE, 1024),
+    'i': (getattr(resource, 'RLIMIT_SIGPENDING', 11), 1),
+    'l': (resource.RLIMIT_MEMLOCK, 1024),
+    'm': (resource.RLIMIT_RSS, 1024),
+    'n': (resource.RLIMIT_NOFILE, 1),
+    'q': (getattr(resource, 'RLIMIT_MSGQUEUE', 12), 1),
+    'r': (getattr(resource, 'RLIMIT_RTPRIO', 14), 1),
+    's': (resource.RLIMIT_STACK, 1024),
+    't': (resource.RLIMIT_CPU, 1),
+    'u': (resource.RLIMIT_NPROC, 1),
+    'v': (resource.RLIMIT_AS, 1024),
+    'x': (getattr(resource, 'RLIMIT_LOCKS', 10), 1),
+    }
+
+# characters that make bash do more with a command than split it into words
+SHELL_SYNTAX = re.compile(r'[$`\\|&;<>(){}*?\[\]~!#\'"\n]')
+
+CPU_SETSIZE = 1024
+
+NR_CLOSE_RANGE = 436 # the same on every Linux architecture
+MAX_FD = 0xffffffff # close_range's highest fd
+
+def check_command(command):
+    """ Raise NotNative if bash would do more with command than split it
+    into words """
+    if SHELL_SYNTAX.search(command):
+        raise NotNative('the command uses shell syntax')
+
+def parse_nice(spec):
+    """ Return the niceness increment nice would apply for the nice
+    arguments in spec """
+    args = shlex.split(spec)
+    value = None
+    while args:
+        arg = args.pop(0)
+        if arg in ('-n', '--adjustment') and args:
+            value = args.pop(0)
+        elif arg.startswith('--adjustment='):
+            value = arg[len('--adjustment='):]
+        elif arg.startswith('-n'):
+            value = arg[2:]
+        elif arg.startswith('-'):
+            # the obsolete -NUM form
+            value = arg
+        else:
+            raise NotNative('unexpected nice argument %r' % arg)
+    if value is None:
+        return 10 # nice's default adjustment
+    try:
+        return int(value)
+    except ValueError:
+        raise NotNative('bad nice adjustment %r' % value)
+
+def parse_limit(value, unit):
+    """ Convert a ulimit value to what setrlimit() takes, or 'hard' or
+    'soft' to keep the current hard or soft limit """
+    if value == 'unlimited':
+        return resource.RLIM_INFINITY
+    if value in ('hard', 'soft'):
+        return value
+    try:
+        limit = int(value)
+    except ValueError:
+        raise NotNative('bad ulimit value %r' % value)
+    if limit < 0:
+        raise NotNative('bad ulimit value %r' % value)
+    return limit * unit
+
+def parse_ulimit(spec, corefiles=None):
+    """ Return the (resource, soft, hard) limits bash's ulimit would set
+    for the ulimit arguments in spec, followed by -c corefiles.  soft and
+    hard are None where ulimit leaves the limit alone. """
+    args = []
+    if spec:
+        args.extend(shlex.split(spec))
+    if corefiles is not None:
+        args.extend(['-c', str(corefiles)])
+
+    limits = []
+    hard = soft = False
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith('-') or len(arg) < 2:
+            raise NotNative('unexpected ulimit argument %r' % arg)
+        letters = arg[1:]
+        for i in range(len(letters)):
+            letter = letters[i]
+            if letter == 'H':
+                hard = True
+            elif letter == 'S':
+                soft = True
+            elif letter == 'a':
+                pass # only prints the limits
+            elif ULIMITS.has_key(letter):
+                rest = letters[i+1:]
+                if rest:
+                    value = rest
+                elif args and not args[0].startswith('-'):
+                    value = args.pop(0)
+                else:
+                    value = None # only prints the limit
+                if value is not None:
+                    res, unit = ULIMITS[letter]
+                    limit = parse_limit(value, unit)
+                    # bash sets both limits unless told which
+                    both = not hard and not soft
+                    soft_limit = hard_limit = None
+                    if soft or both:
+                        soft_limit = limit
+                    if hard or both:
+                        hard_limit = limit
+                    limits.append((res, soft_limit, hard_limit))
+                break
+            else:
+                raise NotNative('unsupported ulimit option -%s' % letter)
+    return limits
+
+def parse_cpus(spec):
+    """ Parse a cpu or node list like 0-3,6,8-9 """
+    items = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                first, last = part.split('-', 1)
+                items.extend(range(int(first), int(last) + 1))
+            else:
+                items.append(int(part))
+        except ValueError:
+            raise NotNative('bad cpu list %r' % spec)
+    if not items:
+        raise NotNative('empty cpu list %r' % spec)
+    return items
+
+def read_node_cpus(node, sysfs='/sys/devices/system/node'):
+    try:
+        f = open(os.path.join(sysfs, 'node%d' % node, 'cpulist'))
+        try:
+            return parse_cpus(f.read().strip())
+        finally:
+            f.close()
+    except IOError:
+        raise NotNative('NUMA node %s not found' % node)
+
+def parse_affinity(spec):
+    """ Return the cpus numactl would bind the program to for the numactl
+    arguments in spec.  Memory policies need numactl itself. """
+    args = shlex.split(spec)
+    cpus = None
+    while args:
+        arg = args.pop(0)
+        if '=' in arg and arg.startswith('--'):
+            option, value = arg.split('=', 1)
+        elif arg in ('-C', '-N', '--physcpubind', '--cpunodebind') and args:
+            option, value = arg, args.pop(0)
+        elif arg[:2] in ('-C', '-N') and len(arg) > 2:
+            option, value = arg[:2], arg[2:]
+        else:
+            raise NotNative('numactl option %r needs numactl' % arg)
+        if value.startswith('+') or value.startswith('!') or value == 'all':
+            raise NotNative('numactl %s %s needs numactl' % (option, value))
+        if option in ('-C', '--physcpubind'):
+            selected = parse_cpus(value)
+        elif option in ('-N', '--cpunodebind'):
+            selected = []
+            for node in parse_cpus(value):
+                selected.extend(read_node_cpus(node))
+        else:
+            raise NotNative('numactl option %r needs numactl' % option)
+        if cpus is None:
+            cpus = []
+        cpus.extend([ cpu for cpu in selected if cpu not in cpus ])
+    return cpus
+
+def read_cgroup_mounts(mounts='/proc/mounts'):
+    """ Return ({controller: cgroup v1 mount point}, cgroup2 mount point) """
+    controllers = {}
+    unified = None
+    f = open(mounts)
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            where, fstype, opts = fields[1], fields[2], fields[3]
+            if fstype == 'cgroup2' and unified is None:
+                unified = where
+            elif fstype == 'cgroup':
+                for opt in opts.split(','):
+                    controllers.setdefault(opt, where)
+    finally:
+        f.close()
+    return controllers, unified
+
+def parse_cgroup(spec, mounts='/proc/mounts'):
+    """ Return the cgroup.procs files cgexec would put the program in for
+    the cgexec arguments in spec """
+    args = shlex.split(spec)
+    try:
+        controllers, unified = read_cgroup_mounts(mounts)
+    except IOError, why:
+        raise NotNative("can't read %s: %s" % (mounts, why))
+    procs = []
+    while args:
+        arg = args.pop(0)
+        if arg == '--sticky':
+            continue
+        if arg == '-g' and args:
+            value = args.pop(0)
+        elif arg.startswith('-g'):
+            value = arg[2:]
+        else:
+            raise NotNative('unexpected cgexec argument %r' % arg)
+        if ':' not in value:
+            raise NotNative('bad cgexec group %r' % value)
+        names, path = value.split(':', 1)
+        path = path.lstrip('/')
+        if names == '*':
+            roots = dict([ (root, True) for root in controllers.values() ]).keys()
+            roots.sort()
+        else:
+            roots = []
+            for name in names.split(','):
+                root = controllers.get(name, unified)
+                if root is None:
+                    raise NotNative('cgroup controller %s is not mounted' % name)
+                if root not in roots:
+                    roots.append(root)
+        if not roots and unified is not None:
+            roots = [unified]
+        for root in roots:
+            filename = os.path.join(root, path, 'cgroup.procs')
+            if filename not in procs:
+                procs.append(filename)
+    return procs
+
+def sched_setaffinity(pid, cpus):
+    """ Bind pid (0 for this process) to cpus """
+    words = CPU_SETSIZE / (8 * ctypes.sizeof(ctypes.c_ulong))
+    mask = (ctypes.c_ulong * words)()
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for cpu in cpus:
+        if cpu < 0 or cpu >= CPU_SETSIZE:
+            raise OSError(errno.EINVAL, 'cpu %d out of range' % cpu)
+        mask[cpu / bits] |= 1 << (cpu % bits)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+def find_close_range():
+    """ Return a function calling close_range(2) with (low, high, flags),
+    or None if the kernel or the C library doesn't have it """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    close_range = getattr(libc, 'close_range', None)
+    if close_range is not None:
+        close_range.argtypes = [ctypes.c_uint, ctypes.c_uint, ctypes.c_int]
+    elif sys.platform.startswith('linux'):
+        # glibc older than 2.34; the kernel may still have it
+        syscall = libc.syscall
+        def close_range(low, high, flags):
+            return syscall(NR_CLOSE_RANGE, ctypes.c_uint(low),
+                           ctypes.c_uint(high), ctypes.c_int(flags))
+    else:
+        return None
+    # closing a descriptor that can't be open fails only if the call does
+    if close_range(MAX_FD, MAX_FD, 0) != 0:
+        return None
+    return close_range
+
+# looked up once in the daemon, so forked children don't have to
+CLOSE_RANGE = find_close_range()
+
+def close_fds(low, maxfd):
+    """ Close every file descriptor from low up, in a forked child about
+    to exec.  Uses close_range(2) when the kernel has it, otherwise closes
+    the descriptors listed in /proc/self/fd, and only if that can't be
+    read tries each one below maxfd. """
+    if CLOSE_RANGE is not None and CLOSE_RANGE(low, MAX_FD, 0) == 0:
+        return
+    try:
+        names = os.listdir('/proc/self/fd')
+    except OSError:
+        os.closerange(low, maxfd)
+        return
+    for name in names:
+        fd = int(name)
+        if fd >= low:
+            try:
+                os.close(fd)
+            except OSError:
+                # the descriptor listdir() read the directory with
+                pass
+
+def set_cloexec(fd):
+    """ Have fd closed when this process, or a child of it, execs """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+class LaunchSettings:
+    """ The nicelevel, ulimit, corefiles, affinity and cgroup settings of
+    a run_detached program, applied by the launcher to itself before it
+    execs the program rather than by running the program under cgexec,
+    nice, bash's ulimit and numactl.
+
+    Raises NotNative for anything only those programs can do, e.g. a
+    numactl memory policy; such programs are still started through the
+    shell chain.
+    """
+
+    def __init__(self, nicelevel=None, ulimit=None, corefiles=None,
+                 affinity=None, cgroup=None):
+        self.nice = None
+        self.limits = []
+        self.cpus = None
+        self.cgroup_procs = []
+        if nicelevel is not None:
+            self.nice = parse_nice(nicelevel)
+        if ulimit is not None or corefiles is not None:
+            self.limits = parse_ulimit(ulimit, corefiles)
+        if affinity is not None:
+            self.cpus = parse_affinity(affinity)
+        if cgroup is not None:
+            self.cgroup_procs = parse_cgroup(cgroup)
+
+    def apply(self):
+        """ Apply the settings to this process, in the order the shell
+        chain would.  Returns an error message if the program must not be
+        run, like cgexec and numactl refusing to run it. """
+        pid = os.getpid()
+        for filename in self.cgroup_procs:
+            try:
+                f = open(filename, 'w')
+                try:
+                    f.write('%d\n' % pid)
+                finally:
+                    f.close()
+            except IOError, why:
+                return "couldn't move into cgroup %s: %s" % (
+                    os.path.dirname(filename), why.strerror)
+
+        if self.nice:
+            try:
+                os.nice(self.nice)
+            except OSError, why:
+                # like nice, warn and carry on
+                sys.stderr.write('adminservice: cannot set niceness: %s\n'
+                                 % why.strerror)
+
+        for res, soft, hard in self.limits:
+            # like ulimit in the shell chain, a limit that can't be set
+            # doesn't stop the program from running
+            try:
+                current = resource.getrlimit(res)
+                if soft == 'hard':
+                    soft = current[1]
+                elif soft == 'soft' or soft is None:
+                    soft = current[0]
+                if hard == 'soft':
+                    hard = current[0]
+                elif hard == 'hard' or hard is None:
+                    hard = current[1]
+                resource.setrlimit(res, (soft, hard))
+            except (ValueError, resource.error), why:
+                sys.stderr.write('adminservice: cannot set limit %s: %s\n'
+                                 % (res, why))
+
+        if self.cpus is not None:
+            try:
+                sched_setaffinity(0, self.cpus)
+            except OSError, why:
+                return "couldn't set cpu affinity: %s" % why.strerror
+        return None
+
+class NativeLaunch:
+    """ Starts a run_detached program without the shell chain of
+    RedhawkProcessConfig.get_start_command.  The daemonized launcher
+    applies the LaunchSettings, points stdout and stderr at the program's
+    log files and execs the program itself; its parent writes the pid
+    file.  A start_pre_script is still sourced by bash, which then execs
+    the program, so what the script exports reaches the program; the pid
+    file is written just before that, so it only appears once the script
+    is done, as with the shell chain. """
+
+    def __init__(self, settings, stdout_file, stderr_file=None, pid_file=None,
+                 pre_script=None, post_script=None, maxfd=1024):
+        self.settings = settings
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file # None to send stderr to stdout_file
+        self.pid_file = pid_file # None if the program writes it itself
+        self.pre_script = pre_script # bash commands run before the program
+        self.post_script = post_script # bash commands run once it's started
+        self.maxfd = maxfd
+
+    def execute(self, argv, env, filename=None):
+        """ Runs in the daemonized child; never returns.  filename is the
+        program argv[0] names, found on the PATH as the shell would. """
+        if filename is None:
+            filename = argv[0]
+        try:
+            try:
+                flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                stdout = os.open(self.stdout_file, flags, 0666)
+                if self.stderr_file is None:
+                    stderr = stdout
+                else:
+                    stderr = os.open(self.stderr_file, flags, 0666)
+                stdin = os.open('/dev/null', os.O_RDONLY)
+                os.dup2(stdin, 0)
+                os.dup2(stdout, 1)
+                os.dup2(stderr, 2)
+                close_fds(3, self.maxfd)
+            except OSError, why:
+                sys.stderr.write("adminservice: couldn't open log file: %s\n"
+                                 % why.strerror)
+                return
+            except TypeError, why:
+                # a log file that isn't a path; make_native_launch
+                # shouldn't let one through
+                sys.stderr.write("adminservice: bad log file: %s\n" % why)
+                return
+
+            msg = self.settings.apply()
+            if msg is not None:
+                sys.stderr.write('adminservice: %s\n' % msg)
+                return
+
+            if self.pre_script is not None:
+                script = self.pre_script
+                if self.pid_file is not None:
+                    script = '%s echo $$ > "$0";' % script
+                argv = ['/bin/bash', '-c', '%s exec "$@"' % script,
+                        self.pid_file or filename, filename] + list(argv[1:])
+                filename = argv[0]
+            os.execve(filename, argv, env)
+        except OSError, why:
+            code = errno.errorcode.get(why.args[0], why.args[0])
+            sys.stderr.write("adminservice: couldn't exec %s: %s\n"
+                             % (filename, code))
+        finally:
+            os._exit(127)
+
+    def started(self, pid, env):
+        """ Runs in the daemonized child's parent once the program was
+        forked """
+        if self.pid_file is not None and self.pre_script is None:
+            # the launcher polls for the pid file, so it mustn't see it
+            # half written
+            tmp = '%s.%d.tmp' % (self.pid_file, os.getpid())
+            f = open(tmp, 'w')
+            try:
+                f.write('%d\n' % pid)
+            finally:
+                f.close()
+            os.rename(tmp, self.pid_file)
+        if self.post_script is not None:
+            subprocess.call(['/bin/bash', '-c', self.post_script], env=env,
+                            close_fds=True)
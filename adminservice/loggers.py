@@ -11,8 +11,12 @@ import os
 import errno
 import sys
 import time
+import thread
+import threading
 import traceback
 
+from collections import deque
+
 try:
     import syslog
 except ImportError:
@@ -211,6 +215,9 @@ class RotatingFileHandler(FileHandler):
         if not (self.stream.tell() >= self.maxBytes):
             return
 
+        self.rollover()
+
+    def rollover(self):
         self.stream.close()
         if self.backupCount > 0:
             for i in range(self.backupCount - 1, 0, -1):
@@ -222,16 +229,398 @@ class RotatingFileHandler(FileHandler):
             self.removeAndRename(self.baseFilename, dfn)
         self.stream = open(self.baseFilename, 'w')
 
+class BatchedFileHandler(RotatingFileHandler):
+    """ A RotatingFileHandler for child logs that doesn't write each record
+    as it's emitted.  Records are queued with a LogBatcher, which writes
+    everything queued for the file with one write() when it's flushed.
+    The size of the file is kept in memory, so deciding whether to roll
+    it over doesn't cost a tell() per record.  Records formatted as
+    '%(message)s' skip LogRecord.asdict() and its strftime().
+    """
+
+    def __init__(self, filename, batcher, mode='a', maxBytes=0,
+                 backupCount=0):
+        RotatingFileHandler.__init__(self, filename, mode, maxBytes,
+                                     backupCount)
+        self.batcher = batcher
+        self.chunks = [] # formatted records waiting to be written
+        self.size = self.get_size()
+
+    def get_size(self):
+        return os.fstat(self.stream.fileno()).st_size
+
+    def emit(self, record):
+        try:
+            if self.fmt == '%(message)s' and not record.kw:
+                msg = record.msg
+            else:
+                msg = self.fmt % record.asdict()
+            if isinstance(msg, unicode):
+                msg = msg.encode("UTF-8")
+            self.chunks.append(msg)
+            self.batcher.queue(self, len(msg))
+        except:
+            self.handleError()
+
+    def flush(self):
+        """ Write the queued records, on the batcher's AsyncLogWriter if
+        it has one """
+        chunks, self.chunks = self.chunks, []
+        if not chunks:
+            return
+        writer = self.batcher.writer
+        if writer is None:
+            self.write_chunks(chunks)
+        else:
+            # process output is never dropped to make room in the queue
+            writer.submit(None, self.write_chunks, chunks)
+
+    def call(self, function, *args):
+        """ Run function after the records queued before it are written """
+        writer = self.batcher.writer
+        if writer is None:
+            return function(*args)
+        return writer.call(function, *args)
+
+    def write_chunks(self, chunks):
+        """ Write chunks, rolling the file over when it reaches maxBytes,
+        the same records ahead of each rollover as if they had been
+        written one at a time """
+        try:
+            if self.maxBytes <= 0:
+                self.write(''.join(chunks))
+                return
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                self.size += len(chunk)
+                if self.size >= self.maxBytes:
+                    self.write(''.join(batch))
+                    batch = []
+                    self.rollover()
+            if batch:
+                self.write(''.join(batch))
+        except:
+            self.handleError()
+
+    def write(self, data):
+        fd = self.stream.fileno()
+        while data:
+            try:
+                written = os.write(fd, data)
+            except OSError, why:
+                if why.args[0] == errno.EINTR:
+                    continue
+                raise
+            data = data[written:]
+
+    def rollover(self):
+        RotatingFileHandler.rollover(self)
+        self.size = 0
+
+    def doRollover(self):
+        if self.maxBytes > 0 and self.size >= self.maxBytes:
+            self.rollover()
+
+    def reopen(self):
+        self.flush()
+        self.call(self.reopen_now)
+
+    def reopen_now(self):
+        RotatingFileHandler.reopen(self)
+        self.size = self.get_size()
+
+    def remove(self):
+        # what was logged before the file was removed goes with it
+        self.chunks = []
+        self.call(RotatingFileHandler.remove, self)
+
+    def close(self):
+        self.flush()
+        self.call(RotatingFileHandler.close, self)
+
+class LogBatcher:
+    """ Gathers the records child logs emit, so the output every process
+    sends during a pass of the main loop is written with one write() per
+    log file instead of one or more per pipe read.
+
+    The main loop calls check() once per pass.  What's queued is written
+    once interval seconds have passed since the last flush (every pass
+    when interval is 0), or as soon as more than maxbytes are queued.
+    Anything that reads the logs calls flush() first, which also waits
+    for the writer, if there is one, to have written it.
+    """
+
+    writer = None # AsyncLogWriter the batches are written on, if any
+
+    def __init__(self, interval=0, maxbytes=1<<20):
+        self.interval = interval
+        self.maxbytes = maxbytes
+        self.handlers = {} # id(handler) -> BatchedFileHandler with records
+        self.queued = 0 # bytes queued
+        self.lastflush = time.time()
+
+    def queue(self, handler, size):
+        self.handlers[id(handler)] = handler
+        self.queued += size
+        if self.queued > self.maxbytes:
+            self.write()
+
+    def write(self):
+        """ Write what's queued, or hand it to the writer to write """
+        handlers, self.handlers = self.handlers, {}
+        self.queued = 0
+        self.lastflush = time.time()
+        for handler in handlers.values():
+            handler.flush()
+
+    def flush(self):
+        """ Write what's queued and return once it's in the files """
+        self.write()
+        if self.writer is not None:
+            self.writer.flush()
+
+    def check(self, now=None):
+        if not self.handlers:
+            return
+        if now is None:
+            now = time.time()
+        if not (self.lastflush <= now < self.lastflush + self.interval):
+            self.write()
+
+    def get_timeout(self, maximum, now=None):
+        """ Seconds until what's queued is due to be written, at most
+        maximum """
+        if not self.handlers:
+            return maximum
+        if now is None:
+            now = time.time()
+        return max(0, min(maximum, self.lastflush + self.interval - now))
+
+class AsyncLogWriter:
+    """ Writes logs on a thread of its own, so a log volume that's slow or
+    stalled, or a slow rollover, doesn't hold up the main loop.
+
+    Handlers wrapped in an AsyncHandler, and the batches of a LogBatcher
+    whose writer this is, are queued here instead of being written, for
+    the writer thread to write in order.  At most maxsize of them are
+    queued; when the queue is full, policy decides what happens:
+
+      block       wait for the writer thread to make room
+      drop-oldest drop the oldest main log record queued, else wait
+      drop-debug  drop the record if it's a main log record below INFO,
+                  else drop the oldest queued main log record below INFO,
+                  else wait
+
+    Child log batches are submitted with no level and are never dropped.
+
+    Flushing, reopening, removing and closing a log are queued too, but
+    never dropped, and wait until the writer thread has done them, so
+    they happen after everything logged before them and are done when
+    they return.  Until start() is called, on the writer thread itself
+    and in forked children, which don't have the thread, everything is
+    written at once as it would be without it.
+    """
+
+    policies = ('block', 'drop-oldest', 'drop-debug')
+
+    def __init__(self, maxsize=10000, policy='block'):
+        if policy not in self.policies:
+            raise ValueError('bad log writer policy %r' % policy)
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.entries = deque() # (level, function, args, done or None)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.thread_ident = None
+        self.pid = None # pid of the process the thread runs in
+        self.stopping = False
+        self.queued = 0 # records queued
+        self.dropped = 0 # records dropped because the queue was full
+        self.flushed = 0 # records written
+        self.waits = 0 # times a full queue made a caller wait
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name='logwriter')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Write everything queued and stop the writer thread """
+        if self.is_inline():
+            return
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        self.thread.join()
+        self.thread = None
+
+    def is_inline(self):
+        """ True if what's logged has to be written by the caller """
+        return (self.thread is None or self.pid != os.getpid() or
+                thread.get_ident() == self.thread_ident)
+
+    def submit(self, level, function, *args):
+        """ Queue a record of level; function(*args) writes it.  A level
+        of None means it mustn't be dropped. """
+        if self.is_inline():
+            function(*args)
+            return
+        self.condition.acquire()
+        try:
+            entries = self.entries
+            while len(entries) >= self.maxsize:
+                if self.policy == 'block':
+                    victim = None
+                elif self.policy == 'drop-oldest':
+                    victim = self.find_record()
+                elif level is not None and level < LevelsByName.INFO:
+                    self.dropped += 1
+                    return
+                else:
+                    victim = self.find_record(LevelsByName.INFO)
+                if victim is not None:
+                    del entries[victim]
+                    self.dropped += 1
+                    break
+                self.waits += 1
+                self.condition.wait()
+            entries.append((level, function, args, None))
+            self.queued += 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def find_record(self, below=None):
+        """ Index of the oldest record queued that may be dropped, of a
+        level below below if it's given; None if there isn't one """
+        index = 0
+        for level, function, args, done in self.entries:
+            if level is not None and (below is None or level < below):
+                return index
+            index += 1
+        return None
+
+    def call(self, function, *args):
+        """ Return function(*args), run by the writer thread after what was
+        queued before it """
+        if self.is_inline():
+            return function(*args)
+        done = [threading.Event(), None, None] # finished, result, exc_info
+        self.condition.acquire()
+        try:
+            self.entries.append((None, function, args, done))
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        done[0].wait()
+        if done[2] is not None:
+            raise done[2][0], done[2][1], done[2][2]
+        return done[1]
+
+    def flush(self):
+        """ Wait until everything queued so far has been written """
+        self.call(lambda: None)
+
+    def run(self):
+        self.thread_ident = thread.get_ident()
+        flushed = 0
+        while 1:
+            self.condition.acquire()
+            try:
+                self.flushed += flushed
+                while not self.entries and not self.stopping:
+                    self.condition.wait()
+                if not self.entries:
+                    return # stopping, and everything is written
+                entries = list(self.entries)
+                self.entries.clear()
+                self.condition.notifyAll() # there's room again
+            finally:
+                self.condition.release()
+            flushed = 0
+            for level, function, args, done in entries:
+                try:
+                    result = function(*args)
+                except:
+                    if done is None:
+                        traceback.print_exc(file=sys.stderr)
+                    else:
+                        done[2] = sys.exc_info()
+                else:
+                    if done is None:
+                        flushed += 1
+                    else:
+                        done[1] = result
+                if done is not None:
+                    done[0].set()
+
+    def get_info(self):
+        self.condition.acquire()
+        try:
+            return {'policy': self.policy,
+                    'maxsize': self.maxsize,
+                    'pending': len(self.entries),
+                    'queued': self.queued,
+                    'dropped': self.dropped,
+                    'flushed': self.flushed,
+                    'waits': self.waits}
+        finally:
+            self.condition.release()
+
+class AsyncHandler(Handler):
+    """ Hands the records of another handler to an AsyncLogWriter to write
+    on its thread """
+
+    def __init__(self, handler, writer):
+        self.handler = handler
+        self.writer = writer
+        self.level = handler.level
+
+    def setFormat(self, fmt):
+        self.handler.setFormat(fmt)
+
+    def setLevel(self, level):
+        self.level = level
+        self.handler.setLevel(level)
+
+    def emit(self, record):
+        if record.kw:
+            # what the message names may change before it's written
+            record.msg = record.msg % record.kw
+            record.kw = {}
+        self.writer.submit(record.level, self.handler.emit, record)
+
+    def flush(self):
+        self.writer.call(self.handler.flush)
+
+    def reopen(self):
+        self.writer.call(self.handler.reopen)
+
+    def remove(self):
+        self.writer.call(self.handler.remove)
+
+    def close(self):
+        self.writer.call(self.handler.close)
+
 class LogRecord:
     def __init__(self, level, msg, **kw):
         self.level = level
         self.msg = msg
         self.kw = kw
         self.dictrepr = None
+        self.created = time.time()
 
     def asdict(self):
         if self.dictrepr is None:
-            now = time.time()
+            now = self.created
             msecs = (now - long(now)) * 1000
             part1 = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
             asctime = '%s,%03d' % (part1, msecs)
@@ -323,7 +712,7 @@ class SyslogHandler(Handler):
             self.handleError()
 
 def getLogger(filename, level, fmt, rotating=False, maxbytes=0, backups=0,
-              stdout=False):
+              stdout=False, batcher=None, writer=None):
 
     handlers = []
 
@@ -339,6 +728,12 @@ def getLogger(filename, level, fmt, rotating=False, maxbytes=0, backups=0,
     elif filename == 'syslog':
         handlers.append(SyslogHandler())
 
+    elif batcher is not None:
+        if rotating is False:
+            maxbytes = 0
+        handlers.append(BatchedFileHandler(filename, batcher, 'a', maxbytes,
+                                           backups))
+
     else:
         if rotating is False:
             handlers.append(FileHandler(filename))
@@ -348,6 +743,14 @@ def getLogger(filename, level, fmt, rotating=False, maxbytes=0, backups=0,
     if stdout:
         handlers.append(StreamHandler(sys.stdout))
 
+    if writer is not None:
+        # a BoundIO is read back at once, a batcher has its own writer
+        for i in range(len(handlers)):
+            handler = handlers[i]
+            if (not isinstance(handler, BatchedFileHandler) and
+                not isinstance(getattr(handler, 'stream', None), BoundIO)):
+                handlers[i] = AsyncHandler(handler, writer)
+
     for handler in handlers:
         handler.setFormat(fmt)
         handler.setLevel(level)
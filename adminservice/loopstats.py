@@ -0,0 +1,144 @@
+import time
+
+# upper bounds (seconds) of the histogram buckets; the last bucket counts
+# everything above the last bound
+BUCKET_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# the phases of an iteration of AdminService.runforever, in order
+PHASES = ('map', 'poll', 'read', 'write', 'checks', 'transition', 'reap',
+          'signal', 'tick', 'stop')
+
+MAXINT = 2 ** 31 - 1
+
+def _rpc_number(n):
+    # xmlrpclib can't marshal ints that don't fit in 32 bits
+    if n > MAXINT:
+        return float(n)
+    return n
+
+class Histogram:
+    """ Counts of durations in fixed buckets, plus their total and maximum.
+    Memory use doesn't grow with the number of samples. """
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_info(self):
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = 0.0
+        return {'count': _rpc_number(self.count),
+                'total': self.total,
+                'mean': mean,
+                'max': self.max,
+                'buckets': [ _rpc_number(n) for n in self.buckets ],
+                }
+
+class LoopStats:
+    """ Timings of each phase of the main loop.
+
+    The loop calls begin() at the top of each iteration, mark() at the
+    end of each phase and end() at the bottom.  The time since the previous
+    mark is charged to the phase, and at the end of the iteration each
+    phase's time is added to its histogram.  An iteration that spends more
+    than slow seconds outside of the poll is counted as slow, and the phase
+    that took the longest in it is remembered.
+    """
+
+    slow = 0.1 # seconds of work (not counting the poll) that make an iteration slow
+
+    def __init__(self):
+        self.phases = {}
+        for name in PHASES:
+            self.phases[name] = Histogram()
+        self.iteration = Histogram()
+        self.started = time.time()
+        self.iterations = 0
+        self.slow_iterations = 0
+        self.read_events = 0
+        self.write_events = 0
+        self.last_slow = None # (time, busy seconds, slowest phase)
+        self.begun = None # when the current iteration began
+        self.last = None # time of the last mark
+        self.current = {} # phase -> seconds spent in it this iteration
+
+    def begin(self, now=None):
+        if now is None:
+            now = time.time()
+        self.begun = self.last = now
+        self.current = {}
+
+    def mark(self, phase, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.last
+        self.last = now
+        if elapsed < 0:
+            # the clock was set back
+            elapsed = 0.0
+        self.current[phase] = self.current.get(phase, 0.0) + elapsed
+
+    def events(self, r, w):
+        self.read_events += len(r)
+        self.write_events += len(w)
+
+    def end(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.begun is None:
+            return
+        busy = 0.0
+        slowest = (0.0, None)
+        for phase, elapsed in self.current.items():
+            self.phases[phase].add(elapsed)
+            if phase == 'poll':
+                continue
+            busy += elapsed
+            if elapsed > slowest[0]:
+                slowest = (elapsed, phase)
+        self.iterations += 1
+        self.iteration.add(busy)
+        if busy > self.slow:
+            self.slow_iterations += 1
+            self.last_slow = (now, busy, slowest[1])
+        self.begun = None
+
+    def get_info(self):
+        phases = []
+        for name in PHASES:
+            info = self.phases[name].get_info()
+            info['name'] = name
+            phases.append(info)
+        info = {'since': self.started,
+                'iterations': _rpc_number(self.iterations),
+                'slow_iterations': _rpc_number(self.slow_iterations),
+                'slow_threshold': self.slow,
+                'read_events': _rpc_number(self.read_events),
+                'write_events': _rpc_number(self.write_events),
+                'bucket_bounds': list(BUCKET_BOUNDS),
+                'busy': self.iteration.get_info(),
+                'phases': phases,
+                }
+        if self.last_slow is not None:
+            when, busy, phase = self.last_slow
+            info['last_slow'] = {'time': when, 'busy': busy,
+                                 'phase': phase or ''}
+        return info
@@ -19,6 +19,9 @@ import warnings
 import fcntl
 import subprocess
 import inspect
+import shlex
+import cPickle
+from StringIO import StringIO
 
 from adminservice.medusa import asyncore_25 as asyncore
 
@@ -34,6 +37,9 @@ from adminservice.datatypes import signal_number
 from adminservice.datatypes import list_of_exitcodes
 from adminservice.datatypes import dict_of_key_value_pairs
 from adminservice.datatypes import logfile_name
+from adminservice.datatypes import snapshot_name
+from adminservice.datatypes import config_watch_mode
+from adminservice.datatypes import async_logging_policy
 from adminservice.datatypes import list_of_strings
 from adminservice.datatypes import octal_type
 from adminservice.datatypes import existing_directory
@@ -52,11 +58,26 @@ from adminservice import loggers
 from adminservice import states
 from adminservice import xmlrpc
 from adminservice import poller
+from adminservice import detached
+from adminservice import scriptrunner
+from adminservice import conditional
+from adminservice import timers
+from adminservice import startup
+from adminservice import admission
+from adminservice import timeline
+from adminservice import launch
+from adminservice import configcache
+from adminservice import datatypes
 
 mydir = os.path.abspath(os.path.dirname(__file__))
 version_txt = os.path.join(mydir, 'version.txt')
 VERSION = open(version_txt).read().strip()
 
+# follows a run_detached start_pre_script in the start command, so the
+# launcher can tell how long the script took
+PRE_SCRIPT_DONE = ('[ -n "$ADMINSERVICE_PRE_SCRIPT_DONE" ] && '
+                   'date +%s.%N > "$ADMINSERVICE_PRE_SCRIPT_DONE";')
+
 def normalize_path(v):
     return os.path.normpath(os.path.abspath(os.path.expanduser(v)))
 
@@ -465,6 +486,7 @@ class ServerOptions(Options):
     httpservers = ()
     unlink_pidfile = False
     unlink_socketfiles = False
+    is_subreaper = False
     mood = states.AdminServiceStates.RUNNING
 
     def __init__(self):
@@ -508,13 +530,67 @@ class ServerOptions(Options):
                  "t", "strip_ansi", flag=1, default=0)
         self.add("profile_options", "adminserviced.profile_options",
                  "", "profile_options=", profile_options, default=None)
+        self.add("script_pool_size", "adminserviced.script_pool_size",
+                 "", "script_pool_size=", integer, default=4)
+        self.add("script_timeout", "adminserviced.script_timeout",
+                 "", "script_timeout=", integer, default=60)
+        self.add("script_cache_ttl", "adminserviced.script_cache_ttl",
+                 "", "script_cache_ttl=", integer, default=1)
+        self.add("subreaper", "adminserviced.subreaper",
+                 "", "subreaper", flag=1, default=0)
+        self.add("watchdog_threshold", "adminserviced.watchdog_threshold",
+                 "", "watchdog_threshold=", integer, default=0)
+        self.add("dependency_startup", "adminserviced.dependency_startup",
+                 "", "dependency_startup", flag=1, default=0)
+        self.add("startup_parallelism", "adminserviced.startup_parallelism",
+                 "", "startup_parallelism=", integer, default=8)
+        self.add("spawn_max_starting", "adminserviced.spawn_max_starting",
+                 "", "spawn_max_starting=", integer, default=0)
+        self.add("spawn_max_rate", "adminserviced.spawn_max_rate",
+                 "", "spawn_max_rate=", integer, default=0)
+        self.add("spawn_max_load", "adminserviced.spawn_max_load",
+                 "", "spawn_max_load=", float, default=0)
+        self.add("spawn_min_memory", "adminserviced.spawn_min_memory",
+                 "", "spawn_min_memory=", byte_size, default=0)
+        self.add("shell_launch", "adminserviced.shell_launch",
+                 "", "shell_launch", flag=1, default=0)
+        self.add("config_snapshot", "adminserviced.config_snapshot",
+                 "", "config_snapshot=", snapshot_name, default=None)
+        self.add("config_workers", "adminserviced.config_workers",
+                 "", "config_workers=", integer, default=0)
+        self.add("config_watch", "adminserviced.config_watch",
+                 "", "config_watch=", config_watch_mode, default=None)
+        self.add("config_watch_delay", "adminserviced.config_watch_delay",
+                 "", "config_watch_delay=", float, default=1)
+        self.add("childlog_flush_interval",
+                 "adminserviced.childlog_flush_interval",
+                 "", "childlog_flush_interval=", float, default=0)
+        self.add("childlog_buffer_size", "adminserviced.childlog_buffer_size",
+                 "", "childlog_buffer_size=", byte_size, default=1024 * 1024)
+        self.add("async_logging", "adminserviced.async_logging",
+                 "", "async_logging=", async_logging_policy, default=None)
+        self.add("async_log_queue", "adminserviced.async_log_queue",
+                 "", "async_log_queue=", integer, default=10000)
         self.pidhistory = {}
+        self.dispatcher_serial = 0
+        self.interest_changes = {} # id(dispatcher) -> dispatcher to recheck
         self.process_group_configs = []
+        self.rh_config_cache = {} # config directory -> ConfigDirCache
         self.parse_criticals = []
         self.parse_warnings = []
         self.parse_infos = []
         self.signal_receiver = SignalReceiver()
         self.poller = poller.Poller(self)
+        self.detached_monitor = detached.DetachedMonitor(self)
+        self.script_runner = scriptrunner.ScriptRunner(self)
+        self.conditional_configs = conditional.ConditionalConfigCache(self)
+        self.timers = timers.TimerHeap()
+        self.startup_scheduler = startup.StartupScheduler(self)
+        self.spawn_admission = admission.SpawnAdmission(self)
+        self.timeline = timeline.StartupTimeline(self)
+        self.child_log_batcher = loggers.LogBatcher()
+        self.log_writer = None # AsyncLogWriter, with async_logging
+        self.stop_reports = [] # reports of the last tiered stops, oldest first
 
     def version(self, dummy):
         """Print version to stdout and exit(0).
@@ -523,9 +599,9 @@ class ServerOptions(Options):
         self.exit(0)
 
     def getLogger(self, filename, level, fmt, rotating=False, maxbytes=0,
-                  backups=0, stdout=False):
+                  backups=0, stdout=False, batcher=None):
         return loggers.getLogger(filename, level, fmt, rotating, maxbytes,
-                                 backups, stdout)
+                                 backups, stdout, batcher)
 
     def default_configfile(self, searchpaths):
         if os.getuid() == 0:
@@ -609,52 +685,352 @@ class ServerOptions(Options):
 
         self.identifier = section.identifier
 
+        self.child_log_batcher.interval = self.childlog_flush_interval
+        self.child_log_batcher.maxbytes = self.childlog_buffer_size
+
     def process_rh_defaults(self):
-        """Read in the default domain/node/waveform configurations."""
-        defaultsFile = os.path.join(self.defaults_dir, 'domain.defaults')
-        configDir = os.path.join(self.configroot.adminserviced.config_dir,
-                                 self.configroot.adminserviced.domains_dir)
-        if os.path.exists(defaultsFile):
-            parser = self.parse_rh_config(defaultsFile, configDir)
-            groups = self.process_groups_from_parser(parser, DomainConfig)
-            self.domain_configs = groups
-            self.process_group_configs.extend(groups)
-        else:
-            raise ValueError("could not find config file %s" % defaultsFile)
-
-        defaultsFile = os.path.join(self.defaults_dir, 'node.defaults')
-        configDir = os.path.join(self.configroot.adminserviced.config_dir,
-                                 self.configroot.adminserviced.nodes_dir)
-        if os.path.exists(defaultsFile):
-            parser = self.parse_rh_config(defaultsFile, configDir)
-            groups = self.process_groups_from_parser(parser, NodeConfig)
-            self.node_configs = groups
-            self.process_group_configs.extend(groups)
-        else:
-            raise ValueError("could not find config file %s" % defaultsFile)
-
-        defaultsFile = os.path.join(self.defaults_dir, 'waveform.defaults')
-        configDir = os.path.join(self.configroot.adminserviced.config_dir,
-                                 self.configroot.adminserviced.waveforms_dir)
-        if os.path.exists(defaultsFile):
-            parser = self.parse_rh_config(defaultsFile, configDir)
-            groups = self.process_groups_from_parser(parser, WaveformConfig)
-            self.waveform_configs = groups
-            self.process_group_configs.extend(groups)
-        else:
-            raise ValueError("could not find config file %s" % defaultsFile)
-        
+        """Read in the default domain/node/waveform configurations.
+
+        The three directories are read in three steps: scan_rh_configs
+        works out which of their files have to be parsed, parse_rh_files
+        parses those of all three at once, fanned out over worker
+        processes when there are enough of them, and finish_rh_configs
+        makes each directory's groups from its files."""
+        if not self.rh_config_cache and self.config_snapshot:
+            self.load_config_snapshot()
+
+        section = self.configroot.adminserviced
+        reads = []
+        for defaults, config_class, subdir in (
+            ('domain.defaults', DomainConfig, section.domains_dir),
+            ('node.defaults', NodeConfig, section.nodes_dir),
+            ('waveform.defaults', WaveformConfig, section.waveforms_dir)):
+            defaultsFile = os.path.join(self.defaults_dir, defaults)
+            if not os.path.exists(defaultsFile):
+                raise ValueError("could not find config file %s" % defaultsFile)
+            configDir = os.path.join(section.config_dir, subdir)
+            reads.append(self.scan_rh_configs(defaultsFile, configDir,
+                                              config_class))
+        self.parse_rh_files(reads)
+        self.domain_configs = self.finish_rh_configs(reads[0])
+        self.node_configs = self.finish_rh_configs(reads[1])
+        self.waveform_configs = self.finish_rh_configs(reads[2])
+
+        # a domain has a group in each directory; merge them into one
+        groups = self.process_group_configs + self.domain_configs
+        groups = groups + self.node_configs + self.waveform_configs
         groupMap = {}
-        for group in self.process_group_configs:
-            if not groupMap.has_key(group.name):
+        merged = {}
+        for group in groups:
+            existing = groupMap.get(group.name)
+            if existing is None:
                 groupMap[group.name] = group
             else:
-                existing = groupMap[group.name]
                 existing.process_configs.extend(group.process_configs)
-                existing.process_configs.sort()
+                merged[group.name] = existing
+        for group in merged.values():
+            group.process_configs.sort()
         self.process_group_configs = groupMap.values()
         self.process_group_configs.sort()
 
+        if self.config_snapshot:
+            self.save_config_snapshot()
+
+    def get_snapshot_key(self):
+        """ What a config snapshot has to have been made by to be used:
+        this version of adminservice, reading configs with the same code.
+        Whether the configs in it are still current is up to
+        read_rh_configs, as for configs it kept from an earlier read. """
+        modules = (sys.modules[__name__], configcache, datatypes)
+        return (VERSION, sys.version,
+                [ configcache.source_stamp(module) for module in modules ])
+
+    def load_config_snapshot(self):
+        """ Take the configs of the domain/node/waveform directories from
+        the config snapshot, if it was made from the same code and none of
+        the directories they name has gone since """
+        caches = configcache.load_snapshot(self.config_snapshot,
+                                           self.get_snapshot_key(), self)
+        if caches is None:
+            return
+        for cache in caches.values():
+            if not cache.dirs_exist():
+                return
+        self.rh_config_cache = caches
+        self.parse_infos.append('Loaded config snapshot %s'
+                                % self.config_snapshot)
+
+    def save_config_snapshot(self):
+        """ Write the configs of the domain/node/waveform directories to
+        the config snapshot if any of them had to be read again """
+        caches = self.rh_config_cache
+        dirty = [ cache for cache in caches.values() if cache.dirty ]
+        if not dirty:
+            return
+        for cache in dirty:
+            cache.dirty = False
+        try:
+            configcache.save_snapshot(self.config_snapshot,
+                                      self.get_snapshot_key(), caches, self,
+                                      (LaunchPlan,))
+        except (IOError, OSError, cPickle.PicklingError, TypeError), why:
+            for cache in dirty:
+                cache.dirty = True
+            self.parse_warnings.append('Could not write config snapshot %s: %s'
+                                       % (self.config_snapshot, why))
+
+    def scan_rh_configs(self, defaultsFile, configDir, config_class):
+        """ Start reading the *.ini files in configDir, with the defaults
+        in defaultsFile; return the DirectoryRead to finish it with.
+
+        What was made from each file is kept in a ConfigDirCache, so only
+        files that are new or have changed are parsed again and the
+        others keep their configs; those to parse are left in pending.  A
+        directory whose files can't be read one at a time (a file sets
+        [DEFAULT] values, sets the default section, has sections other
+        than domain/node/waveform ones or repeats another file's section)
+        is read as a whole with parse_rh_config whenever any of it
+        changes.
+        """
+        cache = self.rh_config_cache.get(configDir)
+        if cache is None:
+            cache = self.rh_config_cache[configDir] = configcache.ConfigDirCache()
+        read = configcache.DirectoryRead(defaultsFile, configDir, config_class,
+                                         cache)
+
+        try:
+            stamp, read.text, digest = configcache.read_file(defaultsFile)
+        except (IOError, OSError):
+            raise ValueError("could not read config file %s" % defaultsFile)
+        # ENV_SDRROOT is where a domain manager is found if it doesn't say
+        environ = self.environ_expansions
+        expansions = configcache.get_expansions(read.text, environ,
+                                                ['ENV_SDRROOT'])
+        read.basis = (digest, expansions, self.here, self.childlogdir,
+                      self.childpiddir)
+
+        pattern = os.path.join(configDir, "*.ini")
+        stamps = []
+        for filename in sorted(glob.glob(pattern)):
+            stamp = configcache.get_stamp(filename)
+            if stamp is not None:
+                read.infos.append(
+                    'Included extra file "%s" during parsing' % filename)
+                read.filenames.append(filename)
+                stamps.append(stamp)
+        if not read.filenames:
+            read.warnings.append('No file matches via include "%s"' % pattern)
+
+        # a directory read as a whole may use any environment expansion
+        expansions = environ.items()
+        expansions.sort()
+        read.snapshot = (read.basis, expansions, zip(read.filenames, stamps))
+        if cache.merged is not None and cache.merged[0] == read.snapshot:
+            read.groups = configcache.clone_groups(cache.merged[1])
+            return read
+
+        for filename, stamp in zip(read.filenames, stamps):
+            entry = cache.files.get(filename)
+            if entry is not None and entry.is_current(stamp, read.basis,
+                                                      environ):
+                read.entries[filename] = entry
+                continue
+            try:
+                stamp, data, digest = configcache.read_file(filename)
+            except (IOError, OSError):
+                continue # gone since the glob, parser.read() skips it too
+            read.reread = True
+            expansions = configcache.get_expansions(data, environ)
+            if (entry is not None and entry.basis == read.basis and
+                entry.digest == digest and entry.expansions == expansions):
+                entry.stamp = stamp
+                read.entries[filename] = entry
+                continue
+            read.pending.append((filename, stamp, digest, expansions, data))
+
+        if read.pending or cache.basis != read.basis:
+            read.defaults = self.parse_rh_defaults(read.text, configDir,
+                                                   config_class)
+            read.whole = read.defaults[0] is None
+        return read
+
+    def parse_rh_files(self, reads):
+        """ Parse the files pending in reads, DirectoryReads from
+        scan_rh_configs.  The files are parsed by worker processes when
+        there are enough of them for it to pay; any error is raised as a
+        ValueError naming the file. """
+        jobs = []
+        for read in reads:
+            if read.groups is None and not read.whole:
+                jobs.extend([ (read, item) for item in read.pending ])
+        if not jobs:
+            return
+
+        def parse(job):
+            read, item = job
+            filename, stamp, digest, expansions, data = item
+            first_warning = len(self.parse_warnings)
+            try:
+                made = self.parse_rh_file(filename, data, read.defaults,
+                                          read.config_class)
+            except ValueError, why:
+                return configcache.name_file(str(why), filename), None, []
+            found = self.parse_warnings[first_warning:]
+            del self.parse_warnings[first_warning:]
+            return None, made, found
+
+        def parse_apart(job):
+            # in a worker, whose options can't be sent back with the configs
+            error, made, found = parse(job)
+            if made is not None:
+                configcache.set_options(made[1], None)
+            return error, made, found
+
+        workers = self.count_config_workers(len(jobs))
+        if workers > 1:
+            results = configcache.parallel_map(parse_apart, jobs, workers)
+            for error, made, found in results:
+                if made is not None:
+                    configcache.set_options(made[1], self)
+        else:
+            results = map(parse, jobs)
+
+        for (read, item), (error, made, file_warnings) in zip(jobs, results):
+            if error is not None:
+                raise ValueError(error)
+            read.warnings.extend(file_warnings)
+            if made is None:
+                read.whole = True
+                continue
+            filename, stamp, digest, expansions, data = item
+            read.entries[filename] = configcache.IniFile(
+                filename, stamp, digest, read.basis, expansions,
+                made[0], made[1])
+            read.parsed += 1
+
+    def count_config_workers(self, files):
+        """ How many worker processes to parse files .ini files with; 1
+        to parse them in this process, which is always the case once
+        threads are running """
+        if configcache.threads_running():
+            return 1
+        workers = self.config_workers
+        if not workers:
+            workers = configcache.cpu_count()
+        return max(1, min(workers, files // configcache.FILES_PER_WORKER))
+
+    def finish_rh_configs(self, read):
+        """ Return the groups configured by the directory of read, a
+        DirectoryRead that parse_rh_files is done with """
+        cache = read.cache
+        if read.groups is not None:
+            # nothing changed since the directory was read as a whole
+            self.parse_infos.extend(read.infos)
+            self.parse_warnings.extend(read.warnings)
+            return read.groups
+
+        files = {}
+        sections = {}
+        for filename in read.filenames:
+            if read.whole:
+                break
+            entry = read.entries.get(filename)
+            if entry is None:
+                continue # gone since the glob
+            for section in entry.sections:
+                if sections.has_key(section):
+                    read.whole = True
+                sections[section] = filename
+            files[filename] = entry
+
+        if read.whole:
+            # read the directory as a whole; parse_rh_config notes the
+            # files it includes itself
+            parser = self.parse_rh_config(read.defaults_file, read.config_dir)
+            groups = self.process_groups_from_parser(parser, read.config_class)
+            cache.files = {}
+            cache.basis = None
+            cache.merged = (read.snapshot, groups)
+            cache.dirty = True
+            return configcache.clone_groups(groups)
+
+        self.parse_infos.extend(read.infos)
+        self.parse_warnings.extend(read.warnings)
+        if (read.reread or cache.basis != read.basis or
+            cache.merged is not None or len(files) != len(cache.files)):
+            cache.dirty = True
+        cache.files = files
+        cache.basis = read.basis
+        cache.merged = None
+        self.parse_infos.append('Parsed %d of %d files in %s'
+                                % (read.parsed, len(read.filenames),
+                                   read.config_dir))
+        groups = []
+        for filename in read.filenames:
+            if files.has_key(filename):
+                groups.extend(files[filename].groups)
+        return configcache.clone_groups(groups)
+
+    def parse_rh_defaults(self, text, configDir, config_class):
+        """ Parse a domain/node/waveform defaults file; return (parser,
+        default config), or (None, None) if it has sections besides the
+        default one and the directory must be read as a whole """
+        parser = UnhosedConfigParser()
+        parser.expansions = self.environ_expansions
+        try:
+            parser.read_string(text)
+        except ConfigParser.ParsingError, why:
+            raise ValueError(str(why))
+        if not parser.sections():
+            return None, None
+        for section in parser.sections():
+            split = configcache.split_rh_section(section)
+            if split is None or split[1] != 'default':
+                return None, None
+        # every file of the directory would expand %(here)s to this
+        parser.expand_here(os.path.abspath(configDir))
+        return parser, self.rh_default_config(parser, config_class)
+
+    def parse_rh_file(self, filename, data, defaults, config_class):
+        """ Make the group configs of one .ini file; return (its sections,
+        the groups), or None if it can't be read apart from the rest of
+        its directory """
+        defaults_parser, default_config = defaults
+        parser = UnhosedConfigParser()
+        parser.expansions = self.environ_expansions
+        for key, value in defaults_parser.defaults().items():
+            parser.set(ConfigParser.DEFAULTSECT, key, value)
+        try:
+            parser.readfp(StringIO(data), filename)
+        except ConfigParser.ParsingError, why:
+            raise ValueError(str(why))
+        if parser.defaults() != defaults_parser.defaults():
+            return None
+        sections = parser.sections()
+        for section in sections:
+            split = configcache.split_rh_section(section)
+            if split is None or split[1] == 'default':
+                return None
+            parser.section_to_file[section] = filename
+        parser.expand_here(os.path.abspath(os.path.dirname(filename)))
+        groups = self.process_groups_from_parser(parser, config_class,
+                                                 default_config)
+        return sections, groups
+
+    def rh_default_config(self, parser, config_class):
+        """ The config made from the domain/node/waveform default sections
+        of parser, or None if it has none """
+        default_config = None
+        for section in parser.sections():
+            split = configcache.split_rh_section(section)
+            if split is None or split[1] != 'default':
+                continue
+            processes = self.processes_from_section(parser, section, 'default',
+                                                    config_class, True,
+                                                    default_config)
+            default_config = processes[0]
+        return default_config
+
     def parse_rh_config(self, fp, config_dir):
         need_close = False
         if not hasattr(fp, 'read'):
@@ -798,6 +1174,29 @@ class ServerOptions(Options):
         section.childpiddir = existing_directory(get('childpiddir', '/var/run/redhawk'))
         section.nocleanup = boolean(get('nocleanup', 'false'))
         section.strip_ansi = boolean(get('strip_ansi', 'false'))
+        section.script_pool_size = integer(get('script_pool_size', 4))
+        section.script_timeout = integer(get('script_timeout', 60))
+        section.script_cache_ttl = integer(get('script_cache_ttl', 1))
+        section.subreaper = boolean(get('subreaper', 'false'))
+        section.watchdog_threshold = integer(get('watchdog_threshold', 0))
+        section.dependency_startup = boolean(get('dependency_startup', 'false'))
+        section.startup_parallelism = integer(get('startup_parallelism', 8))
+        section.spawn_max_starting = integer(get('spawn_max_starting', 0))
+        section.spawn_max_rate = integer(get('spawn_max_rate', 0))
+        section.spawn_max_load = float(get('spawn_max_load', 0))
+        section.spawn_min_memory = byte_size(get('spawn_min_memory', '0'))
+        section.shell_launch = boolean(get('shell_launch', 'false'))
+        section.config_snapshot = snapshot_name(get('config_snapshot', ''))
+        section.config_workers = integer(get('config_workers', 0))
+        section.config_watch = config_watch_mode(get('config_watch', 'false'))
+        section.config_watch_delay = float(get('config_watch_delay', 1))
+        section.childlog_flush_interval = float(
+            get('childlog_flush_interval', 0))
+        section.childlog_buffer_size = byte_size(
+            get('childlog_buffer_size', '1MB'))
+        section.async_logging = async_logging_policy(
+            get('async_logging', 'off'))
+        section.async_log_queue = integer(get('async_log_queue', 10000))
 
         environ_str = get('environment', '')
         environ_str = expand(environ_str, expansions, 'environment')
@@ -831,7 +1230,8 @@ class ServerOptions(Options):
         section.profile_options = None
         return section
 
-    def process_groups_from_parser(self, parser, config_class=None):
+    def process_groups_from_parser(self, parser, config_class=None,
+                                   default_config=None):
         groups = []
         all_sections = parser.sections()
         homogeneous_exclude = []
@@ -879,7 +1279,6 @@ class ServerOptions(Options):
             groups.append(ProcessGroupConfig(self, config_name, priority, enabled, processes))
 
         # process REDHAWK specific items
-        default_config = None
         groupMap = {}
         for section in all_sections:
             sect_type = section.split(':', 1)[0]
@@ -1109,6 +1508,12 @@ class ServerOptions(Options):
         started_status_script = get(section, 'started_status_script', None if default_klass is None else default_klass.started_status_script)
         status_script = get(section, 'status_script', None if default_klass is None else default_klass.status_script)
         query_script = get(section, 'query_script', None if default_klass is None else default_klass.query_script)
+        script_timeout = get(section, 'script_timeout', None if default_klass is None else default_klass.script_timeout)
+        if script_timeout is not None:
+            script_timeout = integer(script_timeout)
+        depends_on = get(section, 'depends_on', None if default_klass is None else default_klass.depends_on)
+        if isinstance(depends_on, basestring):
+            depends_on = list_of_strings(depends_on)
         stop_pre_script = get(section, 'stop_pre_script', None if default_klass is None else default_klass.stop_pre_script)
         stop_post_script = get(section, 'stop_post_script', None if default_klass is None else default_klass.stop_post_script)
         start_cmd_option = get(section, 'start_cmd_option', None if default_klass is None else default_klass.start_cmd_option)
@@ -1259,6 +1664,8 @@ class ServerOptions(Options):
             started_status_script=started_status_script,
             status_script=status_script,
             query_script=query_script,
+            script_timeout=script_timeout,
+            depends_on=depends_on,
             stop_pre_script=stop_pre_script,
             stop_post_script=stop_post_script,
             start_cmd_option=start_cmd_option,
@@ -1313,6 +1720,10 @@ class ServerOptions(Options):
             except:
                 pass
 
+        if not defaults:
+            pconfig.check_command()
+        pconfig.get_fingerprint()
+
         return [pconfig]
 
     def getEnableValue(self, section, get, defaultValue):
@@ -1491,6 +1902,8 @@ class ServerOptions(Options):
                     self._try_unlink(socketname)
         if self.unlink_pidfile:
             self._try_unlink(self.pidfile)
+        self.signal_receiver.close_wakeup()
+        self.detached_monitor.close()
         self.poller.close()
 
     def _try_unlink(self, path):
@@ -1523,7 +1936,21 @@ class ServerOptions(Options):
             server.close()
 
     def close_logger(self):
+        writer = self.log_writer
+        if writer is not None and writer.dropped:
+            self.logger.warn('dropped %d of %d log records queued for the '
+                             'log writer thread' % (writer.dropped,
+                                                    writer.queued))
         self.logger.close()
+        if writer is not None:
+            # writes what's queued for the child logs too
+            writer.stop()
+
+    def start_log_writer(self):
+        """ Start writing the logs on a thread, with async_logging; threads
+        don't survive daemonizing, so not before then """
+        if self.log_writer is not None:
+            self.log_writer.start()
 
     def setsignals(self):
         receive = self.signal_receiver.receive
@@ -1533,10 +1960,17 @@ class ServerOptions(Options):
         signal.signal(signal.SIGHUP, receive)
         signal.signal(signal.SIGCHLD, receive)
         signal.signal(signal.SIGUSR2, receive)
+        self.signal_receiver.open_wakeup()
 
     def get_signal(self):
         return self.signal_receiver.get_signal()
 
+    def get_signals(self):
+        return self.signal_receiver.get_signals()
+
+    def get_signal_map(self):
+        return self.signal_receiver.get_wakeup_map()
+
     def openhttpservers(self, adminserviced):
         try:
             self.httpservers = self.make_http_servers(adminserviced)
@@ -1587,14 +2021,32 @@ class ServerOptions(Options):
     def get_socket_map(self):
         return asyncore.socket_map
 
+    def make_subreaper(self):
+        """ Become a child subreaper (Linux 3.4 and later), so the programs
+        that run_detached launchers daemonize are reparented to us instead
+        of to init and can be reaped with their real exit status.  Must be
+        called after daemonizing; it isn't inherited by fork. """
+        if not self.subreaper:
+            return
+        PR_SET_CHILD_SUBREAPER = 36
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+                code = ctypes.get_errno()
+                raise OSError(code, os.strerror(code))
+        except (ImportError, OSError, AttributeError), why:
+            self.logger.warn('unable to become a child subreaper, detached '
+                             'programs will be polled: %s' % (why,))
+            return
+        self.is_subreaper = True
+        self.logger.info('running as a child subreaper')
+
     def cleanup_fds(self):
         # try to close any leaked file descriptors (for reload)
         start = 5
-        for x in range(start, self.minfds):
-            try:
-                os.close(x)
-            except OSError:
-                pass
+        launch.close_fds(start, self.minfds)
 
     def kill(self, pid, signal):
         os.kill(pid, signal)
@@ -1769,6 +2221,10 @@ class ServerOptions(Options):
     def make_logger(self):
         # must be called after realize() and after adminservice does setuid()
         format =  '%(asctime)s %(levelname)s %(message)s\n'
+        if self.async_logging is not None and self.log_writer is None:
+            self.log_writer = loggers.AsyncLogWriter(self.async_log_queue,
+                                                     self.async_logging)
+            self.child_log_batcher.writer = self.log_writer
         self.logger = loggers.getLogger(
             self.logfile,
             self.loglevel,
@@ -1777,6 +2233,7 @@ class ServerOptions(Options):
             maxbytes=self.logfile_maxbytes,
             backups=self.logfile_backups,
             stdout = self.nodaemon,
+            writer = self.log_writer,
             )
         for msg in self.parse_criticals:
             self.logger.critical(msg)
@@ -1797,10 +2254,22 @@ class ServerOptions(Options):
         except OSError, e:
             pass
 
+    def close_fds(self, low):
+        """ Close every descriptor from low up in a forked child """
+        launch.close_fds(low, self.minfds)
+
     def fork(self):
-        return os.fork()
+        pid = os.fork()
+        if pid == 0:
+            self.signal_receiver.close_wakeup()
+        return pid
 
     def dup2(self, frm, to):
+        if frm == to:
+            # dup2() leaves it alone, close-on-exec and all
+            flags = fcntl.fcntl(to, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC
+            fcntl.fcntl(to, fcntl.F_SETFD, flags)
+            return to
         return os.dup2(frm, to)
 
     def setpgrp(self):
@@ -1886,8 +2355,9 @@ class ServerOptions(Options):
     def make_pipes(self, stderr=True):
         """ Create pipes for parent to child stdin/stdout/stderr
         communications.  Open fd in nonblocking mode so we can read them
-        in the mainloop without blocking.  If stderr is False, don't
-        create a pipe for stderr. """
+        in the mainloop without blocking.  Every fd is close-on-exec, so
+        only the child they're dup2()ed into keeps them.  If stderr is
+        False, don't create a pipe for stderr. """
 
         pipes = {'child_stdin':None,
                  'stdin':None,
@@ -1907,6 +2377,9 @@ class ServerOptions(Options):
                 if fd is not None:
                     flags = fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NDELAY
                     fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+            for fd in pipes.values():
+                if fd is not None:
+                    launch.set_cloexec(fd)
             return pipes
         #TODO - this is commented out... remove?
         #except (OSError,IOError):
@@ -1916,6 +2389,22 @@ class ServerOptions(Options):
                     self.close_fd(fd)
             raise
 
+    def dispatchers_changed(self):
+        """ Called when process, pidfd or inotify dispatchers are created
+        or dropped, so the main loop knows to rebuild its map of them """
+        self.dispatcher_serial += 1
+
+    def interest_changed(self, dispatcher):
+        """ Called when what dispatcher's readable() or writable() returns
+        may have changed, so the main loop asks it again before it polls """
+        self.interest_changes[id(dispatcher)] = dispatcher
+
+    def get_interest_changes(self):
+        """ Return the dispatchers interest_changed() was called for since
+        the last call """
+        changes, self.interest_changes = self.interest_changes, {}
+        return changes.values()
+
     def close_parent_pipes(self, pipes):
         for fdname in ('stdin', 'stdout', 'stderr'):
             fd = pipes.get(fdname)
@@ -2133,6 +2622,41 @@ class Config(object):
         return '<%s instance at %s named %s>' % (self.__class__, id(self),
                                                  self.name)
 
+class LaunchPlan(object):
+    """ Everything spawn() needs to start a process, worked out once when
+    its config is loaded: the start command, the executable it resolves
+    to and the argv to run it with, what is added to the environment, the
+    directory and umask to start in and, for run_detached programs, the
+    NativeLaunch that applies the nice/ulimit/affinity/cgroup limits.
+
+    A plan isn't changed once it's made.  Its config makes a new one if
+    the executable's stat() no longer matches signature; if the command
+    can't be run, error is the ProcessException spawn() reports. """
+
+    def __init__(self, command, filename, argv, environment, directory,
+                 umask, native, native_error, signature, error):
+        self.__dict__.update(command=command,
+                             filename=filename,
+                             argv=tuple(argv),
+                             environment=environment,
+                             directory=directory,
+                             umask=umask,
+                             native=native,
+                             native_error=native_error,
+                             signature=signature,
+                             error=error,
+                             )
+
+    def __setattr__(self, name, value):
+        raise AttributeError('a LaunchPlan is not changed once made')
+
+def stat_signature(st):
+    """ What about a file has to stay the same for a LaunchPlan that
+    resolved to it to be used again """
+    if st is None:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_mode)
+
 class ProcessConfig(Config):
     config_type = 'process'
     req_param_names = [
@@ -2152,10 +2676,14 @@ class ProcessConfig(Config):
         'environment', 'conditional_config', 'serverurl', 'waitforprevious', 'failafterwait',
         'nicelevel', 'affinity', 'ulimit', 'corefiles', 'cgroup', 'permissions_start_only',
         'start_pre_script', 'start_post_script', 'stop_pre_script', 'stop_post_script',
-        'started_status_script', 'status_script', 'query_script',
+        'started_status_script', 'status_script', 'query_script', 'script_timeout',
+        'depends_on',
         'start_cmd_option', 'status_cmd_option', 'stop_cmd_option',
         ]
 
+    launch_plan = None # LaunchPlan made by load_launch_plan()
+    fingerprint = None # taken by get_fingerprint() when the config is read
+
     def __init__(self, options, defaults, **params):
         self.options = options
         self.alive = False
@@ -2173,13 +2701,21 @@ class ProcessConfig(Config):
         if not isinstance(other, ProcessConfig):
             return False
 
-        for name in self.req_param_names + self.optional_param_names:
-            if Automatic in [getattr(self, name), getattr(other, name)] :
-                continue
-            if getattr(self, name) != getattr(other, name):
-                return False
-
-        return True
+        return self.get_fingerprint() == other.get_fingerprint()
+
+    def get_fingerprint(self):
+        """ A hash of every parameter the process is run with.  Configs
+        with the same fingerprint start the same program the same way, so
+        a reload leaves a process whose fingerprint hasn't changed alone.
+        It's taken as the config is read, before create_autochildlogs()
+        fills in the Automatic log files, and kept from then on. """
+        if self.fingerprint is None:
+            names = self.req_param_names + self.optional_param_names
+            names = names + getattr(self, 'add_req_param_names', [])
+            params = [ (name, getattr(self, name, None)) for name in names ]
+            self.fingerprint = configcache.fingerprint(self.config_type,
+                                                       params)
+        return self.fingerprint
 
     def create_autochildlogs(self):
         # temporary logfiles which are erased at start time
@@ -2204,6 +2740,109 @@ class ProcessConfig(Config):
             redirect = "%s 2>> %s" % (redirect, self.stderr_logfile)
         self.output_redirect = redirect
 
+    def check_command(self):
+        """ Raise ValueError if the command can't be split into arguments,
+        so it's reported when the config is read rather than at start """
+        if self.command is None:
+            return
+        for cmd in (self.command, self.start_cmd_option):
+            if cmd is None:
+                continue
+            try:
+                args = shlex.split(cmd)
+            except ValueError, why:
+                raise ValueError("can't parse %r: %s" % (cmd, why))
+            if cmd is self.command and not args:
+                raise ValueError('command is empty')
+
+    def make_launch_plan(self):
+        """ Work out a new LaunchPlan from the config as it is now """
+        options = self.options
+        native, native_error = self.make_native_launch()
+        cmd = self.get_start_command(native)
+
+        environment = {'ADMINSERVICE_ENABLED': '1',
+                       'ADMINSERVICE_PROCESS_NAME': self.name,
+                       }
+        serverurl = self.serverurl
+        if serverurl is None: # unset
+            serverurl = options.serverurl # might still be None
+        if serverurl:
+            environment['ADMINSERVICE_SERVER_URL'] = serverurl
+        if self.environment is not None:
+            environment.update(self.environment)
+
+        filename = None
+        argv = ()
+        st = None
+        error = None
+        try:
+            try:
+                argv = shlex.split(cmd)
+            except ValueError, why:
+                raise BadCommand("can't parse command %r: %s" % (cmd, why))
+            if not argv:
+                raise BadCommand("command is empty")
+
+            program = argv[0]
+            if "/" in program:
+                filename = program
+                try:
+                    st = options.stat(filename)
+                except OSError:
+                    st = None
+            else:
+                filename = program
+                for dir in options.get_path():
+                    found = os.path.join(dir, program)
+                    try:
+                        st = options.stat(found)
+                    except OSError:
+                        pass
+                    else:
+                        filename = found
+                        break
+
+            options.check_execv_args(filename, argv, st)
+        except ProcessException, why:
+            error = why
+
+        return LaunchPlan(cmd, filename, argv, environment, self.directory,
+                          self.umask, native, native_error,
+                          stat_signature(st), error)
+
+    def load_launch_plan(self):
+        """ Make the LaunchPlan as the config is loaded; a command that
+        can't be run is warned about now, not just when it's started """
+        plan = self.launch_plan = self.make_launch_plan()
+        logger = self.options.logger
+        logger.debug("%s start command is: %s" % (self.name, plan.command))
+        if plan.native_error is not None:
+            logger.debug("%s is started through the shell: %s"
+                         % (self.name, plan.native_error))
+        if plan.error is not None:
+            logger.warn("%s can't be started: %s"
+                        % (self.name, plan.error.args[0]))
+        return plan
+
+    def get_launch_plan(self):
+        """ The LaunchPlan to spawn with.  It's only made again if the
+        executable it resolved to has changed, or couldn't be run. """
+        plan = self.launch_plan
+        if plan is None:
+            return self.load_launch_plan()
+        if plan.error is None:
+            try:
+                st = self.options.stat(plan.filename)
+            except OSError:
+                st = None
+            if stat_signature(st) == plan.signature:
+                return plan
+            self.options.logger.info('%s changed, making a new launch plan '
+                                     'for %s' % (plan.filename, self.name))
+        plan = self.launch_plan = self.make_launch_plan()
+        return plan
+
     def make_process(self, group=None):
         from adminservice.process import Subprocess
         process = Subprocess(self)
@@ -2232,11 +2871,9 @@ class ProcessConfig(Config):
         if self.enable is True or self.enable is False:
             return self.enable
         if self.conditional_config is not None:
-            # read in the config file
-            enablement = readFile(self.conditional_config, 0, 0)
-            # We read in the entire file with \n's, re.MULTILINE allows ^$ to match the \n line instead of the whole string
-            groups = re.search(self.enable, enablement, re.MULTILINE)
-            return groups is not None
+            # the file is shared by many processes; it's read once and only
+            # reread by the main loop when it changes
+            return self.options.conditional_configs.is_enabled(self.conditional_config, self.enable)
 
     def get_pid(self):
         pid = -1
@@ -2248,13 +2885,13 @@ class ProcessConfig(Config):
                 pass
         return pid
 
-    def get_start_command(self):
+    def get_start_command(self, native=None):
         cmd = self.command
         if self.run_detached:
             pre_script = ''
             if self.start_pre_script is not None:
                 script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.start_pre_script) else '.', self.start_pre_script)
-                pre_script = ("%s %s;" % (script, self.output_redirect))
+                pre_script = ("%s %s; %s" % (script, self.output_redirect, PRE_SCRIPT_DONE))
 
             post_script = ''
             if self.start_post_script is not None:
@@ -2269,6 +2906,12 @@ class ProcessConfig(Config):
     def get_stop_command(self):
         return None
 
+    def make_native_launch(self):
+        """ Return (NativeLaunch, None) to start a run_detached program
+        without a shell, or (None, why not) to run get_start_command
+        through the shell; why not is None if nothing asked for it """
+        return None, None
+
     def is_started(self):
         if self.started_status_script is not None:
             cmd = "%s %s" % (self.started_status_script, '' if self.pid_file is None else self.pid_file)
@@ -2276,9 +2919,42 @@ class ProcessConfig(Config):
         else:
             return self.check_status()
 
-    def check_status(self):
+    def get_status_command(self):
+        """ The command that checks if the process is running, or None if
+        the pid file is checked directly """
         if self.status_script is not None:
-            cmd = "%s %s" % (self.status_script, '' if self.pid_file is None else self.pid_file)
+            return "%s %s" % (self.status_script, '' if self.pid_file is None else self.pid_file)
+        return None
+
+    def get_script_key(self, kind):
+        """ Key for this process' results in the ScriptRunner """
+        return (kind, self.name, self.pid_file)
+
+    def invalidate_status(self):
+        """ Forget any cached status for this process, e.g. after it was
+        started or stopped """
+        self.options.script_runner.invalidate(self.get_script_key('status'))
+
+    def check_status_async(self, callback):
+        """ Like check_status, but a status command is run by the
+        ScriptRunner so the main loop isn't blocked.  callback is called
+        with True or False once the status is known, possibly right away.
+        """
+        cmd = self.get_status_command()
+        if cmd is None:
+            callback(self.check_status())
+            return
+
+        def onstatus(job):
+            self.alive = job.ok()
+            callback(self.alive)
+
+        self.options.script_runner.run(self.get_script_key('status'), cmd,
+                                       onstatus, timeout=self.script_timeout)
+
+    def check_status(self):
+        cmd = self.get_status_command()
+        if cmd is not None:
             return os.system(cmd) == 0
 
         try:
@@ -2389,6 +3065,12 @@ class RedhawkProcessConfig(ProcessConfig):
         if hasattr(self, 'waitforprevious') and self.waitforprevious is not None:
             self.waitforprevious = integer(self.waitforprevious)
 
+        if hasattr(self, 'script_timeout') and self.script_timeout is not None:
+            self.script_timeout = integer(self.script_timeout)
+
+        if isinstance(getattr(self, 'depends_on', None), basestring):
+            self.depends_on = list_of_strings(self.depends_on)
+
         for name in self.env_param_names:
             val = getattr(self, name, None)
             if val is not None:
@@ -2436,10 +3118,58 @@ class RedhawkProcessConfig(ProcessConfig):
             redirect = "%s 2>> %s" % (redirect, self.stderr_logfile)
         self.output_redirect = redirect
 
-    def get_start_command(self, addPid=True):
+    def make_native_launch(self, addPid=True):
+        """ Return (NativeLaunch, None), the launcher that applies cgroup,
+        nicelevel, ulimit, corefiles and affinity itself and execs the
+        program without the shell chain, or (None, why not) if the shell
+        chain is needed """
+        if not self.run_detached or self.options.shell_launch:
+            return None, None
+        try:
+            launch.check_command(self.command)
+            if self.start_cmd_option is not None:
+                launch.check_command(self.start_cmd_option)
+            settings = launch.LaunchSettings(self.nicelevel, self.ulimit,
+                                             self.corefiles, self.affinity,
+                                             self.cgroup)
+        except launch.NotNative, why:
+            return None, str(why)
+
+        if hasattr(self, 'logfile'):
+            stdout_file = self.logfile
+        else:
+            stdout_file = self.stdout_logfile
+        # a log file of NONE discards the output
+        stdout_file = stdout_file or os.devnull
+        stderr_file = None
+        if not self.redirect_stderr:
+            stderr_file = self.stderr_logfile or os.devnull
+
+        pre_script = None
+        if self.start_pre_script is not None:
+            script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.start_pre_script) else '.', self.start_pre_script)
+            pre_script = "%s %s; %s" % (script, self.output_redirect, PRE_SCRIPT_DONE)
+
+        post_script = None
+        if self.start_post_script is not None:
+            script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.start_post_script) else '.', self.start_post_script)
+            post_script = "%s %s" % (script, self.output_redirect)
+
+        native = launch.NativeLaunch(settings, stdout_file, stderr_file,
+                                     addPid and self.pid_file or None,
+                                     pre_script, post_script,
+                                     self.options.minfds)
+        return native, None
+
+    def get_start_command(self, native=None, addPid=True):
+        """ The command that starts the program: the shell chain, or what
+        native, the config's NativeLaunch if it has one, runs """
         cmd = self.command
 
-        if self.run_detached:
+        if self.run_detached and native is not None:
+            # the launcher applies the settings and runs the program itself
+            cmd = "%s %s" % (cmd, self.start_cmd_option or '')
+        elif self.run_detached:
             cgroup = ("cgexec " + self.cgroup) if self.cgroup is not None else ''
 
             nice = ("/bin/nice " + self.nicelevel) if self.nicelevel is not None else ''
@@ -2457,7 +3187,7 @@ class RedhawkProcessConfig(ProcessConfig):
             pre_script = ''
             if self.start_pre_script is not None:
                 script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.start_pre_script) else '.', self.start_pre_script)
-                pre_script = ("%s %s;" % (script, self.output_redirect))
+                pre_script = ("%s %s; %s" % (script, self.output_redirect, PRE_SCRIPT_DONE))
 
             post_script = ''
             if self.start_post_script is not None:
@@ -2468,7 +3198,6 @@ class RedhawkProcessConfig(ProcessConfig):
             
             cmd = "%s %s /bin/bash -c '%s %s %s %s %s %s & %s %s'" % (cgroup, nice, ulimit, pre_script, numactl, cmd, start_cmd_option, self.output_redirect, pid, post_script)
 
-        self.options.logger.blather("%s start command is:\n%s" % (self.name, cmd))
         return cmd
 
 class DomainConfig(RedhawkProcessConfig):
@@ -2601,22 +3330,25 @@ class WaveformConfig(RedhawkProcessConfig):
             if self.start_delay is not None:
                 self.command = self.command + " --delay=" + self.start_delay
 
-    def get_start_command(self, addPid=True):
-        return RedhawkProcessConfig.get_start_command(self, False)
+    def get_start_command(self, native=None, addPid=True):
+        return RedhawkProcessConfig.get_start_command(self, native, False)
+
+    def make_native_launch(self, addPid=True):
+        # the waveform writes its own pid file
+        return RedhawkProcessConfig.make_native_launch(self, False)
 
     def get_stop_command(self):
         remove_command = readFile(self.pid_file, 0, 0).strip()
         return "%s %s" % (remove_command, self.stop_cmd_option)
 
-    def check_status(self):
+    def get_status_command(self):
         if self.status_script is not None:
-            cmd = "%s %s" % (self.status_script, self.pid_file)
-            return os.system(cmd) == 0
+            return "%s %s" % (self.status_script, self.pid_file)
 
         if self.pid_file is not None and os.path.exists(self.pid_file):
             status_command = readFile(self.pid_file, 0, 0).strip()
-            return os.system("%s --quiet %s" % (status_command, self.status_cmd_option)) == 0
-        return False
+            return "%s --quiet %s" % (status_command, self.status_cmd_option)
+        return None
 
 class EventListenerConfig(ProcessConfig):
     config_type = 'event'
@@ -2690,6 +3422,7 @@ class ProcessGroupConfig(Config):
     def after_setuid(self):
         for config in self.process_configs:
             config.create_autochildlogs()
+            config.load_launch_plan()
 
     def make_group(self):
         from adminservice.process import ProcessGroup
@@ -2725,6 +3458,7 @@ class EventListenerPoolConfig(Config):
     def after_setuid(self):
         for config in self.process_configs:
             config.create_autochildlogs()
+            config.load_launch_plan()
 
     def make_group(self):
         from adminservice.process import EventListenerPool
@@ -2883,6 +3617,8 @@ def _init_signames():
 class SignalReceiver:
     def __init__(self):
         self._signals_recvd = []
+        self._wakeup_fds = None # (read fd, write fd) of the wakeup pipe
+        self._wakeup_map = {} # read fd -> SignalWakeupDispatcher
 
     def receive(self, sig, frame):
         if sig not in self._signals_recvd:
@@ -2895,6 +3631,75 @@ class SignalReceiver:
             sig = None
         return sig
 
+    def get_signals(self):
+        """ Return every signal received since the last call """
+        sigs, self._signals_recvd = self._signals_recvd, []
+        return sigs
+
+    def open_wakeup(self):
+        """ Have the C signal handler write a byte to a pipe the main loop
+        polls, so a signal ends the poll at once instead of being noticed
+        when the poll times out """
+        if self._wakeup_fds is not None:
+            return
+        fds = os.pipe()
+        for fd in fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NDELAY
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+        signal.set_wakeup_fd(fds[1])
+        self._wakeup_fds = fds
+        self._wakeup_map = {fds[0]: SignalWakeupDispatcher(fds[0])}
+
+    def close_wakeup(self):
+        """ Stop writing to the wakeup pipe and close it.  Forked children
+        call this too, so they don't write into a descriptor that has been
+        closed and reused by the time a signal arrives. """
+        if self._wakeup_fds is None:
+            return
+        signal.set_wakeup_fd(-1)
+        for fd in self._wakeup_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._wakeup_fds = None
+        self._wakeup_map = {}
+
+    def get_wakeup_map(self):
+        """ The dispatcher map for the wakeup pipe, for the main loop """
+        return self._wakeup_map
+
+class SignalWakeupDispatcher:
+    """ Main loop dispatcher for the read end of the signal wakeup pipe.
+    Reading just empties the pipe; the signals themselves are queued by
+    SignalReceiver.receive and handled after the poll. """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __repr__(self):
+        return '<%s at %s for fd %s>' % (self.__class__.__name__, id(self),
+                                         self.fd)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            while os.read(self.fd, 512):
+                pass
+        except OSError, why:
+            if why.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def handle_error(self):
+        pass
+
 # miscellaneous utility functions
 
 def expand(s, expansions, name):
@@ -25,6 +25,19 @@ class BasePoller:
     def poll(self, timeout):
         raise NotImplementedError
 
+    def forget(self, fd):
+        """ Drop all interest in fd; it was closed or now belongs to a
+        different dispatcher """
+        raise NotImplementedError
+
+    def set_interest(self, fd, readable, writable):
+        """ Register exactly the given interest in fd """
+        self.forget(fd)
+        if readable:
+            self.register_readable(fd)
+        if writable:
+            self.register_writable(fd)
+
     def before_daemonize(self):
         pass
 
@@ -56,6 +69,10 @@ class SelectPoller(BasePoller):
     def unregister_all(self):
         self._init_fdsets()
 
+    def forget(self, fd):
+        self.readables.discard(fd)
+        self.writables.discard(fd)
+
     def poll(self, timeout):
         try:
             r, w, x = self._select.select(
@@ -107,6 +124,15 @@ class PollPoller(BasePoller):
         if fd in self.readables:
             self._poller.register(fd, self.READ)
 
+    def forget(self, fd):
+        if fd in self.readables or fd in self.writables:
+            self.readables.discard(fd)
+            self.writables.discard(fd)
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
     def poll(self, timeout):
         fds = self._poll_fds(timeout)
         readables, writables = [], []
@@ -176,6 +202,12 @@ class KQueuePoller(BasePoller):
         self.writables.discard(fd)
         self._kqueue_control(fd, kevent)
 
+    def forget(self, fd):
+        if fd in self.readables:
+            self.unregister_readable(fd)
+        if fd in self.writables:
+            self.unregister_writable(fd)
+
     def _kqueue_control(self, fd, kevent):
         try:
             self._kqueue.control([kevent], 0)
@@ -219,13 +251,149 @@ class KQueuePoller(BasePoller):
         self._kqueue.close()
         self._kqueue = None
 
+class EpollPoller(BasePoller):
+    '''
+    Wrapper for select.epoll()
+
+    Registrations persist in the kernel from one poll() to the next, and
+    the registered event mask of every fd is remembered so registering
+    interest that is already registered doesn't make a system call.  The
+    kernel is only told about new fds, closed fds and interest changes.
+
+    The epoll fd is only opened when it's first needed, so it's opened
+    after a restart's cleanup_fds() has closed the fds left over from
+    the last run, not before.
+    '''
+
+    def initialize(self):
+        self._epoll = None # opened by _get_epoll()
+        self.READ = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP
+        self.WRITE = select.EPOLLOUT
+        self.masks = {} # fd -> event mask registered with the kernel
+
+    def register_readable(self, fd):
+        self._update(fd, self.masks.get(fd, 0) | self.READ)
+
+    def register_writable(self, fd):
+        self._update(fd, self.masks.get(fd, 0) | self.WRITE)
+
+    def unregister_readable(self, fd):
+        self._update(fd, self.masks.get(fd, 0) & ~self.READ)
+
+    def unregister_writable(self, fd):
+        self._update(fd, self.masks.get(fd, 0) & ~self.WRITE)
+
+    def forget(self, fd):
+        self._update(fd, 0)
+
+    def set_interest(self, fd, readable, writable):
+        mask = 0
+        if readable:
+            mask = mask | self.READ
+        if writable:
+            mask = mask | self.WRITE
+        self._update(fd, mask)
+
+    def _get_epoll(self):
+        if self._epoll is None:
+            self._epoll = select.epoll()
+        return self._epoll
+
+    def _update(self, fd, mask):
+        old = self.masks.get(fd, 0)
+        if mask == old:
+            return
+        try:
+            if not mask:
+                del self.masks[fd]
+                self._get_epoll().unregister(fd)
+            elif not old:
+                self.masks[fd] = mask
+                self._epoll_register(fd, mask)
+            else:
+                self.masks[fd] = mask
+                self._epoll_modify(fd, mask)
+        except (IOError, OSError), error:
+            if error.errno in (errno.EBADF, errno.ENOENT):
+                # the fd was closed behind our back, the kernel has already
+                # dropped it
+                self.options.logger.blather('%s encountered in epoll for '
+                                            'fd %s' % (errno.errorcode[error.errno], fd))
+            else:
+                raise
+
+    def _epoll_register(self, fd, mask):
+        try:
+            self._get_epoll().register(fd, mask)
+        except (IOError, OSError), error:
+            if error.errno != errno.EEXIST:
+                raise
+            self._get_epoll().modify(fd, mask)
+
+    def _epoll_modify(self, fd, mask):
+        try:
+            self._get_epoll().modify(fd, mask)
+        except (IOError, OSError), error:
+            if error.errno != errno.ENOENT:
+                raise
+            # the fd number was closed and reused since we registered it
+            self._get_epoll().register(fd, mask)
+
+    def poll(self, timeout):
+        readables, writables = [], []
+
+        try:
+            events = self._get_epoll().poll(timeout)
+        except (IOError, OSError), error:
+            if error.errno == errno.EINTR:
+                self.options.logger.blather('EINTR encountered in poll')
+                return readables, writables
+            raise
+
+        for fd, eventmask in events:
+            registered = self.masks.get(fd, 0)
+            if eventmask & (select.EPOLLERR | select.EPOLLHUP):
+                # let the dispatcher find out about the error or hangup,
+                # whether it's waiting to read or to write; the kernel
+                # reports these even for an fd only registered for writing
+                eventmask = eventmask | registered
+            if eventmask & self.READ and registered & self.READ:
+                readables.append(fd)
+            if eventmask & self.WRITE and registered & self.WRITE:
+                writables.append(fd)
+        return readables, writables
+
+    def before_daemonize(self):
+        # the registrations are made again in the daemon's own epoll
+        self._close_epoll()
+
+    def after_daemonize(self):
+        masks, self.masks = self.masks, {}
+        for fd, mask in masks.items():
+            self._update(fd, mask)
+
+    def _close_epoll(self):
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+
+    def close(self):
+        # the fds registered are closed with the run they belonged to
+        self._close_epoll()
+        self.masks = {}
+
 def implements_poll():
     return hasattr(select, 'poll')
 
 def implements_kqueue():
     return hasattr(select, 'kqueue')
 
-if implements_kqueue():
+def implements_epoll():
+    return hasattr(select, 'epoll')
+
+if implements_epoll():
+    Poller = EpollPoller
+elif implements_kqueue():
     Poller = KQueuePoller
 elif implements_poll():
     Poller = PollPoller
@@ -2,7 +2,8 @@ import os
 import sys
 import time
 import errno
-import shlex
+import fcntl
+import tempfile
 import traceback
 import signal
 import subprocess
@@ -16,9 +17,9 @@ from adminservice.states import getProcessStateDescription
 from adminservice.states import ALL_STOPPED_STATES
 from adminservice.states import STOPPED_STATES
 
-from adminservice.options import decode_wait_status, make_namespec
+from adminservice.options import decode_wait_status
 from adminservice.options import signame
-from adminservice.options import ProcessException, BadCommand
+from adminservice.options import ProcessException
 
 from adminservice.dispatchers import EventListenerStates
 
@@ -28,6 +29,8 @@ from adminservice.datatypes import integer
 from adminservice.datatypes import RestartUnconditionally
 
 from adminservice.socket_manager import SocketManager
+from adminservice.shutdown import stop_process
+from adminservice.scriptrunner import list_parts
 
 class Subprocess:
 
@@ -53,7 +56,13 @@ class Subprocess:
     exitstatus = None # status attached to dead process by finsh()
     spawnerr = None # error message attached by spawn() if any
     group = None # ProcessGroup instance if process is in the group
-    waits_left = None # Number of transition waits left until failing transition
+    wait_deadline = None # time at which waiting for the previous process runs out
+    timer_deadline = None # time our next timed transition was scheduled for
+    launcher_pid = 0 # pid of the run_detached launcher child; 0 once reaped
+    status_pending = False # true while an asynchronous status check is running
+    launch_report_pipe = None # (read fd, write fd) the launcher reports its steps on
+    stop_escalated = False # true once stopwaitsecs ran out and SIGKILL was sent
+    stop_script_pending = False # true while a stop_pre_script or stop_post_script runs
 
     def __init__(self, config):
         """Constructor.
@@ -64,6 +73,8 @@ class Subprocess:
         self.dispatchers = {}
         self.pipes = {}
         self.state = ProcessStates.STOPPED if config.is_enabled() else ProcessStates.DISABLED
+        if config.conditional_config is not None:
+            config.options.conditional_configs.watch(self)
 
     def removelogs(self):
         for dispatcher in self.dispatchers.values():
@@ -100,54 +111,18 @@ class Subprocess:
 
         dispatcher.input_buffer += chars
         dispatcher.flush() # this must raise EPIPE if the pipe is closed
+        if dispatcher.input_buffer:
+            # the rest is sent when the pipe becomes writable
+            self.config.options.interest_changed(dispatcher)
 
     def get_execv_args(self):
-        """Internal: turn a program name into a file name, using $PATH,
-        make sure it exists / is executable, raising a ProcessException
-        if not """
-        try:
-            cmd = self.config.get_start_command()
-            commandargs = shlex.split(cmd)
-            self.config.options.logger.debug("Start command: %s" % cmd)
-        except ValueError, e:
-            raise BadCommand("can't parse command %r: %s" % \
-                (self.config.command, str(e)))
-
-        if commandargs:
-            program = commandargs[0]
-        else:
-            raise BadCommand("command is empty")
-
-        if "/" in program:
-            filename = program
-            try:
-                st = self.config.options.stat(filename)
-            except OSError:
-                st = None
-
-        else:
-            path = self.config.options.get_path()
-            found = None
-            st = None
-            for dir in path:
-                found = os.path.join(dir, program)
-                try:
-                    st = self.config.options.stat(found)
-                except OSError:
-                    pass
-                else:
-                    break
-            if st is None:
-                filename = program
-            else:
-                filename = found
-
-        # check_execv_args will raise a ProcessException if the execv
-        # args are bogus, we break it out into a separate options
-        # method call here only to service unit tests
-        self.config.options.check_execv_args(filename, commandargs, st)
-
-        return filename, commandargs
+        """Internal: the file name and argv the config's LaunchPlan
+        resolved the command to, raising the ProcessException that keeps
+        it from being run, if any """
+        plan = self.config.get_launch_plan()
+        if plan.error is not None:
+            raise plan.error
+        return plan.filename, list(plan.argv)
 
     event_map = {
         ProcessStates.BACKOFF: events.ProcessStateBackoffEvent,
@@ -181,6 +156,35 @@ class Subprocess:
             new_state = ProcessStates.DISABLED
 
         self.state = new_state
+        self.wake()
+        self.config.options.spawn_admission.state_changed(self, old_state, new_state)
+        self.config.options.timeline.state_changed(self, old_state, new_state)
+        self.config.options.startup_scheduler.state_changed(self, old_state, new_state)
+
+    def wake(self):
+        """ Have our group transitioned on the next pass of the main loop """
+        self.config.options.timers.wake(self.group)
+
+    def schedule(self):
+        """ Set a timer for the next time our state needs a transition
+        without anything else happening to us """
+        state = self.state
+        when = None
+        if state == ProcessStates.STARTING:
+            when = self.laststart + self.config.startsecs
+        elif state in (ProcessStates.BACKOFF, ProcessStates.STOPPING):
+            if self.delay:
+                when = self.delay
+        if self.wait_deadline is not None and state in STOPPED_STATES:
+            if when is None or self.wait_deadline < when:
+                when = self.wait_deadline
+
+        timers = self.config.options.timers
+        if when is None:
+            timers.cancel_timer(id(self))
+        elif when != self.timer_deadline or not timers.has_timer(id(self)):
+            timers.set_timer(id(self), self.group, when - time.time())
+        self.timer_deadline = when
 
     def _assertInState(self, *states):
         if self.state not in states:
@@ -212,6 +216,7 @@ class Subprocess:
         self.administrative_stop = False
 
         self.laststart = time.time()
+        options.timeline.begin(self, self.laststart)
 
         self._assertInState(ProcessStates.EXITED, ProcessStates.FATAL,
                             ProcessStates.BACKOFF, ProcessStates.STOPPED)
@@ -228,6 +233,7 @@ class Subprocess:
 
         try:
             self.dispatchers, self.pipes = self.config.make_dispatchers(self)
+            options.dispatchers_changed()
         except (OSError, IOError), why:
             code = why.args[0]
             if code == errno.EMFILE:
@@ -241,6 +247,10 @@ class Subprocess:
             self.change_state(ProcessStates.BACKOFF)
             return
 
+        if self.config.run_detached:
+            # the launcher reports how long each of its steps took on this
+            self.launch_report_pipe = os.pipe()
+
         try:
             pid = options.fork()
         except OSError, why:
@@ -257,6 +267,7 @@ class Subprocess:
             self.change_state(ProcessStates.BACKOFF)
             options.close_parent_pipes(self.pipes)
             options.close_child_pipes(self.pipes)
+            self._close_launch_report()
             return
 
         if pid != 0:
@@ -274,8 +285,40 @@ class Subprocess:
         self.spawnerr = None
         self.delay = time.time() + self.config.startsecs
         options.pidhistory[pid] = self
+        options.timeline.span(self, 'fork', self.laststart, time.time())
+        if self.config.run_detached:
+            self.launcher_pid = pid
+            if self.launch_report_pipe is not None:
+                r, w = self.launch_report_pipe
+                options.close_fd(w)
+                self.launch_report_pipe = (r, None)
         return pid
 
+    def _read_launch_report(self):
+        """ Return what the run_detached launcher reported about its steps """
+        if self.launch_report_pipe is None:
+            return ''
+        r = self.launch_report_pipe[0]
+        data = []
+        try:
+            fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+            while True:
+                chunk = os.read(r, 4096)
+                if not chunk:
+                    break
+                data.append(chunk)
+        except (OSError, IOError):
+            pass
+        self._close_launch_report()
+        return ''.join(data)
+
+    def _close_launch_report(self):
+        if self.launch_report_pipe is not None:
+            for fd in self.launch_report_pipe:
+                if fd is not None:
+                    self.config.options.close_fd(fd)
+            self.launch_report_pipe = None
+
     def _prepare_child_fds(self):
         options = self.config.options
         options.dup2(self.pipes['child_stdin'], 0)
@@ -284,18 +327,20 @@ class Subprocess:
             options.dup2(self.pipes['child_stdout'], 2)
         else:
             options.dup2(self.pipes['child_stderr'], 2)
-        for i in range(3, options.minfds):
-            options.close_fd(i)
-
-    def handle_term(self, sig, frame):
-        self.config.options.mood = AdminServiceStates.SHUTDOWN
+        first = 3
+        if self.launch_report_pipe is not None:
+            # the launcher writes its report to fd 3
+            options.dup2(self.launch_report_pipe[1], 3)
+            first = 4
+        options.close_fds(first)
 
     def _spawn_as_child(self, filename, argv):
         options = self.config.options
         exit_code = 127
 
-        # Add a handler to let the detached processes know to stop statusing
-        signal.signal(signal.SIGTERM, self.handle_term)
+        # Don't inherit the parent's signal handling; a run_detached
+        # launcher that is told to stop should just go away
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
         try:
             # prevent child from receiving signals sent to the
@@ -320,22 +365,15 @@ class Subprocess:
                 return # finally clause will exit the child process
 
             # set environment
+            plan = self.config.launch_plan
             env = os.environ.copy()
-            env['ADMINSERVICE_ENABLED'] = '1'
-            serverurl = self.config.serverurl
-            if serverurl is None: # unset
-                serverurl = options.serverurl # might still be None
-            if serverurl:
-                env['ADMINSERVICE_SERVER_URL'] = serverurl
-            env['ADMINSERVICE_PROCESS_NAME'] = self.config.name
             if self.group:
                 env['ADMINSERVICE_GROUP_NAME'] = self.group.config.name
-            if self.config.environment is not None:
-                env.update(self.config.environment)
+            env.update(plan.environment)
 
             # change directory
             try:
-                cwd = self.config.directory
+                cwd = plan.directory
                 if cwd is not None:
                     options.chdir(cwd)
             except OSError, why:
@@ -346,49 +384,11 @@ class Subprocess:
 
             # set umask, then execve
             try:
-                if self.config.umask is not None:
-                    options.setumask(self.config.umask)
+                if plan.umask is not None:
+                    options.setumask(plan.umask)
                 self.config.alive = True
                 if self.config.run_detached:
-                    # If the process is already running, we don't need to start it again.
-                    if not self.config.check_status():
-
-                        # Remove the pid file, use its existence to check if the process has started
-                        if os.path.exists(self.config.pid_file):
-                            os.remove(self.config.pid_file)
-
-                        # Start the process as a daemon
-                        daemonize(self.config.directory, self.config.umask, argv, env)
-
-                        # Give the process some time to start up
-                        num_checks = 0
-                        while not os.path.exists(self.config.pid_file) and (num_checks < 10):
-                            time.sleep(1)
-                            num_checks += 1
-
-                        # If there's a script to check if the config was started, run it now.
-                        # The assumption is it will return when it can determine if the process
-                        # is in either a good or bad state.
-                        if self.config.started_status_script is not None and not self.config.is_started():
-                            raise "Bad start status for %s" % self.config.name
-
-                    else:
-                        self.change_state(ProcessStates.RUNNING)
-                        msg = "Process for %s was already running. Not going to relaunch\n" % self.config.name
-                        options.write(1, "adminservice: " + msg)
-
-                    # Check status every second
-                    status = self.config.check_status()
-                    while status and self.config.options.mood == AdminServiceStates.RUNNING:
-                        exit_code = 0
-                        time.sleep(1)
-                        status = self.config.check_status()
-                    
-                    # This is one of the few times that we can remove the pid file.
-                    #    Either the service is shutting down - leave the pid file
-                    #    The process ended/died - remove the pid file
-                    if not status and os.path.exists(self.config.pid_file):
-                        os.remove(self.config.pid_file)
+                    exit_code = self._launch_detached(plan, argv, env)
                 else:
                     # This call won't return
                     options.execve(argv[0], argv, env)
@@ -407,7 +407,7 @@ class Subprocess:
                 msg = "adminservice: couldn't exec %s: %s\n" % (filename, error)
                 options.write(2, msg)
 
-            # this point should only be reached if execve failed or the spawnve'd process is finished.
+            # this point should only be reached if execve failed or the detached launch is done.
             # the finally clause will exit the child process.
         except Exception, e:
             options.write(2, "Exception spawning process: %s" % e)
@@ -417,65 +417,288 @@ class Subprocess:
             options._exit(exit_code) # exit process with code for spawn failure
             
 
+    def _launch_detached(self, plan, argv, env):
+        """ Runs in the forked child of a run_detached process.  Starts the
+        program as a daemon (unless it's already running), waits for it to
+        come up and returns the exit code for this launcher.  The launcher
+        doesn't stick around; once it has exited the parent's
+        DetachedMonitor keeps track of the program.
+
+        How long each step took is written to fd 3 for the parent's
+        StartupTimeline, one "step start end" line per step.
+        """
+        report = []
+        def step(name, start):
+            report.append('%s %.6f %.6f\n' % (name, start, time.time()))
+
+        marker = None
+        launcher = os.getpid()
+        try:
+            options = self.config.options
+
+            # If the process is already running, we don't need to start it again.
+            start = time.time()
+            running = self.config.check_status()
+            step('status_check', start)
+            if running:
+                msg = "Process for %s was already running. Not going to relaunch\n" % self.config.name
+                options.write(1, "adminservice: " + msg)
+                return 0
+
+            # Remove the pid file, use its existence to check if the process has started
+            if os.path.exists(self.config.pid_file):
+                os.remove(self.config.pid_file)
+
+            if self.config.start_pre_script is not None:
+                # the start command writes the time the pre script finished here
+                fd, marker = tempfile.mkstemp(prefix='adminservice-launch-')
+                os.close(fd)
+                env['ADMINSERVICE_PRE_SCRIPT_DONE'] = marker
+
+            # Start the process as a daemon
+            start = time.time()
+            daemonize(plan.directory, plan.umask, argv, env,
+                      native=plan.native, filename=plan.filename)
+            step('daemonize', start)
+
+            # Give the process some time to start up
+            start = time.time()
+            deadline = start + 10
+            while not os.path.exists(self.config.pid_file) and time.time() < deadline:
+                time.sleep(0.1)
+            found = time.time()
+            if marker is not None:
+                try:
+                    done = float(open(marker).read().strip())
+                except (IOError, ValueError):
+                    done = None
+                if done is not None and start <= done <= found:
+                    report.append('pre_script %.6f %.6f\n' % (start, done))
+                    start = done
+            report.append('pid_file %.6f %.6f\n' % (start, found))
+
+            # If there's a script to check if the config was started, run it now.
+            # The assumption is it will return when it can determine if the process
+            # is in either a good or bad state.
+            if self.config.started_status_script is not None:
+                start = time.time()
+                started = self.config.is_started()
+                step('started_status', start)
+                if not started:
+                    options.write(2, "adminservice: Bad start status for %s\n" % self.config.name)
+                    return 127
+
+            start = time.time()
+            running = self.config.check_status()
+            step('status', start)
+            if running:
+                return 0
+
+            # The process ended/died before we could hand it off, remove the pid file
+            if os.path.exists(self.config.pid_file):
+                os.remove(self.config.pid_file)
+            return 127
+        finally:
+            # daemonize()'s intermediate children sys.exit() through here too
+            if os.getpid() == launcher:
+                if marker is not None and os.path.exists(marker):
+                    os.remove(marker)
+                if self.launch_report_pipe is not None:
+                    try:
+                        os.write(3, ''.join(report))
+                    except OSError:
+                        pass
+
+    def _launcher_finished(self, sts):
+        """ The run_detached launcher was reaped.  If it left the program
+        running, hand the program to the DetachedMonitor and return True.
+        Otherwise return False and the launcher's exit is treated like the
+        exit of any other child.
+        """
+        options = self.config.options
+        self.launcher_pid = 0
+        es, msg = decode_wait_status(sts)
+        if es != 0:
+            options.detached_monitor.launcher_failed(self)
+            return False
+
+        pid = self.config.get_pid()
+        if isinstance(pid, (int, long)) and pid > 0:
+            self.pid = pid
+        else:
+            # the pid file doesn't hold a pid, liveness comes from check_status
+            pid = None
+        options.detached_monitor.track(self, pid)
+        options.logger.info('%s is running detached (pid %s)'
+                            % (self.config.name, pid or 'unknown'))
+
+        if self.killing:
+            # we were asked to stop while the launcher was still running
+            shutting_down = (options.mood < AdminServiceStates.RUNNING)
+            self.kill(self.config.stopsignal, shutting_down)
+        return True
+
+    def detached_exited(self):
+        """ Called by the DetachedMonitor when a polled run_detached program
+        has gone away.  It isn't our child, so there's no real exit status. """
+        self.finish(self.pid, 0)
+
     def stop(self):
-        """ Administrative stop """
+        """ Administrative stop.  The stop scripts are run without blocking
+        the main loop, so with a stop_pre_script the process is signalled
+        once the script is done and None is returned right away. """
         self.administrative_stop = True
         self.laststopreport = 0
+        if self.stop_script_pending:
+            # already on its way down
+            return None
 
         # We want to leave the processes up if they have pid_files and
         # admin service is shutting down, otherwise run the stop scripts
         shutting_down = (self.config.options.mood < AdminServiceStates.RUNNING)
-        if (not shutting_down and self.config.run_detached) or not self.config.run_detached:
-            if self.config.stop_pre_script is not None:
-                script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.config.stop_pre_script) else '.', self.config.stop_pre_script)
-                pre_script = ('%s %s' % (script, self.config.output_redirect))
-                self.run_script(pre_script)
+        if shutting_down and self.config.run_detached:
+            return self.kill(self.config.stopsignal, shutting_down)
+
+        if self.config.stop_pre_script is None:
+            return self._stop(shutting_down)
+
+        def onprescript(ok):
+            self.stop_script_pending = False
+            if self.get_state() in RUNNING_STATES:
+                msg = self._stop(shutting_down)
+                if msg is not None:
+                    self.config.options.logger.warn('unable to stop %s: %s'
+                                                    % (self.config.name, msg))
+            else:
+                # it went away while the script ran
+                self._stop_post_script()
+            self.wake()
+
+        self.stop_script_pending = True
+        self.run_script('stop_pre_script', self.config.stop_pre_script,
+                        onprescript)
+        return None
 
-                    
+    def _stop(self, shutting_down):
+        """ Signal the process and run its stop_post_script """
         killval = self.kill(self.config.stopsignal, shutting_down)
+        self.config.alive = False
+        self._stop_post_script()
+        return killval
 
-        if (not shutting_down and self.config.run_detached) or not self.config.run_detached:
-            self.config.alive = False
-            if self.config.stop_post_script is not None:
-                script = "%s %s" % ('/usr/bin/run-parts' if os.path.isdir(self.config.stop_post_script) else '', self.config.stop_post_script)
-                post_script = ('%s %s' % (script, self.config.output_redirect))
-                self.run_script(post_script)
+    def _stop_post_script(self):
+        if self.config.stop_post_script is None:
+            return
 
-        return killval
+        def onpostscript(ok):
+            self.stop_script_pending = False
+            self.wake()
+
+        self.stop_script_pending = True
+        self.run_script('stop_post_script', self.config.stop_post_script,
+                        onpostscript, source=False)
+
+    def run_script(self, kind, script, callback=None, source=True):
+        """ Run a lifecycle script without blocking, with its output going
+        to the process log.  A directory is run like run-parts would, one
+        script after another in sorted order.  A single script is sourced
+        by /bin/sh when source is set.  callback is called with true if
+        every script exited with status 0. """
+        config = self.config
+        logger = config.options.logger
+        if os.path.isdir(script):
+            commands = [ '%s %s' % (part, config.output_redirect)
+                         for part in list_parts(script) ]
+        else:
+            commands = [ '%s%s %s' % (source and '. ' or '', script,
+                                      config.output_redirect) ]
+
+        def onfinished(jobs):
+            ok = True
+            for job in jobs:
+                if job.timed_out:
+                    ok = False
+                elif not job.ok():
+                    ok = False
+                    logger.warn('%s %r for %s exited with status %s'
+                                % (kind, job.command, config.name, job.exitcode))
+            if callback is not None:
+                callback(ok)
+
+        logger.debug('running %s of %s' % (kind, config.name))
+        config.options.script_runner.run_all(config.get_script_key(kind),
+                                             commands, onfinished,
+                                             timeout=config.script_timeout)
+
+    def query(self, callback=None):
+        """ Run the query script without blocking.  Returns the ScriptJob,
+        whose output is the script's stdout followed by its stderr; callback
+        is called with the job when it's done. """
+        script = self.config.query_script
+        if os.path.isdir(script):
+            script = "/usr/bin/run-parts %s" % script
+
+        # send in preexec_fn to change user to uid/gid
+        return self.config.options.script_runner.run(
+            self.config.get_script_key('query'), script, callback,
+            timeout=self.config.script_timeout, capture=True,
+            preexec_fn=self.set_uid)
+
+    def check_detached_status(self, callback):
+        """ Find out in the background whether the program named by our pid
+        file is running and call callback with the answer.  status_pending
+        is set until then. """
+        if self.status_pending:
+            return
+        self.status_pending = True
 
-    def run_script(self, script_to_run):
-        if script_to_run is not None:
-            try:
-                os.system(script_to_run)
-            except OSError, e:
-                self.config.options.write(2, "adminservice: unable to execute script(s) %s: %s\n" % (script_to_run, repr(e)))
-            except:
-                (fil, fun, line), t,v,tbinfo = asyncore.compact_traceback()
-                error = '%s, %s: file: %s line: %s' % (t, v, fil, line)
-                msg = "adminservice: couldn't run script at %s: %s\n" % (script_to_run, error)
-                self.config.options.write(2, msg)
+        def onstatus(alive):
+            self.status_pending = False
+            callback(alive)
+            self.wake()
 
-    def query(self):
-        if self.config.query_script is not None:
-            try:
-                shell = False if os.path.isdir(self.config.query_script) else True
-                args = ['/usr/bin/run-parts'] if not shell else []
-                args.extend([self.config.query_script])
-
-                # send in preexec_fn to change user to uid/gid
-                proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell, preexec_fn=self.set_uid)
-                comm = proc.communicate()
-                return "%s%s" % (comm[0], comm[1] if comm[1] is not None else '')
-            except OSError, e:
-                self.config.options.write(2, "adminservice: unable to execute query(s) %s: %s\n" % (self.config.query_script, repr(e)))
-            except:
-                (fil, fun, line), t,v,tbinfo = asyncore.compact_traceback()
-                error = '%s, %s: file: %s line: %s' % (t, v, fil, line)
-                msg = "adminservice: couldn't run query at %s: %s\n" % (self.config.query_script, error)
-                self.config.options.write(2, msg)
-            return "Error running query"
+        self.config.check_status_async(onstatus)
+
+    def _remove_pid_file(self):
+        if os.path.exists(self.config.pid_file):
+            self.config.options.logger.info("Didn't expect to find the pid file %s, removing now" % self.config.pid_file)
+            os.remove(self.config.pid_file)
+
+    def _stopped_status(self, alive):
+        """ Status of a detached program found while we're STOPPED """
+        if self.state != ProcessStates.STOPPED or self.laststart:
+            return
+        if self.config.options.mood <= AdminServiceStates.RESTARTING:
+            return
+        if alive:
+            # If the process has a pid file and is already running, transition to STARTING
+            # This will handle not starting another process, just need it tracked
+            self.config.options.logger.info('%s appears to be running already, changing from %s to STARTING state'
+                                            % (self.config.name, getProcessStateDescription(self.state)))
+            self.spawn()
         else:
-            return "%s is in the %s state" % (make_namespec(self.config.group, self.config.name), getProcessStateDescription(self.get_state()))
+            self._remove_pid_file()
+            if (self.config.is_enabled() and self.config.autostart and
+                self.config.options.spawn_admission.admit(self)):
+                # STOPPED -> STARTING; if it has to wait its turn, the pid
+                # file is gone, so transition() spawns it when it comes
+                self.spawn()
+
+    def _disabled_status(self, alive):
+        """ Status of a detached program found while we're DISABLED """
+        if self.state != ProcessStates.DISABLED:
+            return
+        if self.config.options.mood <= AdminServiceStates.RESTARTING:
+            return
+        if alive:
+            # If the process has a pid file and is already running, transition to STARTING
+            # This will handle not starting another process, just need it tracked
+            self.config.options.logger.info('%s appears to be running already, changing it to a startable state' % self.config.name)
+            self.change_state(ProcessStates.STOPPED)
+            self.spawn()
+        else:
+            # If the process isn't running but has a pid file, remove it so we don't keep checking
+            self._remove_pid_file()
 
     def stop_report(self):
         """ Log a 'waiting for x to stop' message with throttling. """
@@ -571,25 +794,17 @@ class Subprocess:
                     try:
                         options.kill(detached_pid, sig)
                         options.logger.warn("Killed detached pid %d" % detached_pid)
-                        if os.path.exists(self.config.pid_file) and not self.config.check_status():
-                            options.logger.trace("Removing %s after killing detached process" % self.config.pid_file)
-                            os.remove(self.config.pid_file)
+                        self.config.invalidate_status()
                     except Exception, e:
                         options.logger.warn("Problem killing detached pid %d: %s" % (detached_pid, e))
             if stop_command is not None:
                 if shutdown:
                     options.logger.info("Leaving %s(%d) running, system is shutting down" % (self.config.name, pid))
                 else:
-                    try:
-                        val = os.system(stop_command)
-                        options.logger.debug("Stop command for %s had return code of %s" % (pid, val))
-                        if os.path.exists(self.config.pid_file) and not self.config.check_status():
-                            options.logger.trace("Removing %s after killing detached process" % self.config.pid_file)
-                            os.remove(self.config.pid_file)
-                    except Exception, e:
-                        options.logger.warn("Problem running stop command for %s: %s" % (pid, e))
-            options.logger.info("Sending %s to pid %s" % (sig, pid))
-            options.kill(pid, sig)
+                    self._run_stop_command(stop_command, pid)
+            if self.launcher_pid or not self.config.run_detached:
+                options.logger.info("Sending %s to pid %s" % (sig, pid))
+                options.kill(pid, sig)
         except:
             tb = traceback.format_exc()
             msg = 'unknown problem killing %s (%s):%s' % (self.config.name,
@@ -601,8 +816,31 @@ class Subprocess:
             self.delay = 0
             return msg
 
+        if shutdown and self.config.run_detached and not self.launcher_pid:
+            # the program is left running and there's no child of ours to
+            # reap, so we're done with it now
+            self.finish(self.pid, 0)
+
         return None
 
+    def _run_stop_command(self, stop_command, pid):
+        """ Run the stop command of a run_detached program without
+        blocking; it is signalled with SIGKILL after stopwaitsecs if the
+        command doesn't stop it """
+        options = self.config.options
+
+        def onstopped(job):
+            if job.ok():
+                options.logger.debug("Stop command for %s had return code of %s" % (pid, job.exitcode))
+            elif not job.timed_out:
+                options.logger.warn("Stop command for %s had return code of %s" % (pid, job.exitcode))
+            self.config.invalidate_status()
+            self.wake()
+
+        options.script_runner.run(self.config.get_script_key('stop'),
+                                  stop_command, onstopped,
+                                  timeout=self.config.script_timeout, ttl=0)
+
     def signal(self, sig):
         """Send a signal to the subprocess, without intending to kill it.
 
@@ -616,6 +854,13 @@ class Subprocess:
             options.logger.debug(msg)
             return msg
 
+        if (self.config.run_detached and not self.launcher_pid and
+            options.detached_monitor.get_pid(self) is None):
+            msg = ("can't send %s sig %s, its pid file doesn't hold a pid" %
+                   (self.config.name, signame(sig)))
+            options.logger.debug(msg)
+            return msg
+
         options.logger.debug('sending %s (pid %s) sig %s'
                              % (self.config.name,
                                 self.pid,
@@ -642,6 +887,12 @@ class Subprocess:
     def finish(self, pid, sts):
         """ The process was reaped and we need to report and manage its state
         """
+        if self.launcher_pid and pid == self.launcher_pid:
+            self.config.options.timeline.launcher_finished(
+                self, self._read_launch_report(), time.time())
+            if self._launcher_finished(sts):
+                return
+
         self.drain()
 
         es, msg = decode_wait_status(sts)
@@ -715,9 +966,12 @@ class Subprocess:
             os.remove(self.config.pid_file)
 
         self.pid = 0
+        self.config.options.detached_monitor.untrack(self)
+        self.config.invalidate_status()
         self.config.options.close_parent_pipes(self.pipes)
         self.pipes = {}
         self.dispatchers = {}
+        self.config.options.dispatchers_changed()
 
         # if we died before we processed the current event (only happens
         # if we're an event listener), notify the event system that this
@@ -747,6 +1001,30 @@ class Subprocess:
     def get_state(self):
         return self.state
 
+    def should_spawn(self, now):
+        """ Return true if transition() would spawn us now, not counting
+        whether adminserviced is shutting down """
+        state = self.state
+        config = self.config
+        if self.stop_script_pending:
+            # it's being stopped
+            return False
+        if state == ProcessStates.EXITED:
+            if config.is_enabled() and config.autorestart:
+                if config.autorestart is RestartUnconditionally:
+                    return True
+                # autorestart is RestartWhenExitUnexpected
+                return self.exitstatus not in config.exitcodes
+        elif state == ProcessStates.STOPPED and not self.laststart:
+            if config.run_detached and os.path.exists(config.pid_file):
+                # transition() checks whether it is already running instead
+                return False
+            return bool(config.is_enabled() and config.autostart)
+        elif state == ProcessStates.BACKOFF:
+            if config.is_enabled() and self.backoff <= config.startretries:
+                return now > self.delay
+        return False
+
     def transition(self):
         now = time.time()
         state = self.state
@@ -755,49 +1033,18 @@ class Subprocess:
 
         if self.config.options.mood > AdminServiceStates.RESTARTING:
             # dont start any processes if adminservice is shutting down
-            if state == ProcessStates.EXITED:
-                if self.config.is_enabled() and self.config.autorestart:
-                    if self.config.autorestart is RestartUnconditionally:
-                        # EXITED -> STARTING
-                        self.spawn()
-                    else: # autorestart is RestartWhenExitUnexpected
-                        if self.exitstatus not in self.config.exitcodes:
-                            # EXITED -> STARTING
-                            self.spawn()
-            elif state == ProcessStates.STOPPED and not self.laststart:
-                # Remove the pid file, use its existence to check if the process has started
-                if self.config.run_detached and os.path.exists(self.config.pid_file) and not self.config.check_status():
-                    logger.info("Didn't expect to find the pid file %s, removing now" % self.config.pid_file)
-                    os.remove(self.config.pid_file)
-
-                if self.config.is_enabled() and self.config.autostart:
-                    # STOPPED -> STARTING
+            if self.should_spawn(now):
+                if self.config.options.spawn_admission.admit(self, now):
+                    # EXITED/STOPPED/BACKOFF -> STARTING
                     self.spawn()
-                elif self.config.run_detached:
-                    if os.path.exists(self.config.pid_file) and self.config.check_status():
-                        # If the process has a pid file and is already running, transition to STARTING
-                        # This will handle not starting another process, just need the status thread running
-                        logger.info('%s appears to be running already, changing from %s to STARTING state'
-                                     % (self.config.name, getProcessStateDescription(self.state)))
-                        self.spawn()
+            elif state == ProcessStates.STOPPED and not self.laststart:
+                if self.config.run_detached and os.path.exists(self.config.pid_file):
+                    # The process may already be running, find out before starting
+                    # it (or removing a stale pid file)
+                    self.check_detached_status(self._stopped_status)
             elif state == ProcessStates.DISABLED and os.path.exists(self.config.pid_file):
                 # If the process is in the disabled state, it may still be running. Check based on the pid_file config value.
-                stat = self.config.check_status()
-                if not stat:
-                    # If the process isn't running but has a pid file, remove it so we don't keep checking
-                    logger.info("Didn't expect to find the pid file %s, removing now" % self.config.pid_file)
-                    os.remove(self.config.pid_file)
-                else:
-                    # If the process has a pid file and is already running, transition to STARTING
-                    # This will handle not starting another process, just need the status thread running
-                    logger.info('%s appears to be running already, changing it to a startable state' % self.config.name)
-                    self.change_state(ProcessStates.STOPPED)
-                    self.spawn()
-            elif state == ProcessStates.BACKOFF:
-                if self.config.is_enabled() and self.backoff <= self.config.startretries:
-                    if now > self.delay:
-                        # BACKOFF -> STARTING
-                        self.spawn()
+                self.check_detached_status(self._disabled_status)
 
         if state == ProcessStates.STARTING:
             if now - self.laststart > self.config.startsecs:
@@ -829,6 +1076,7 @@ class Subprocess:
                 # sigkill.  if this doesn't kill it, the process will be stuck
                 # in the STOPPING state forever.
                 logger.warn('killing %r (%s) with SIGKILL' % (self.config.name, self.pid))
+                self.stop_escalated = True
                 shutting_down = (self.config.options.mood < AdminServiceStates.RUNNING)
                 self.kill(signal.SIGKILL, shutting_down)
 
@@ -890,15 +1138,20 @@ class FastCGISubprocess(Subprocess):
             options.dup2(self.pipes['child_stdout'], 2)
         else:
             options.dup2(self.pipes['child_stderr'], 2)
-        for i in range(3, options.minfds):
-            options.close_fd(i)
+        options.close_fds(3)
 
 class ProcessGroupBase:
+    transition_every_pass = False # false if transitioning only when woken will do
+    update_in_place = False # true if update() can take on a reread config
+
     def __init__(self, config):
         self.config = config
         self.processes = {}
+        self.pending_updates = {} # name -> (new ProcessConfig or None, restart)
         for pconfig in self.config.process_configs:
             self.processes[pconfig.name] = pconfig.make_process(self)
+        config.options.timers.wake(self)
+        config.options.startup_scheduler.register(self)
 
 
     def __cmp__(self, other):
@@ -934,9 +1187,10 @@ class ProcessGroupBase:
                 proc.give_up()
 
     def get_unstopped_processes(self):
-        """ Processes which aren't in a state that is considered 'stopped' """
+        """ Processes which aren't in a state that is considered 'stopped'
+        or whose stop scripts are still running """
         return [ x for x in self.processes.values() if x.get_state() not in
-                 ALL_STOPPED_STATES ]
+                 ALL_STOPPED_STATES or x.stop_script_pending ]
 
     def get_dispatchers(self):
         dispatchers = {}
@@ -944,14 +1198,151 @@ class ProcessGroupBase:
             dispatchers.update(process.dispatchers)
         return dispatchers
 
+    def schedule(self):
+        for process in self.processes.values():
+            process.schedule()
+
+    def forget_process(self, process):
+        options = process.config.options
+        options.detached_monitor.untrack(process)
+        options.timers.cancel_timer(id(process))
+        options.spawn_admission.withdraw(process)
+        options.timeline.forget(process)
+        options.startup_scheduler.forget(process)
+
     def before_remove(self):
-        pass
+        for process in self.processes.values():
+            self.forget_process(process)
+        self.config.options.startup_scheduler.unregister(self)
+
+    def get_target_config(self, name):
+        """ The config the process named name runs with once any update
+        waiting for it to stop is applied; None if it's being removed """
+        if self.pending_updates.has_key(name):
+            return self.pending_updates[name][0]
+        process = self.processes.get(name)
+        if process is None:
+            return None
+        return process.config
+
+    def diff_config(self, config):
+        """ Compare the process configs of config, a reread config for
+        this group, with the ones the group has by fingerprint; return
+        the names of the (added, changed, removed) processes """
+        added = []
+        changed = []
+        new = {}
+        for pconfig in config.process_configs:
+            new[pconfig.name] = pconfig
+            if not self.processes.has_key(pconfig.name):
+                added.append(pconfig.name)
+                continue
+            current = self.get_target_config(pconfig.name)
+            if (current is None or
+                current.get_fingerprint() != pconfig.get_fingerprint()):
+                changed.append(pconfig.name)
+        removed = [ name for name in self.processes.keys()
+                    if not new.has_key(name) and
+                    self.get_target_config(name) is not None ]
+        added.sort()
+        changed.sort()
+        removed.sort()
+        return added, changed, removed
+
+    def update(self, config):
+        """ Take on config, a reread config for this group, touching only
+        the processes whose fingerprints changed; the others keep running
+        with their configs, logs and dispatchers as they are.  Added
+        processes are made at once.  Changed and removed processes are
+        stopped, and apply_updates() swaps them out once they're down,
+        starting a changed one again if it was running.  Returns the
+        names of the (added, changed, removed) processes. """
+        options = self.config.options
+        added, changed, removed = self.diff_config(config)
+        new = {}
+        configs = []
+        for pconfig in config.process_configs:
+            if pconfig.name in added or pconfig.name in changed:
+                pconfig.create_autochildlogs()
+                pconfig.load_launch_plan()
+                new[pconfig.name] = pconfig
+            else:
+                pconfig = self.get_target_config(pconfig.name)
+            configs.append(pconfig)
+        config.process_configs = configs
+        self.config = config
+
+        for name in added:
+            self.processes[name] = new[name].make_process(self)
+        for name in changed + removed:
+            process = self.processes[name]
+            restart = process.get_state() in RUNNING_STATES
+            if self.pending_updates.has_key(name):
+                restart = restart or self.pending_updates[name][1]
+            self.pending_updates[name] = (new.get(name), restart)
+            if process.get_state() not in ALL_STOPPED_STATES:
+                if name in removed:
+                    why = 'it is no longer configured'
+                else:
+                    why = 'to apply its new config'
+                options.logger.info('stopping %s, %s' % (name, why))
+                msg = stop_process(self, process)
+                if msg is not None:
+                    options.logger.warn('could not stop %s: %s' % (name, msg))
+
+        if added or changed or removed:
+            # dependencies name processes that may have been replaced
+            options.startup_scheduler.register(self)
+            options.dispatchers_changed()
+        self.apply_updates()
+        options.timers.wake(self)
+        return added, changed, removed
+
+    def apply_updates(self):
+        """ Swap out the processes update() stopped once they're down """
+        options = self.config.options
+        scheduler = options.startup_scheduler
+        swapped = False
+        for name, (pconfig, restart) in self.pending_updates.items():
+            process = self.processes[name]
+            if (process.get_state() not in ALL_STOPPED_STATES or
+                process.stop_script_pending):
+                continue
+            del self.pending_updates[name]
+            self.forget_process(process)
+            del self.processes[name]
+            swapped = True
+            if pconfig is None:
+                options.logger.info('removed %s' % name)
+                continue
+            process = pconfig.make_process(self)
+            self.processes[name] = process
+            options.logger.info('replaced %s with its new config' % name)
+            if not restart or not pconfig.is_enabled():
+                continue
+            if scheduler.is_enabled():
+                scheduler.request(process)
+            elif not process.should_spawn(time.time()):
+                process.spawn()
+        if swapped:
+            scheduler.register(self)
+            options.dispatchers_changed()
 
 class ProcessGroup(ProcessGroupBase):
+    update_in_place = True
+
     def transition(self):
+        if self.pending_updates:
+            self.apply_updates()
+        scheduler = self.config.options.startup_scheduler
+        if scheduler.is_enabled():
+            # start processes as their dependencies come up, not in priority order
+            return scheduler.transition(self)
+
         procs = self.processes.values()[:]
         procs.sort()
         last_state = None
+        now = time.time()
 
         for proc in procs:
             logger = proc.config.options.logger
@@ -960,25 +1351,25 @@ class ProcessGroup(ProcessGroupBase):
             if last_state is not None and proc.get_state() in STOPPED_STATES:
                 previous_state = last_state[0]
 
-                if previous_state in RUNNING_STATES and proc.waits_left is None:
-                    proc.waits_left = proc.config.waitforprevious
+                if (previous_state in RUNNING_STATES and proc.wait_deadline is None and
+                    proc.config.waitforprevious is not None):
+                    proc.wait_deadline = now + proc.config.waitforprevious
 
                 # If this process isn't configured to wait, don't bother with these transitions
-                if proc.waits_left is not None and previous_state != ProcessStates.RUNNING:
+                if proc.wait_deadline is not None and previous_state != ProcessStates.RUNNING:
                     # Need to wait if we have a wait time set, the previous process is in the STARTING state and
-                    # this process is in the STOPPED state
-                    if proc.waits_left > 0 and previous_state == ProcessStates.STARTING:
+                    # this process is in the STOPPED state.  schedule() wakes us when the wait runs out.
+                    if now < proc.wait_deadline and previous_state == ProcessStates.STARTING:
                         logger.trace("%s startup wait conditions true, returning"
                                      % proc.config.name)
-                        proc.waits_left -= 1
                         return
-                    # If there are no waits left, or the previous process has transitioned to a new state(not running - a bad state)
+                    # If there is no wait left, or the previous process has transitioned to a new state(not running - a bad state)
                     # and we haven't started, change the process to the FATAL state and skip this process. Otherwise transition
-                    elif proc.waits_left == 0 or previous_state != ProcessStates.STARTING:
-                        logger.debug("waits = 0 or previous is not starting")
+                    else:
+                        logger.debug("wait is over or previous is not starting")
                         if proc.config.failafterwait and proc.state != ProcessStates.FATAL:
-                            logger.debug("Marking %s as FATAL, waits left: %d  previous state: %s"
-                                         % (proc.config.name, proc.waits_left, getProcessStateDescription(previous_state)))
+                            logger.debug("Marking %s as FATAL, wait left: %.1f  previous state: %s"
+                                         % (proc.config.name, max(0, proc.wait_deadline - now), getProcessStateDescription(previous_state)))
                             proc.change_state(ProcessStates.FATAL)
                             continue
 
@@ -989,12 +1380,17 @@ class ProcessGroup(ProcessGroupBase):
                              % proc.config.name)
                 return
 
-            proc.waits_left = None
+            proc.wait_deadline = None
             proc.transition()
+            if proc.status_pending:
+                # don't move on until we know whether this one is running
+                return
             if proc.get_state() != ProcessStates.DISABLED:
                 last_state = (proc.get_state(), proc)
 
 class FastCGIProcessGroup(ProcessGroup):
+    update_in_place = False # the socket is made from the group's config
+
     def __init__(self, config, **kwargs):
         ProcessGroup.__init__(self, config)
         sockManagerKlass = kwargs.get('socketManager', SocketManager)
@@ -1008,6 +1404,9 @@ class FastCGIProcessGroup(ProcessGroup):
             raise ValueError('Could not create FastCGI socket %s: %s' % (self.socket_manager.config(), e))
 
 class EventListenerPool(ProcessGroupBase):
+    # listeners change state on I/O and events are buffered at any time
+    transition_every_pass = True
+
     def __init__(self, config):
         ProcessGroupBase.__init__(self, config)
         self.event_buffer = []
@@ -1041,6 +1440,7 @@ class EventListenerPool(ProcessGroupBase):
             self.dispatch()
 
     def before_remove(self):
+        ProcessGroupBase.before_remove(self)
         self._unsubscribe()
 
     def dispatch(self):
@@ -1150,7 +1550,11 @@ def new_serial(inst):
     inst.serial += 1
     return inst.serial
 
-def daemonize(directory, umask, argv, env, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
+def daemonize(directory, umask, argv, env, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null', native=None, filename=None):
+    """ Run argv as a daemon.  With a NativeLaunch, the daemon execs the
+    program itself, filename if given (argv[0] found on the PATH), and its
+    parent writes the pid file; otherwise argv (the shell chain of the
+    start command) is run by the daemon. """
     stdin = os.path.abspath(stdin)
     stdout = os.path.abspath(stdout)
     stderr = os.path.abspath(stderr)
@@ -1188,8 +1592,12 @@ def daemonize(directory, umask, argv, env, stdin='/dev/null', stdout='/dev/null'
         sys.stderr.write("fork #3 failed: (%d) %s\n"%(e.errno, e.strerror))
         sys.exit(1)
     if pid > 0:
+        if native is not None:
+            native.started(pid, env)
         sys.exit(0) # exit parent
 
     # Now I am a daemon!
+    if native is not None:
+        native.execute(argv, env, filename) # doesn't return
     subprocess.Popen(argv, env=env, close_fds=True)
     os._exit(0)
@@ -36,6 +36,7 @@ import threading
 import time
 import pkg_resources
 import xml.dom.minidom
+import json
 from operator import itemgetter
 
 from adminservice.medusa import asyncore_25 as asyncore
@@ -48,6 +49,7 @@ from adminservice.options import split_namespec as sn
 from adminservice import xmlrpc
 from adminservice import states
 from adminservice import http_client
+from adminservice import timeline
 
 class fgthread(threading.Thread):
     """ A subclass of threading.Thread, with a kill() method.
@@ -1451,6 +1453,104 @@ class DefaultControllerPlugin(ControllerPluginBase):
             "version\t\t\tShow the version of the remote adminserviced "
             "process")
 
+    def do_loopstats(self, arg):
+        verbose = arg.strip() == '-v'
+        if arg.strip() and not verbose:
+            self.ctl.output('Error: loopstats accepts only -v')
+            self.help_loopstats()
+            return
+
+        if not self.ctl.upcheck():
+            return
+        adminservice = self.ctl.get_adminservice()
+        stats = adminservice.getLoopStats()
+
+        self.ctl.output('iterations: %d  slow (> %gms): %d  read events: %d  '
+                        'write events: %d' % (
+                            stats['iterations'], stats['slow_threshold'] * 1000,
+                            stats['slow_iterations'], stats['read_events'],
+                            stats['write_events']))
+        last_slow = stats.get('last_slow')
+        if last_slow:
+            self.ctl.output('last slow iteration: %s, %.1fms, mostly in %s' % (
+                time.strftime('%b %d %I:%M:%S %p',
+                              time.localtime(last_slow['time'])),
+                last_slow['busy'] * 1000, last_slow['phase']))
+
+        template = '%-10s %10s %12s %10s %10s'
+        self.ctl.output(template % ('phase', 'count', 'total ms', 'mean ms',
+                                    'max ms'))
+        bounds = stats['bucket_bounds']
+        for info in stats['phases'] + [dict(stats['busy'], name='(busy)')]:
+            self.ctl.output(template % (
+                info['name'], int(info['count']), '%.1f' % (info['total'] * 1000),
+                '%.3f' % (info['mean'] * 1000), '%.3f' % (info['max'] * 1000)))
+            if verbose:
+                self._show_buckets(bounds, info['buckets'])
+
+    def _show_buckets(self, bounds, buckets):
+        for i, count in enumerate(buckets):
+            if count:
+                if i < len(bounds):
+                    label = '<= %gms' % (bounds[i] * 1000)
+                else:
+                    label = '> %gms' % (bounds[-1] * 1000)
+                self.ctl.output('    %-12s %d' % (label, count))
+
+    def help_loopstats(self):
+        self.ctl.output("loopstats\t\tShow where adminserviced's main loop "
+                        "spends its time")
+        self.ctl.output("loopstats -v\t\tAlso show the histogram of each phase")
+
+    def do_timeline(self, arg):
+        args = arg.split()
+        trace = None
+        if args[:1] == ['--trace'] and len(args) == 2:
+            trace = args[1]
+        elif args:
+            self.ctl.output('Error: timeline accepts only --trace FILE')
+            self.help_timeline()
+            return
+
+        if not self.ctl.upcheck():
+            return
+        adminservice = self.ctl.get_adminservice()
+        info = adminservice.getStartupTimeline()
+
+        if trace is not None:
+            try:
+                f = open(trace, 'w')
+                try:
+                    json.dump(timeline.to_chrome_trace(info), f)
+                finally:
+                    f.close()
+            except (IOError, OSError), e:
+                self.ctl.output('ERROR: could not write %s: %s' % (trace, e))
+                return
+            self.ctl.output('wrote %d spans to %s' % (len(info['spans']), trace))
+
+        path = info['critical_path']
+        if not path:
+            self.ctl.output('no process has been started yet')
+            return
+        total = path[-1]['running'] - path[0]['begin']
+        self.ctl.output('critical path: %d processes, %.1fs' % (len(path), total))
+        template = '%-30s %9s %9s  %s'
+        self.ctl.output(template % ('process', 'waited s', 'start s', 'slowest steps'))
+        for step in path:
+            name = make_namespec(step['group'], step['process'])
+            phases = step['phases'][:]
+            phases.sort(key=itemgetter('duration'), reverse=True)
+            slowest = ', '.join([ '%s %.1fs' % (phase['name'], phase['duration'])
+                                  for phase in phases[:3] ])
+            self.ctl.output(template % (name, '%.1f' % step['waited'],
+                                        '%.1f' % step['duration'], slowest))
+
+    def help_timeline(self):
+        self.ctl.output("timeline\t\tShow the critical path of the last startup")
+        self.ctl.output("timeline --trace <file>\tAlso write every recorded startup "
+                        "step to <file> as a Chrome trace (chrome://tracing)")
+
     def do_fg(self, arg):
         if not self.ctl.upcheck():
             return
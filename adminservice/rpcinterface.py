@@ -20,6 +20,7 @@ from adminservice.events import notify
 from adminservice.events import RemoteCommunicationEvent
 
 from adminservice.http import NOT_DONE_YET
+from adminservice.shutdown import TieredStop
 from adminservice.xmlrpc import (
     capped_int,
     Faults,
@@ -99,6 +100,95 @@ class AdminServiceNamespaceRPCInterface:
         self._update('getPID')
         return self.adminserviced.options.get_pid()
 
+    def getLoopStats(self):
+        """ Return timings of the phases of adminserviced's main loop
+
+        @return struct stats  A struct with the iteration, slow iteration
+                              and event counts, the histogram bucket bounds
+                              (seconds) and, for the time spent working in
+                              each iteration ('busy') and for each phase, its
+                              count, total, mean, max and bucket counts
+        """
+        self._update('getLoopStats')
+        return self.adminserviced.loop_stats.get_info()
+
+    def getLogStats(self):
+        """ Return the counters of the log writer thread async_logging
+        writes the logs on
+
+        @return struct stats  A struct with string policy ('off' when the
+                              logs are written synchronously), int maxsize
+                              and the numbers of records pending, queued,
+                              dropped because the queue was full and
+                              flushed (written), and how many times a full
+                              queue made the main loop wait
+        """
+        self._update('getLogStats')
+        writer = self.adminserviced.options.log_writer
+        if writer is None:
+            return {'policy': 'off', 'maxsize': 0, 'pending': 0, 'queued': 0,
+                    'dropped': 0, 'flushed': 0, 'waits': 0}
+        return writer.get_info()
+
+    def getLoopStalls(self):
+        """ Return the most recent times the main loop was blocked for
+        longer than watchdog_threshold, oldest first
+
+        @return array stalls  An array of structs with keys float time,
+                              float duration (seconds, as far as known),
+                              boolean finished, string process, string rpc
+                              and string stack (the main thread's stack
+                              when the stall was noticed)
+        """
+        self._update('getLoopStalls')
+        return self.adminserviced.watchdog.get_stalls()
+
+    def getSpawnQueue(self):
+        """ Return the state of spawn admission control: its limits, how
+        many processes are STARTING, the processes waiting for their turn
+        to start and how long processes have had to wait
+
+        @return struct info  A struct with the limits (max_starting,
+                             max_rate, max_load, min_memory), starting,
+                             tickets, available, the limit holding the
+                             queue back, load and memory as last read,
+                             depth, the queue (structs with name, group and
+                             waited seconds, in the order they will start),
+                             admitted, the times each limit held the queue
+                             back and a histogram of the waits
+        """
+        self._update('getSpawnQueue')
+        return self.adminserviced.options.spawn_admission.get_info()
+
+    def getStartupTimeline(self):
+        """ Return the recorded steps of recent process starts and the
+        critical path through the last of them
+
+        @return struct info  A struct with since (when recording began),
+                             spans (structs with process, group, attempt,
+                             name, start and end; the whole-attempt 'start'
+                             spans also have an outcome) and critical_path
+                             (structs with process, group, attempt, begin,
+                             running, duration, waited and phases, each
+                             phase a struct with name and duration)
+        """
+        self._update('getStartupTimeline')
+        return self.adminserviced.options.timeline.get_info()
+
+    def getStopReports(self):
+        """ Return reports of the last priority tiered stops, from the
+        shutdown of adminserviced or stopAllProcesses, oldest first
+
+        @return array reports  An array of structs with reason, start, end
+                               and tiers, highest priority first; each tier
+                               a struct with priority, groups, start, end and
+                               processes (structs with name, group,
+                               stopwaitsecs, requested, stopped, duration,
+                               killed and state)
+        """
+        self._update('getStopReports')
+        return self.adminserviced.options.stop_reports
+
     def readLog(self, offset, length):
         """ Read length bytes from the main log starting at offset
 
@@ -113,6 +203,8 @@ class AdminServiceNamespaceRPCInterface:
         if logfile is None or not os.path.exists(logfile):
             raise RPCError(Faults.NO_FILE, logfile)
 
+        for handler in self.adminserviced.options.logger.handlers:
+            handler.flush()
         try:
             return readFile(logfile, int(offset), int(length))
         except ValueError, inst:
@@ -132,6 +224,10 @@ class AdminServiceNamespaceRPCInterface:
         if logfile is None or not self.adminserviced.options.exists(logfile):
             raise RPCError(Faults.NO_FILE)
 
+        # what was logged before the clear is written before the file goes
+        for handler in self.adminserviced.options.logger.handlers:
+            handler.flush()
+
         # there is a race condition here, but ignore it.
         try:
             self.adminserviced.options.remove(logfile)
@@ -372,8 +468,13 @@ class AdminServiceNamespaceRPCInterface:
         processes.sort()
         processes = [ (group, process) for process in processes]
 
-        startall = make_startallfunc(processes, isNotRunning, self.startProcess,
+        scheduler = self.adminserviced.options.startup_scheduler
+        if scheduler.is_enabled():
+            startall = make_dependency_startfunc(processes, scheduler,
                                 force=str(force), proc_type=proc_type, wait=wait)
+        else:
+            startall = make_startallfunc(processes, isNotRunning, self.startProcess,
+                                    force=str(force), proc_type=proc_type, wait=wait)
 
         startall.delay = 0.05
         startall.rpcinterface = self
@@ -389,8 +490,13 @@ class AdminServiceNamespaceRPCInterface:
         self._update('startAllProcesses')
 
         processes = self._getAllProcesses()
-        startall = make_startallfunc(processes, isNotRunning, self.startProcess,
+        scheduler = self.adminserviced.options.startup_scheduler
+        if scheduler.is_enabled():
+            startall = make_dependency_startfunc(processes, scheduler,
                                 force=False, proc_type=proc_type, wait=wait)
+        else:
+            startall = make_startallfunc(processes, isNotRunning, self.startProcess,
+                                    force=False, proc_type=proc_type, wait=wait)
 
         startall.delay = 0.05
         startall.rpcinterface = self
@@ -435,29 +541,36 @@ class AdminServiceNamespaceRPCInterface:
 
         self.adminserviced.reap()
 
-        if wait and process.get_state() not in ALL_STOPPED_STATES:
+        if wait and (process.get_state() not in ALL_STOPPED_STATES or
+                     process.stop_script_pending):
 
             def onwait():
                 # process will eventually enter a stopped state by
                 # virtue of the adminserviced.reap() method being called
-                # during normal operations
+                # during normal operations, and its stop scripts will
+                # finish as the main loop reaps them
                 process.stop_report()
-                if process.get_state() not in ALL_STOPPED_STATES:
+                if (process.get_state() not in ALL_STOPPED_STATES or
+                    process.stop_script_pending):
                     return NOT_DONE_YET
                 return True
 
-            onwait.delay = 0
+            onwait.delay = 0.05
             onwait.rpcinterface = self
             return onwait # deferred
 
         return True
 
     def updateProcessGroup(self, name, wait=True):
-        """ Stop all processes in the process group named 'name'
+        """ Apply the reread configuration of the process group named
+        'name'.  Only processes whose configuration changed are touched:
+        they are stopped, given their new configuration and started again
+        if they were running.  Added processes are created and removed
+        ones stopped and dropped; the rest keep running as they are.
 
         @param string name     The group name
-        @param boolean wait    Wait for each process to be fully stopped
-        @return array result   An array of process status info structs
+        @param boolean wait    Wait for changed processes to be replaced
+        @return array result   Names of the added and changed processes
         """
         self._update('updateProcessGroup')
 
@@ -481,6 +594,26 @@ class AdminServiceNamespaceRPCInterface:
             self.adminserviced.remove_process_group(group)
             return
         
+        if group.update_in_place:
+            added, changed, removed = group.update(config)
+            self.adminserviced.options.logger.info(
+                'updated %s: added %s, changed %s, removed %s'
+                % (name, added, changed, removed))
+            names = added + changed
+            names.sort()
+            if not wait or not group.pending_updates:
+                return names
+
+            def onwait():
+                if (group.pending_updates and
+                    self.adminserviced.process_groups.get(name) is group):
+                    return NOT_DONE_YET
+                return names
+
+            onwait.delay = 0.05
+            onwait.rpcinterface = self
+            return onwait # deferred
+
         oldProcs = group.processes.values()
         oldProcs.sort()
         oldProcs.reverse()
@@ -492,8 +625,10 @@ class AdminServiceNamespaceRPCInterface:
                 self.stopProcess(proc.config.name, wait, process=proc)
 
         # Save the new config and return the current process names
+        group.before_remove()
         config.after_setuid()
         self.adminserviced.process_groups[name] = config.make_group()
+        self.adminserviced.options.dispatchers_changed()
         procs = self.adminserviced.process_groups[name].processes.values()
         procs.sort()
         return [ proc.config.name for proc in procs ]
@@ -534,8 +669,14 @@ class AdminServiceNamespaceRPCInterface:
 
         processes = self._getAllProcesses(reverse=True)
 
-        killall = make_allfunc(processes, isRunning, self.stopProcess,
-                               proc_type=proc_type, wait=wait, filter_string="already stopped")
+        if wait:
+            # groups sharing a priority are stopped side by side, one
+            # priority after another
+            killall = make_tiered_stopfunc(processes, self,
+                                           proc_type=proc_type)
+        else:
+            killall = make_allfunc(processes, isRunning, self.stopProcess,
+                                   proc_type=proc_type, wait=wait, filter_string="already stopped")
 
         killall.delay = 0.05
         killall.rpcinterface = self
@@ -623,14 +764,23 @@ class AdminServiceNamespaceRPCInterface:
             group_name, process_name = split_namespec(name)
             return self.queryProcessGroup(group_name)
 
-        if process.config.query_script is not None:
-            output = process.query()
-        else:
-            output = "%s is in the %s state" % (name, getProcessStateDescription(process.get_state()))
+        if process.config.query_script is None:
+            return "%s is in the %s state" % (name, getProcessStateDescription(process.get_state()))
 
-        return output
+        job = process.query()
 
-    def queryProcessGroup(self, name, proc_type):
+        def onquery():
+            if not job.done:
+                return NOT_DONE_YET
+            if job.exitcode is None:
+                return "Error running query"
+            return job.output
+
+        onquery.delay = 0.05
+        onquery.rpcinterface = self
+        return onquery # deferred
+
+    def queryProcessGroup(self, name, proc_type=''):
         """ Query all processes in the group named 'name'
 
         @param string name      The group name
@@ -650,7 +800,9 @@ class AdminServiceNamespaceRPCInterface:
 
         queryall = make_allfunc(processes, alwaysTrue, self.queryProcess, proc_type=proc_type)
 
-        return queryall()
+        queryall.delay = 0.05
+        queryall.rpcinterface = self
+        return queryall # deferred
 
     def queryAllProcesses(self, proc_type=''):
         """ Query all processes listed in the configuration file
@@ -816,6 +968,7 @@ class AdminServiceNamespaceRPCInterface:
         if logfile is None or not os.path.exists(logfile):
             raise RPCError(Faults.NO_FILE, logfile)
 
+        self.adminserviced.options.child_log_batcher.flush()
         try:
             return readFile(logfile, int(offset), int(length))
         except ValueError, inst:
@@ -857,6 +1010,7 @@ class AdminServiceNamespaceRPCInterface:
         if logfile is None or not os.path.exists(logfile):
             return ['', 0, False]
 
+        self.adminserviced.options.child_log_batcher.flush()
         return tailFile(logfile, int(offset), int(length))
 
     def tailProcessStdoutLog(self, name, offset, length):
@@ -1107,12 +1261,13 @@ def make_allfunc(processes, predicate, func, **extra_kwargs):
                 callbacks.remove(struct)
             else:
                 if value is not NOT_DONE_YET:
-                    results.append(
-                        {'name':process.config.name,
-                         'group':group.config.name,
-                         'status':Faults.SUCCESS,
-                         'description':'OK'}
-                        )
+                    ret = {'name':process.config.name,
+                           'group':group.config.name,
+                           'status':Faults.SUCCESS,
+                           'description':'OK'}
+                    if isinstance(value, basestring):
+                        ret['output'] = value
+                    results.append(ret)
                     callbacks.remove(struct)
 
         if callbacks:
@@ -1175,10 +1330,6 @@ def make_startallfunc(processes, predicate, func, **extra_kwargs):
                                         'description':'%s is disabled' % (process.config.name)})
                         continue
 
-                    # Remove the pid file, use its existence to check if the process has started
-                    if process.config.pid_file and os.path.exists(process.config.pid_file) and not process.config.check_status():
-                        os.remove(process.config.pid_file)
-    
                     try:
                         if last_state is not None:
                             timed_out = wait_transition(last_state[0], last_state[1], process)
@@ -1248,6 +1399,161 @@ def make_startallfunc(processes, predicate, func, **extra_kwargs):
 
     return startallfunc
 
+def make_dependency_startfunc(processes, scheduler, **extra_kwargs):
+    """ Return a closure that hands every process to the startup scheduler,
+    which starts each one once its dependencies are running, and returns a
+    result when they have all started or failed """
+
+    pending = []
+    results = []
+    requested = []
+
+    def startfunc(
+        processes=processes,
+        scheduler=scheduler,
+        extra_kwargs=extra_kwargs,
+        pending=pending, # used only to fool scoping, never passed by caller
+        results=results, # used only to fool scoping, never passed by caller
+        requested=requested, # used only to fool scoping, never passed by caller
+        ):
+
+        if not requested:
+            requested.append(True)
+            force = boolean(extra_kwargs['force'])
+            proc_type = extra_kwargs['proc_type']
+
+            for group, process in processes:
+                if len(proc_type) != 0 and not proc_type.startswith(process.config.config_type):
+                    continue
+
+                result = {'name':process.config.name,
+                          'group':group.config.name}
+                if not isNotRunning(process):
+                    result.update(status=Faults.ALREADY_STARTED, description='OK')
+                elif not force and not process.config.is_enabled():
+                    result.update(status=Faults.DISABLED,
+                                  description='%s is disabled' % (process.config.name))
+                else:
+                    try:
+                        process.get_execv_args()
+                    except NotFound, why:
+                        result.update(status=Faults.NO_FILE, description=why.args[0])
+                    except (NotExecutable, NoPermission), why:
+                        result.update(status=Faults.NOT_EXECUTABLE, description=why.args[0])
+                    else:
+                        if process.state == ProcessStates.DISABLED:
+                            process.change_state(ProcessStates.STOPPED)
+                        scheduler.request(process)
+                        pending.append((group, process))
+                        continue
+                results.append(result)
+
+            if not extra_kwargs['wait']:
+                for group, process in pending:
+                    results.append({'name':process.config.name,
+                                    'group':group.config.name,
+                                    'status':Faults.SUCCESS,
+                                    'description':'OK'})
+                del pending[:]
+
+        waiting = []
+        for group, process in pending:
+            state = process.get_state()
+            if state == ProcessStates.RUNNING:
+                results.append({'name':process.config.name,
+                                'group':group.config.name,
+                                'status':Faults.SUCCESS,
+                                'description':'OK'})
+            elif (scheduler.is_requested(process) or
+                  state in (ProcessStates.STARTING, ProcessStates.BACKOFF)):
+                waiting.append((group, process))
+            elif process.spawnerr:
+                results.append({'name':process.config.name,
+                                'group':group.config.name,
+                                'status':Faults.SPAWN_ERROR,
+                                'description':process.spawnerr})
+            else:
+                results.append({'name':process.config.name,
+                                'group':group.config.name,
+                                'status':Faults.ABNORMAL_TERMINATION,
+                                'description':'%s is %s' % (process.config.name,
+                                    getProcessStateDescription(state))})
+        # processes compare by priority, so keep the list instead of removing from it
+        pending[:] = waiting
+
+        if pending:
+            return NOT_DONE_YET
+
+        return results
+
+    return startfunc
+
+def make_tiered_stopfunc(processes, rpcinterface, **extra_kwargs):
+    """ Return a closure that stops the processes a priority tier at a
+    time with a TieredStop, and returns a result when they have all
+    stopped """
+
+    results = []
+    stops = []
+
+    def stopfunc(
+        processes=processes,
+        rpcinterface=rpcinterface,
+        extra_kwargs=extra_kwargs,
+        results=results, # used only to fool scoping, never passed by caller
+        stops=stops, # used only to fool scoping, never passed by caller
+        ):
+
+        if not stops:
+            proc_type = extra_kwargs['proc_type']
+            members = []
+            for group, process in processes:
+                if len(proc_type) != 0 and not proc_type.startswith(process.config.config_type):
+                    continue
+                if isRunning(process):
+                    members.append((group, process))
+                else:
+                    results.append({'name':process.config.name,
+                                    'group':group.config.name,
+                                    'status':Faults.NOT_RUNNING,
+                                    'description':'OK'})
+            failed = {}
+
+            def stop(group, process):
+                name = make_namespec(group.config.name, process.config.name)
+                try:
+                    rpcinterface.stopProcess(name, wait=False)
+                except RPCError, e:
+                    failed[id(process)] = e
+                    if e.code != Faults.NOT_RUNNING:
+                        return e.text
+
+            options = rpcinterface.adminserviced.options
+            stops.append((TieredStop(options, 'stopAllProcesses', members,
+                                     stop=stop), members, failed))
+
+        tiered, members, failed = stops[0]
+        if not tiered.step():
+            return NOT_DONE_YET
+
+        if members:
+            for group, process in members:
+                e = failed.get(id(process))
+                if e is None:
+                    results.append({'name':process.config.name,
+                                    'group':group.config.name,
+                                    'status':Faults.SUCCESS,
+                                    'description':'OK'})
+                else:
+                    results.append({'name':process.config.name,
+                                    'group':group.config.name,
+                                    'status':e.code,
+                                    'description':e.text})
+            del members[:]
+        return results
+
+    return stopfunc
+
 def wait_transition(last_state, last_proc, new_proc):
     new_proc.config.options.logger.trace("RPC - %s - Last state: %s   wait: %r" % (new_proc.config.name, last_state, new_proc.config.waitforprevious))
     # The only states we want to start from: DISABLED(force was set true in the start proc), STOPPED or EXITED
@@ -0,0 +1,252 @@
+import os
+import re
+import time
+import errno
+import signal
+import tempfile
+
+class ScriptJob:
+    """ A script run by the ScriptRunner.  Behaves like a Subprocess as far
+    as reap() is concerned: it sits in options.pidhistory while it runs and
+    is finished with its wait status when it exits. """
+
+    pid = 0 # pid of the shell running the script; 0 when not running
+    done = False # true once the script has exited (or failed to start)
+    exitcode = None # exit code of the script, None if it couldn't be run
+    output = '' # captured stdout followed by stderr, if capture was asked for
+    timed_out = False # true if the script was killed for running too long
+    deadline = None # time after which the script is killed
+
+    def __init__(self, runner, key, command, timeout, ttl, capture, preexec_fn):
+        self.runner = runner
+        self.key = key
+        self.command = command
+        self.timeout = timeout
+        self.ttl = ttl
+        self.capture = capture
+        self.preexec_fn = preexec_fn
+        self.callbacks = []
+        self.files = []
+
+    def ok(self):
+        """ True if the script ran and exited with status 0 """
+        return self.exitcode == 0
+
+    def add_callback(self, callback):
+        if callback is None:
+            return
+        if self.done:
+            self.runner.call(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self, pid, sts):
+        """ The script was reaped """
+        from adminservice.options import decode_wait_status
+        es, msg = decode_wait_status(sts)
+        if self.timed_out:
+            self.exitcode = None
+        else:
+            self.exitcode = es
+        self.runner.job_finished(self)
+
+# names of the files in a directory run-parts runs
+RUN_PARTS_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def list_parts(path):
+    """ Return the scripts run-parts would run from directory path, in
+    the order it would run them """
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    names.sort()
+    parts = []
+    for name in names:
+        if not RUN_PARTS_NAME.match(name):
+            continue
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            parts.append(filename)
+    return parts
+
+class ScriptRunner:
+    """ Runs status, started status, query and stop scripts without
+    blocking the main loop.
+
+    Each script is run by /bin/sh in a forked child and reaped by the main
+    loop like any other child, so results come back through callbacks.  At
+    most pool_size scripts run at once, the rest wait in a queue.  Scripts
+    that run longer than their timeout are killed, and results are kept
+    for ttl seconds so repeated checks of the same process don't rerun
+    its script.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.queue = [] # jobs waiting for a free slot
+        self.running = {} # pid -> job
+        self.pending = {} # key -> queued or running job
+        self.cache = {} # key -> (expiry time, finished job)
+
+    def get_pool_size(self):
+        return max(1, self.options.script_pool_size)
+
+    def run(self, key, command, callback=None, timeout=None, ttl=None,
+            capture=False, preexec_fn=None):
+        """ Run command for key (usually a (kind, process) tuple) and call
+        callback with the finished ScriptJob.  If a result for key is still
+        fresh, or a run for key is already underway, no new script is run.
+        Returns the job. """
+        if timeout is None:
+            timeout = self.options.script_timeout
+        if ttl is None:
+            ttl = self.options.script_cache_ttl
+
+        now = time.time()
+        cached = self.cache.get(key)
+        if cached is not None:
+            expires, job = cached
+            if now < expires and job.command == command:
+                job.add_callback(callback)
+                return job
+            del self.cache[key]
+
+        job = self.pending.get(key)
+        if job is None or job.command != command:
+            job = ScriptJob(self, key, command, timeout, ttl, capture,
+                            preexec_fn)
+            self.pending[key] = job
+            self.queue.append(job)
+        job.add_callback(callback)
+        self.start_queued()
+        return job
+
+    def run_all(self, key, commands, callback=None, timeout=None):
+        """ Run commands one after another, without caching their results,
+        and call callback with the list of finished ScriptJobs once the
+        last one is done """
+        commands = list(commands)
+        jobs = []
+
+        def run_next(job=None):
+            if job is not None:
+                jobs.append(job)
+            if commands:
+                self.run(key + (len(jobs),), commands.pop(0), run_next,
+                         timeout=timeout, ttl=0)
+            elif callback is not None:
+                callback(jobs)
+
+        run_next()
+
+    def invalidate(self, key):
+        """ Forget any cached result for key """
+        if self.cache.has_key(key):
+            del self.cache[key]
+
+    def start_queued(self):
+        while self.queue and len(self.running) < self.get_pool_size():
+            self.start(self.queue.pop(0))
+
+    def start(self, job):
+        options = self.options
+        try:
+            if job.capture:
+                job.files = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+            pid = options.fork()
+        except (OSError, IOError), why:
+            code = errno.errorcode.get(why.args[0], why.args[0])
+            options.logger.warn('unable to run script %r: %s'
+                                % (job.command, code))
+            self.job_finished(job)
+            return
+
+        if pid != 0:
+            job.pid = pid
+            if job.timeout:
+                job.deadline = time.time() + job.timeout
+            self.running[pid] = job
+            options.pidhistory[pid] = job
+            options.logger.blather('running script %r with pid %s'
+                                   % (job.command, pid))
+            return
+
+        # child
+        try:
+            options.setpgrp()
+            devnull = os.open('/dev/null', os.O_RDWR)
+            options.dup2(devnull, 0)
+            if job.capture:
+                options.dup2(job.files[0].fileno(), 1)
+                options.dup2(job.files[1].fileno(), 2)
+            else:
+                options.dup2(devnull, 1)
+                options.dup2(devnull, 2)
+            options.close_fds(3)
+            if job.preexec_fn is not None:
+                msg = job.preexec_fn()
+                if msg:
+                    options.write(2, "adminservice: %s\n" % msg)
+                    return
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            options.execve('/bin/sh', ['/bin/sh', '-c', job.command],
+                           os.environ)
+        finally:
+            options._exit(127)
+
+    def check(self, now=None):
+        """ Called from the main loop; kills scripts that are past their
+        deadline and starts queued ones """
+        if now is None:
+            now = time.time()
+        for pid, job in self.running.items():
+            if job.deadline is not None and now > job.deadline and not job.timed_out:
+                self.options.logger.warn(
+                    'script %r (pid %s) timed out after %s seconds, killing it'
+                    % (job.command, pid, job.timeout))
+                job.timed_out = True
+                try:
+                    self.options.kill(-pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.start_queued()
+
+    def job_finished(self, job):
+        if self.running.has_key(job.pid):
+            del self.running[job.pid]
+        if self.pending.get(job.key) is job:
+            del self.pending[job.key]
+
+        if job.files:
+            output = []
+            for f in job.files:
+                f.seek(0)
+                output.append(f.read())
+                f.close()
+            job.output = ''.join(output)
+            job.files = []
+
+        job.done = True
+        if job.ttl and not job.timed_out and job.exitcode is not None:
+            self.cache[job.key] = (time.time() + job.ttl, job)
+
+        callbacks, job.callbacks = job.callbacks, []
+        for callback in callbacks:
+            self.call(callback, job)
+        self.start_queued()
+
+    def call(self, callback, job):
+        try:
+            callback(job)
+        except:
+            import traceback
+            self.options.logger.critical(
+                'error in callback for script %r:\n%s'
+                % (job.command, traceback.format_exc()))
+
+    def get_running_count(self):
+        return len(self.running)
+
+    def get_queued_count(self):
+        return len(self.queue)
@@ -0,0 +1,149 @@
+import time
+
+from adminservice.states import ProcessStates
+from adminservice.states import ALL_STOPPED_STATES
+from adminservice.states import getProcessStateDescription
+
+def stop_process(group, process):
+    """ Ask process to stop the way ProcessGroup.stop_all() does; return
+    an error message if it couldn't be signalled """
+    state = process.get_state()
+    if state in (ProcessStates.RUNNING, ProcessStates.STARTING):
+        # RUNNING/STARTING -> STOPPING
+        return process.stop()
+    elif state == ProcessStates.BACKOFF:
+        # BACKOFF -> FATAL
+        process.give_up()
+
+class TieredStop:
+    """ Stops processes a priority tier at a time.
+
+    The processes are split into tiers by priority and the tiers are
+    stopped highest priority first, so the waveforms of every domain go
+    down together, then the nodes, then the domain managers.  Every
+    process in a tier is asked to stop at once, whatever its group, so
+    their stop signals, stop scripts and SIGKILL escalations after
+    stopwaitsecs overlap; the next tier isn't touched until everything in
+    the current one has stopped.
+
+    How long each process took to stop and whether it had to be killed
+    after stopwaitsecs is recorded in a report, which is logged as each
+    tier finishes and kept in options.stop_reports.
+    """
+
+    reports_kept = 10 # reports kept in options.stop_reports
+
+    def __init__(self, options, reason, members, stop=stop_process):
+        """ members is a list of (group, process) to stop; stop is
+        called with each of them and returns an error message if the
+        process couldn't be asked to stop """
+        self.options = options
+        self.stop = stop
+        tiers = {}
+        for group, process in members:
+            tiers.setdefault(process.config.priority, []).append((group, process))
+        priorities = tiers.keys()
+        priorities.sort()
+        priorities.reverse()
+        self.tiers = [ (priority, tiers[priority]) for priority in priorities ]
+        self.current = None # (members, report) of the tier being stopped
+        self.report = {'reason': reason,
+                       'start': time.time(),
+                       'end': 0.0,
+                       'tiers': [],
+                       }
+
+    def step(self):
+        """ Move the stop along; return True once everything is stopped """
+        while True:
+            if self.current is None:
+                if not self.tiers:
+                    self.finish()
+                    return True
+                self.begin_tier()
+            if not self.update():
+                return False
+            self.end_tier()
+
+    def begin_tier(self):
+        priority, members = self.tiers.pop(0)
+        now = time.time()
+        groups = []
+        processes = []
+        for group, process in members:
+            if group.config.name not in groups:
+                groups.append(group.config.name)
+            processes.append({'name': process.config.name,
+                              'group': group.config.name,
+                              'stopwaitsecs': process.config.stopwaitsecs,
+                              'requested': now,
+                              'stopped': 0.0,
+                              'duration': 0.0,
+                              'killed': False,
+                              'state': '',
+                              })
+        tier = {'priority': priority,
+                'groups': groups,
+                'start': now,
+                'end': 0.0,
+                'processes': processes,
+                }
+        self.report['tiers'].append(tier)
+        self.current = (members, tier)
+        self.options.logger.info('stopping priority %s: %s'
+                                 % (priority, ', '.join(groups)))
+        for (group, process), info in zip(members, processes):
+            process.stop_escalated = False
+            msg = self.stop(group, process)
+            if msg is not None:
+                # it won't stop by itself, don't wait on it
+                info['stopped'] = now
+                info['state'] = getProcessStateDescription(process.get_state())
+                self.options.logger.warn('could not stop %s: %s'
+                                         % (process.config.name, msg))
+
+    def update(self):
+        """ Note which processes of the current tier have stopped; return
+        True if all of them have """
+        members, tier = self.current
+        now = time.time()
+        done = True
+        for (group, process), info in zip(members, tier['processes']):
+            if info['stopped']:
+                continue
+            if (process.get_state() not in ALL_STOPPED_STATES or
+                process.stop_script_pending):
+                done = False
+                continue
+            info['stopped'] = now
+            info['duration'] = now - info['requested']
+            info['killed'] = bool(process.stop_escalated)
+            info['state'] = getProcessStateDescription(process.get_state())
+        return done
+
+    def end_tier(self):
+        members, tier = self.current
+        self.current = None
+        tier['end'] = time.time()
+        logger = self.options.logger
+        slowest = None
+        for info in tier['processes']:
+            if info['killed']:
+                logger.warn('%s had to be killed after stopwaitsecs (%s secs)'
+                            % (info['name'], info['stopwaitsecs']))
+            if slowest is None or info['duration'] > slowest['duration']:
+                slowest = info
+        msg = 'stopped priority %s in %.1f secs' % (tier['priority'],
+                                                   tier['end'] - tier['start'])
+        if slowest is not None:
+            msg += ', slowest was %s (%.1f of %s stopwaitsecs)' % (
+                slowest['name'], slowest['duration'], slowest['stopwaitsecs'])
+        logger.info(msg)
+
+    def finish(self):
+        if self.report['end']:
+            return
+        self.report['end'] = time.time()
+        reports = self.options.stop_reports
+        reports.append(self.report)
+        del reports[:-self.reports_kept]
@@ -0,0 +1,239 @@
+import time
+
+from adminservice.states import ProcessStates
+from adminservice.states import AdminServiceStates
+from adminservice.states import getProcessStateDescription
+
+# dependency states, as returned by StartupScheduler.check_dependencies
+READY = 'ready'
+WAITING = 'waiting'
+FAILED = 'failed'
+
+class StartupScheduler:
+    """ Starts processes as soon as the processes they depend on are
+    RUNNING, instead of one after another in priority order.
+
+    A process depends on the processes named by its depends_on option,
+    either by name within its own group or as group:name (group:* for a
+    whole group).  On top of those, a node depends on the domain manager
+    of its DOMAIN_NAME, and a waveform on its domain manager and on the
+    nodes it names in depends_on, or every node of the domain if it names
+    none.
+
+    When dependency_startup is enabled, ProcessGroup.transition asks the
+    scheduler before spawning anything.  A process whose dependencies are
+    all RUNNING (or DISABLED) may start if fewer than startup_parallelism
+    processes it let start are still STARTING.  A process with a
+    dependency still on its way up waits, for up to waitforprevious
+    seconds (max_wait if waitforprevious is None); if the wait runs out
+    or a dependency settles in some other state, the process is marked
+    FATAL when failafterwait is set and is started anyway otherwise.
+    Groups that had to wait are woken whenever a process changes state,
+    so unrelated domains and their nodes start side by side.
+    """
+
+    max_wait = 300 # seconds to wait for dependencies with no waitforprevious
+
+    def __init__(self, options):
+        self.options = options
+        self.groups = {} # group name -> ProcessGroup
+        self.dependencies = {} # id(Subprocess) -> [Subprocess], resolved lazily
+        self.starting = {} # id(Subprocess) -> Subprocess we let start that is still STARTING
+        self.waiting = {} # id(group) -> group with a process waiting to start
+        self.requested = {} # id(Subprocess) -> Subprocess asked to start over RPC
+
+    def is_enabled(self):
+        return bool(self.options.dependency_startup)
+
+    def register(self, group):
+        self.groups[group.config.name] = group
+        self.dependencies = {}
+
+    def unregister(self, group):
+        if self.groups.get(group.config.name) is group:
+            del self.groups[group.config.name]
+        for process in group.processes.values():
+            self.forget(process)
+        self.waiting.pop(id(group), None)
+
+    def forget(self, process):
+        """ Drop process, which has been replaced or removed """
+        self.starting.pop(id(process), None)
+        self.requested.pop(id(process), None)
+        self.dependencies = {}
+
+    def request(self, process):
+        """ Start process once its dependencies allow it, even if it has
+        been started before or doesn't autostart """
+        self.requested[id(process)] = process
+        self.options.timers.wake(process.group)
+
+    def is_requested(self, process):
+        return self.requested.has_key(id(process))
+
+    def cancel_request(self, process):
+        self.requested.pop(id(process), None)
+
+    def get_dependencies(self, process):
+        deps = self.dependencies.get(id(process))
+        if deps is None:
+            deps = self.resolve(process)
+            self.dependencies[id(process)] = deps
+        return deps
+
+    def resolve(self, process):
+        config = process.config
+        group = process.group
+        logger = config.options.logger
+        deps = []
+        seen = {id(process): True} # Subprocesses compare by priority, not identity
+        names = getattr(config, 'depends_on', None) or []
+
+        def add(dep):
+            if not seen.has_key(id(dep)):
+                seen[id(dep)] = True
+                deps.append(dep)
+
+        for name in names:
+            if ':' in name:
+                group_name, process_name = name.split(':', 1)
+                if process_name in ('', '*'):
+                    process_name = None
+                dep_group = self.groups.get(group_name)
+            else:
+                dep_group, process_name = group, name
+            if dep_group is None:
+                logger.warn('%s depends on %s, which is not a known group'
+                            % (config.name, name))
+            elif process_name is None:
+                for dep in dep_group.processes.values():
+                    add(dep)
+            elif dep_group.processes.has_key(process_name):
+                add(dep_group.processes[process_name])
+            else:
+                logger.warn('%s depends on %s, which is not a known process'
+                            % (config.name, name))
+
+        if group is not None and config.config_type in ('node', 'waveform'):
+            members = group.processes.values()
+            for dep in members:
+                if dep.config.config_type == 'domain':
+                    add(dep)
+            if config.config_type == 'waveform':
+                if not [ dep for dep in deps if dep.config.config_type == 'node' ]:
+                    for dep in members:
+                        if dep.config.config_type == 'node':
+                            add(dep)
+        deps.sort()
+        return deps
+
+    def check_dependencies(self, process, now):
+        """ Return READY if all of process' dependencies are up, WAITING if
+        some are still coming up and it should wait for them, or FAILED """
+        pending = []
+        settled = None
+        for dep in self.get_dependencies(process):
+            state = dep.get_state()
+            if state in (ProcessStates.RUNNING, ProcessStates.DISABLED):
+                continue
+            if (state in (ProcessStates.STARTING, ProcessStates.BACKOFF) or
+                dep.status_pending or dep.should_spawn(now) or
+                self.is_requested(dep)):
+                pending.append(dep)
+            else:
+                settled = dep
+                break
+
+        if settled is None and not pending:
+            process.wait_deadline = None
+            return READY
+
+        logger = self.options.logger
+        if settled is None:
+            if process.wait_deadline is None:
+                waitforprevious = process.config.waitforprevious
+                if waitforprevious is None:
+                    waitforprevious = self.max_wait
+                process.wait_deadline = now + waitforprevious
+                logger.info('%s is waiting up to %s seconds for %s to start'
+                            % (process.config.name, waitforprevious,
+                               pending[0].config.name))
+            if now < process.wait_deadline:
+                logger.trace('%s is waiting for %s to start'
+                             % (process.config.name, pending[0].config.name))
+                return WAITING
+            logger.warn('%s gave up waiting for %s to start'
+                        % (process.config.name, pending[0].config.name))
+        else:
+            logger.debug('%s depends on %s, which is %s'
+                         % (process.config.name, settled.config.name,
+                            getProcessStateDescription(settled.get_state())))
+        process.wait_deadline = None
+        return FAILED
+
+    def has_slot(self):
+        limit = self.options.startup_parallelism
+        return not limit or len(self.starting) < limit
+
+    def transition(self, group):
+        """ Transition the processes of group, spawning those whose turn
+        it is """
+        options = self.options
+        logger = options.logger
+        now = time.time()
+        self.waiting.pop(id(group), None)
+        processes = group.processes.values()
+        processes.sort()
+
+        for process in processes:
+            requested = self.is_requested(process)
+            if options.mood <= AdminServiceStates.RESTARTING:
+                # nothing is started while shutting down
+                process.transition()
+                continue
+            if requested and process.get_state() not in (
+                ProcessStates.STOPPED, ProcessStates.EXITED,
+                ProcessStates.FATAL):
+                # it is already on its way up, was stopped from starting,
+                # or is in a state spawn() can't start it from
+                self.cancel_request(process)
+                requested = False
+            if not requested and not process.should_spawn(now):
+                process.transition()
+                continue
+
+            if process.get_state() != ProcessStates.BACKOFF:
+                ready = self.check_dependencies(process, now)
+                if ready == WAITING:
+                    self.waiting[id(group)] = group
+                    continue
+                if ready == FAILED and process.config.failafterwait:
+                    self.cancel_request(process)
+                    logger.info('%s is not starting, its dependencies did not start'
+                                % process.config.name)
+                    if process.get_state() != ProcessStates.FATAL:
+                        process.change_state(ProcessStates.FATAL)
+                    continue
+
+            if not self.has_slot():
+                self.waiting[id(group)] = group
+                continue
+
+            if requested:
+                if not options.spawn_admission.admit(process, now):
+                    # its turn comes when it gets to the head of the queue
+                    continue
+                self.cancel_request(process)
+                process.spawn()
+            else:
+                process.transition()
+            if process.get_state() == ProcessStates.STARTING:
+                self.starting[id(process)] = process
+
+    def state_changed(self, process, old_state, new_state):
+        if old_state == ProcessStates.STARTING:
+            self.starting.pop(id(process), None)
+        if self.waiting:
+            waiting, self.waiting = self.waiting, {}
+            for group in waiting.values():
+                self.options.timers.wake(group)
@@ -0,0 +1,236 @@
+import collections
+import time
+
+from adminservice.states import ProcessStates
+from adminservice.states import getProcessStateDescription
+
+class StartupTimeline:
+    """ Records where the time goes when processes start.
+
+    Each spawn of a process is an attempt, made of spans:
+
+    - admission: waiting in the spawn admission queue
+    - fork: making the dispatchers and forking
+    - status_check, daemonize, pre_script, pid_file, started_status and
+      status: the steps of a run_detached launcher, reported back by the
+      launcher over a pipe when it exits
+    - running: from the spawn (or the launcher's exit) until the process
+      was promoted to RUNNING after startsecs
+    - start: the whole attempt, ending in RUNNING or whatever state it
+      fell into instead
+
+    Only the last size spans are kept.  The critical
+    path is worked out from the last attempt of each process that reached
+    RUNNING: starting from the one that got there last, each step goes
+    back to the predecessor (a dependency with dependency_startup, the
+    previous process in the group otherwise) that was last to be RUNNING
+    before the attempt began.
+    """
+
+    size = 10000 # spans kept
+
+    def __init__(self, options):
+        self.options = options
+        self.spans = collections.deque(maxlen=self.size)
+        self.attempts = {} # id(Subprocess) -> its latest attempt
+        self.admissions = {} # id(Subprocess) -> (time queued, time admitted)
+        self.started = {} # id(Subprocess) -> (Subprocess, last attempt that reached RUNNING)
+        self.sequence = 0
+        self.since = time.time()
+
+    def admitted(self, process, queued, now):
+        self.admissions[id(process)] = (queued, now)
+
+    def begin(self, process, now):
+        """ process is being spawned """
+        self.sequence += 1
+        attempt = {'attempt': self.sequence,
+                   'begin': now,
+                   'spawned': now,
+                   'launched': None,
+                   'running': None,
+                   'spans': [],
+                   }
+        self.attempts[id(process)] = attempt
+        admission = self.admissions.pop(id(process), None)
+        if admission is not None:
+            queued, admitted = admission
+            if queued < admitted <= now:
+                attempt['begin'] = queued
+                self.span(process, 'admission', queued, admitted)
+        return attempt
+
+    def span(self, process, name, start, end):
+        """ Add a span to process' latest attempt and return it """
+        attempt = self.attempts.get(id(process))
+        if attempt is None:
+            return
+        group = process.group
+        span = {'process': process.config.name,
+                'group': group is not None and group.config.name or '',
+                'attempt': attempt['attempt'],
+                'name': name,
+                'start': start,
+                'end': max(start, end),
+                }
+        attempt['spans'].append(span)
+        self.spans.append(span)
+        return span
+
+    def launcher_finished(self, process, report, now):
+        """ The run_detached launcher exited; report holds the lines it
+        wrote, "name start end" each """
+        attempt = self.attempts.get(id(process))
+        if attempt is None:
+            return
+        attempt['launched'] = now
+        for line in report.splitlines():
+            try:
+                name, start, end = line.split()
+                self.span(process, name, float(start), float(end))
+            except ValueError:
+                continue
+
+    def state_changed(self, process, old_state, new_state):
+        if old_state != ProcessStates.STARTING:
+            return
+        attempt = self.attempts.get(id(process))
+        if attempt is None or attempt['running'] is not None:
+            return
+        now = time.time()
+        if new_state == ProcessStates.RUNNING:
+            attempt['running'] = now
+            self.span(process, 'running', attempt['launched'] or attempt['spawned'], now)
+            self.started[id(process)] = (process, attempt)
+        span = self.span(process, 'start', attempt['begin'], now)
+        span['outcome'] = getProcessStateDescription(new_state)
+
+    def forget(self, process):
+        for mapping in (self.attempts, self.admissions, self.started):
+            mapping.pop(id(process), None)
+
+    def get_predecessors(self, process):
+        """ The processes process waits for before it is started """
+        scheduler = self.options.startup_scheduler
+        if scheduler.is_enabled():
+            return scheduler.get_dependencies(process)
+        group = process.group
+        if group is None:
+            return []
+        procs = group.processes.values()
+        procs.sort()
+        previous = []
+        for proc in procs:
+            if proc is process:
+                break
+            if proc.get_state() != ProcessStates.DISABLED:
+                previous = [proc]
+        return previous
+
+    def get_critical_path(self):
+        """ Return the chain of attempts that decided when the last process
+        to start reached RUNNING, first one first """
+        if not self.started:
+            return []
+        latest = None
+        for process, attempt in self.started.values():
+            if latest is None or attempt['running'] > latest[1]['running']:
+                latest = (process, attempt)
+
+        path = []
+        seen = {}
+        while latest is not None and not seen.has_key(id(latest[0])):
+            seen[id(latest[0])] = True
+            process, attempt = latest
+            latest = None
+            for dep in self.get_predecessors(process):
+                entry = self.started.get(id(dep))
+                if entry is None or entry[1]['running'] > attempt['begin']:
+                    continue
+                if latest is None or entry[1]['running'] > latest[1]['running']:
+                    latest = entry
+
+            phases = []
+            for span in attempt['spans']:
+                if span['name'] != 'start':
+                    phases.append({'name': span['name'],
+                                   'duration': span['end'] - span['start']})
+            group = process.group
+            step = {'process': process.config.name,
+                    'group': group is not None and group.config.name or '',
+                    'attempt': attempt['attempt'],
+                    'begin': attempt['begin'],
+                    'running': attempt['running'],
+                    'duration': attempt['running'] - attempt['begin'],
+                    'waited': 0.0,
+                    'phases': phases,
+                    }
+            if latest is not None:
+                # time between the predecessor running and this starting
+                step['waited'] = attempt['begin'] - latest[1]['running']
+            path.append(step)
+        path.reverse()
+        return path
+
+    def get_info(self):
+        return {'since': self.since,
+                'spans': list(self.spans),
+                'critical_path': self.get_critical_path(),
+                }
+
+def to_chrome_trace(info):
+    """ Convert getStartupTimeline() output to the Chrome trace event
+    format (load it in chrome://tracing or Perfetto).  Each group is shown
+    as a process and each of its processes as a thread; the critical path
+    gets a process of its own. """
+    events = []
+    pids = {}
+    tids = {}
+
+    def ids(group, process):
+        if not pids.has_key(group):
+            pids[group] = len(pids) + 1
+            events.append({'name': 'process_name', 'ph': 'M',
+                           'pid': pids[group], 'tid': 0,
+                           'args': {'name': group or '(no group)'}})
+        key = (group, process)
+        if not tids.has_key(key):
+            tids[key] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': pids[group], 'tid': tids[key],
+                           'args': {'name': process}})
+        return pids[group], tids[key]
+
+    for span in info['spans']:
+        pid, tid = ids(span['group'], span['process'])
+        events.append({'name': span['name'],
+                       'cat': 'startup',
+                       'ph': 'X',
+                       'ts': span['start'] * 1e6,
+                       'dur': (span['end'] - span['start']) * 1e6,
+                       'pid': pid,
+                       'tid': tid,
+                       'args': {'attempt': span['attempt'],
+                                'outcome': span.get('outcome', '')}})
+
+    path = info.get('critical_path') or []
+    if path:
+        pid = len(pids) + 1
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'tid': 0, 'args': {'name': 'critical path'}})
+        events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': pid,
+                       'tid': 0, 'args': {'sort_index': -1}})
+        for step in path:
+            name = step['process']
+            if step['group'] and step['group'] != name:
+                name = '%s:%s' % (step['group'], name)
+            events.append({'name': name,
+                           'cat': 'critical',
+                           'ph': 'X',
+                           'ts': step['begin'] * 1e6,
+                           'dur': step['duration'] * 1e6,
+                           'pid': pid,
+                           'tid': 1,
+                           'args': {'waited': step['waited'],
+                                    'attempt': step['attempt']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -0,0 +1,117 @@
+import time
+import heapq
+import math
+
+def _get_monotonic():
+    """ Return a function giving CLOCK_MONOTONIC in seconds, falling back to
+    time.time where clock_gettime isn't available """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or
+                           ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    ts = timespec()
+    pts = ctypes.pointer(ts)
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, pts) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    try:
+        monotonic()
+    except Exception:
+        return time.time
+    return monotonic
+
+monotonic = _get_monotonic()
+
+class TimerHeap:
+    """ Decides which process groups the main loop needs to transition.
+
+    Instead of transitioning every group on every pass to find out whether
+    a startsecs, backoff, stopwaitsecs or waitforprevious period has run
+    out, each process sets a timer for its next deadline and anything that
+    changes a process' state wakes its group.  The main loop transitions
+    only the groups that are due and sleeps until the nearest deadline.
+
+    Deadlines are kept on the monotonic clock so wall clock changes don't
+    make timers fire early or late.  Each key has at most one timer; setting
+    it again replaces the old deadline, and stale heap entries are skipped
+    when they come up.
+    """
+
+    def __init__(self):
+        self.heap = [] # (deadline, sequence, key)
+        self.timers = {} # key -> (deadline, sequence, owner)
+        self.due = {} # id(owner) -> owner
+        self.sequence = 0
+
+    def set_timer(self, key, owner, seconds):
+        """ Wake owner in seconds, replacing any timer already set for key """
+        deadline = monotonic() + max(0, seconds)
+        self.sequence += 1
+        self.timers[key] = (deadline, self.sequence, owner)
+        heapq.heappush(self.heap, (deadline, self.sequence, key))
+
+    def cancel_timer(self, key):
+        if self.timers.has_key(key):
+            del self.timers[key]
+
+    def has_timer(self, key):
+        return self.timers.has_key(key)
+
+    def wake(self, owner):
+        """ Make owner due on the next pass """
+        if owner is not None:
+            self.due[id(owner)] = owner
+
+    def run(self, now=None):
+        """ Make the owners of expired timers due """
+        if now is None:
+            now = monotonic()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, sequence, key = heapq.heappop(heap)
+            current = self.timers.get(key)
+            if current is None or current[1] != sequence:
+                continue # replaced or cancelled
+            del self.timers[key]
+            self.wake(current[2])
+
+    def pop_due(self):
+        """ Return {id(owner): owner} for everything due and clear it """
+        due, self.due = self.due, {}
+        return due
+
+    def get_timeout(self, maximum, now=None):
+        """ Seconds until the nearest deadline, at most maximum; 0 if
+        anything is already due """
+        if self.due:
+            return 0
+        heap = self.heap
+        while heap:
+            deadline, sequence, key = heap[0]
+            current = self.timers.get(key)
+            if current is not None and current[1] == sequence:
+                break
+            heapq.heappop(heap)
+        if not heap:
+            return maximum
+        if now is None:
+            now = monotonic()
+        # round up to the millisecond so we don't wake just short of the
+        # deadline and spin
+        timeout = math.ceil((heap[0][0] - now) * 1000) / 1000.0
+        return max(0, min(maximum, timeout))
+
+    def get_timer_count(self):
+        return len(self.timers)
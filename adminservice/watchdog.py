@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import thread
+import threading
+import traceback
+
+from adminservice.timers import monotonic
+from adminservice.options import ProcessConfig
+from adminservice.process import Subprocess
+from adminservice.rpcinterface import AdminServiceNamespaceRPCInterface
+
+class Watchdog:
+    """ Notices when the main loop gets stuck in a single iteration.
+
+    The main loop calls busy() when its poll returns and idle() before it
+    polls again.  A thread sleeps on a pipe while the loop is idle; the
+    first busy() after that wakes it, and it then checks once per
+    threshold whether the same iteration is still running.  If so it
+    captures the main thread's stack with sys._current_frames, works out
+    from it which process and RPC were being handled and keeps it in a
+    ring buffer of the last history stalls.  The thread logs the stall,
+    with that stack, as soon as it finds it, so a loop that never gets
+    going again is still reported; the main loop logs how long it lasted
+    when the iteration finally finishes.
+    """
+
+    history = 20 # number of stalls kept
+
+    def __init__(self, options):
+        self.options = options
+        self.threshold = options.watchdog_threshold
+        self.stalls = [] # stall dicts, oldest first
+        self.busy_since = None # monotonic time the current iteration became busy
+        self.current = None # the stall reported for the current iteration
+        self.main_thread = thread.get_ident()
+        self.stopped = False
+        self.sleeping = False # true while the thread waits for busy()
+        self.wakeup_fds = None # (read, write) ends of the thread's pipe
+        self.thread = None
+
+    def start(self):
+        if not self.threshold or self.thread is not None:
+            return
+        self.main_thread = thread.get_ident()
+        self.stopped = False
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NDELAY
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+        self.thread = threading.Thread(target=self.run, name='watchdog')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped = True
+        self.wake()
+        self.thread.join(1)
+        self.thread = None
+        for fd in self.wakeup_fds:
+            os.close(fd)
+        self.wakeup_fds = None
+
+    def wake(self):
+        try:
+            os.write(self.wakeup_fds[1], 'x')
+        except OSError:
+            pass # the pipe is full, so the thread will wake anyway
+
+    def busy(self):
+        self.busy_since = monotonic()
+        # the thread sets sleeping before it looks at busy_since again,
+        # so one of the two always sees the other's change
+        if self.sleeping:
+            self.wake()
+
+    def idle(self):
+        busy_since, self.busy_since = self.busy_since, None
+        stall, self.current = self.current, None
+        if stall is not None and busy_since is not None:
+            stall['duration'] = monotonic() - busy_since
+            stall['finished'] = True
+            self.log(stall)
+
+    def run(self):
+        while not self.stopped:
+            busy_since = self.busy_since
+            if busy_since is None or self.current is not None:
+                # nothing to watch until the next busy(); sleep until then
+                self.sleeping = True
+                if self.busy_since is None or self.current is not None:
+                    self.wait(None)
+                self.sleeping = False
+                continue
+            remaining = busy_since + self.threshold - monotonic()
+            if remaining > 0:
+                self.wait(remaining)
+                continue
+            if self.busy_since == busy_since:
+                self.report(monotonic() - busy_since)
+
+    def wait(self, timeout):
+        """ Sleep until the pipe is written to or timeout seconds pass
+        (forever if timeout is None) """
+        r = self.wakeup_fds[0]
+        try:
+            if timeout is None:
+                ready, _, _ = select.select([r], [], [])
+            else:
+                ready, _, _ = select.select([r], [], [], timeout)
+        except select.error, why:
+            if why.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                os.read(r, 512)
+            except OSError:
+                pass
+
+    def report(self, stalled):
+        frame = sys._current_frames().get(self.main_thread)
+        if frame is None:
+            return
+        stack = traceback.format_stack(frame)
+        process, rpc = find_activity(frame)
+        del frame
+        stall = {'time': time.time(),
+                 'duration': stalled,
+                 'finished': False,
+                 'process': process or '',
+                 'rpc': rpc or '',
+                 'stack': ''.join(stack),
+                 }
+        self.stalls.append(stall)
+        del self.stalls[:-self.history]
+        self.current = stall
+        self.log(stall)
+
+    def log(self, stall):
+        what = []
+        if stall['process']:
+            what.append('process %s' % stall['process'])
+        if stall['rpc']:
+            what.append('RPC %s' % stall['rpc'])
+        handling = what and ' handling %s' % ', '.join(what) or ''
+        if stall['finished']:
+            self.options.logger.warn(
+                'main loop was blocked for %.1f seconds%s'
+                % (stall['duration'], handling))
+        else:
+            self.options.logger.warn(
+                'main loop has been blocked for %.1f seconds%s, at:\n%s'
+                % (stall['duration'], handling, stall['stack']))
+
+    def get_stalls(self):
+        return self.stalls[:]
+
+def find_activity(frame):
+    """ Return the names of the innermost process and RPC method being
+    handled by the stack ending at frame; either may be None """
+    process = rpc = None
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if process is None:
+            if isinstance(obj, Subprocess):
+                process = obj.config.name
+            elif isinstance(obj, ProcessConfig):
+                process = obj.name
+        if rpc is None and isinstance(obj, AdminServiceNamespaceRPCInterface):
+            rpc = frame.f_code.co_name
+        frame = frame.f_back
+    return process, rpc
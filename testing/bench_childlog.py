@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Compare how fast process output is written to child logs one record at
+a time and batched per pass of the main loop.
+
+Usage: bench_childlog.py [processes] [passes] [chunk]
+
+Makes <processes> (50 by default) child loggers the way POutputDispatcher
+does, each rolling over at 1MB with 10 backups, in a temporary directory.
+Then logs <passes> (2000 by default) passes of the main loop in which
+every process sends <chunk> bytes (200 by default) of output, one record
+per pipe read, and reports records and MB written per second:
+
+  per record  each record is written and its size checked with tell()
+              when it's logged, the way child logs were written before
+  batched     records are queued with a LogBatcher that writes each log
+              once per pass
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from adminservice import loggers
+
+MAXBYTES = 1024 * 1024
+BACKUPS = 10
+
+def make_loggers(root, processes, batcher):
+    made = []
+    for i in range(processes):
+        filename = os.path.join(root, 'p%03d-stdout.log' % i)
+        made.append(loggers.getLogger(filename, loggers.LevelsByName.INFO,
+                                      '%(message)s', True, MAXBYTES, BACKUPS,
+                                      batcher=batcher))
+    return made
+
+def run(label, processes, passes, chunk, batched):
+    root = tempfile.mkdtemp(prefix='bench_childlog')
+    try:
+        batcher = None
+        if batched:
+            batcher = loggers.LogBatcher()
+        childlogs = make_loggers(root, processes, batcher)
+        data = ('x' * (chunk - 1)) + '\n'
+        start = time.time()
+        for i in range(passes):
+            for childlog in childlogs:
+                childlog.info(data)
+            if batcher is not None:
+                batcher.check()
+        if batcher is not None:
+            batcher.flush()
+        elapsed = time.time() - start
+        for childlog in childlogs:
+            childlog.close()
+        records = processes * passes
+        print '%-11s %9.0f records/s %8.1f MB/s' % (
+            label, records / elapsed, records * chunk / elapsed / 1e6)
+    finally:
+        shutil.rmtree(root)
+
+def main(processes=50, passes=2000, chunk=200):
+    run('per record', processes, passes, chunk, False)
+    run('batched', processes, passes, chunk, True)
+
+if __name__ == '__main__':
+    args = [ int(arg) for arg in sys.argv[1:4] ]
+    main(*args)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Compare the cost of watching run_detached programs with one forked
+watcher per program (the old model) against the in-daemon DetachedMonitor.
+
+Usage: bench_detached.py [count]
+
+Starts <count> detached sleep programs (500 by default), watches them with
+each model in turn and reports the number of adminserviced processes
+involved and their summed RSS and PSS.  PSS counts shared pages only once,
+so it is the better measure of what the watchers really cost.
+"""
+
+import os
+import sys
+import time
+import signal
+import subprocess
+
+from adminservice.options import ServerOptions
+from adminservice.detached import DetachedMonitor, pid_exists
+
+# load the same modules the daemon has in memory before it forks
+for name in ('adminserviced', 'rpcinterface', 'http'):
+    __import__('adminservice.' + name)
+
+def memory(pid):
+    """ Return (rss, pss) in kB for pid """
+    rss = pss = 0
+    for line in open('/proc/%d/status' % pid):
+        if line.startswith('VmRSS:'):
+            rss = int(line.split()[1])
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            lines = open('/proc/%d/%s' % (pid, name)).readlines()
+        except IOError:
+            continue
+        pss = sum([int(l.split()[1]) for l in lines if l.startswith('Pss:')])
+        break
+    return rss, pss
+
+def report(label, pids):
+    rss = pss = 0
+    for pid in pids:
+        r, p = memory(pid)
+        rss += r
+        pss += p
+    print '%-10s processes: %5d   rss: %8d kB   pss: %8d kB' % (
+        label, len(pids), rss, pss)
+
+def start_programs(count):
+    programs = []
+    for i in range(count):
+        programs.append(subprocess.Popen(['sleep', '100000'],
+                                         preexec_fn=os.setsid))
+    return programs
+
+def forked_watchers(programs):
+    """ One child per program polling its liveness every second, as
+    _spawn_as_child used to """
+    watchers = []
+    for program in programs:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            while pid_exists(program.pid):
+                time.sleep(1)
+            os._exit(0)
+        watchers.append(pid)
+    return watchers
+
+class Program:
+    """ Stand-in for the Subprocess the monitor calls back into """
+    def __init__(self, options, pid):
+        self.config = self
+        self.options = options
+        self.status_script = None
+        self.name = str(pid)
+        self.alive = True
+    def detached_exited(self):
+        pass
+
+def main(count=500):
+    options = ServerOptions()
+    programs = start_programs(count)
+    try:
+        watchers = forked_watchers(programs)
+        time.sleep(2)
+        report('forked', [os.getpid()] + watchers)
+        for pid in watchers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in watchers:
+            os.waitpid(pid, 0)
+
+        monitor = DetachedMonitor(options)
+        for program in programs:
+            monitor.track(Program(options, program.pid), program.pid)
+        start = time.time()
+        monitor.check()
+        elapsed = time.time() - start
+        report('monitor', [os.getpid()])
+        print 'monitor sweep of %d programs took %.2f ms' % (
+            monitor.get_tracked_count(), elapsed * 1000)
+    finally:
+        for program in programs:
+            program.kill()
+            program.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Compare the ways a forked child can close the descriptors it inherited
+before it execs a program, with minfds at 65536.
+
+Usage: bench_fds.py [count] [open fds]
+
+Forks <count> children (200 by default) for each way, each closing every
+descriptor from 3 up and exec()ing /bin/true, and reports how long it took
+from the fork until the child had exited.  The daemon holds <open fds>
+(64 by default) descriptors open while it does, like one with a few dozen
+programs' pipes and log files.  The ways compared are:
+
+  loop         os.close() on each descriptor below minfds, the way children
+               closed them before
+  closerange   os.closerange() below minfds, the same loop done in C
+  proc         close only the descriptors listed in /proc/self/fd
+  close_range  a single close_range(2) call, when the kernel has it
+"""
+
+import os
+import sys
+import time
+import resource
+
+from adminservice import launch
+
+MINFDS = 65536
+PROGRAM = ['/bin/true']
+
+def close_loop(low):
+    for fd in range(low, MINFDS):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def close_closerange(low):
+    os.closerange(low, MINFDS)
+
+def close_proc(low):
+    for name in os.listdir('/proc/self/fd'):
+        fd = int(name)
+        if fd >= low:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def close_close_range(low):
+    if launch.CLOSE_RANGE(low, launch.MAX_FD, 0) != 0:
+        os._exit(126)
+
+def spawn(close):
+    """ Fork a child that closes its descriptors with close and execs
+    PROGRAM; return seconds until it exited """
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            close(3)
+            os.execv(PROGRAM[0], PROGRAM)
+        finally:
+            os._exit(127)
+    pid, status = os.waitpid(pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('child exited with status %s' % status)
+    return elapsed
+
+def run(label, close, count):
+    times = []
+    for i in range(count):
+        times.append(spawn(close))
+    times.sort()
+    print '%-12s median %7.3f ms   mean %7.3f ms' % (
+        label, times[len(times) / 2] * 1000, sum(times) / len(times) * 1000)
+
+def main(count=200, held=64):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < MINFDS and soft < hard:
+        soft = min(MINFDS, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    print 'minfds %d, RLIMIT_NOFILE %d, %d descriptors open' % (
+        MINFDS, soft, held)
+    fds = []
+    try:
+        for i in range(held / 2):
+            fds.extend(os.pipe())
+        run('loop', close_loop, count)
+        run('closerange', close_closerange, count)
+        run('proc', close_proc, count)
+        if launch.CLOSE_RANGE is not None:
+            run('close_range', close_close_range, count)
+        else:
+            print 'close_range  not available'
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+if __name__ == '__main__':
+    args = [ int(arg) for arg in sys.argv[1:3] ]
+    main(*args)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Measure how long it takes the main loop to notice that children have
+exited, from the moment they exit to the moment they are finished.
+
+Usage: bench_sigchld.py [count]
+
+Forks <count> children (200 by default) that all exit at once and runs the
+signal handling and reaping parts of the main loop until every one of them
+has been finished, first the way the loop used to do it (no wakeup pipe,
+one signal and at most 100 children reaped per pass, 1 second poll) and
+then with the signal wakeup pipe and batched reaping.
+"""
+
+import os
+import sys
+import time
+
+from adminservice import loggers
+from adminservice.options import ServerOptions
+from adminservice.poller import Poller
+from adminservice.adminserviced import AdminService
+
+class Child:
+    """ Stand-in for the Subprocess a reaped pid belongs to """
+    def __init__(self, finished):
+        self.finished = finished
+    def finish(self, pid, sts):
+        self.finished.append(time.time())
+
+def make_options():
+    options = ServerOptions()
+    options.logger = loggers.Logger(loggers.LevelsByName.CRIT)
+    options.poller = Poller(options)
+    options.setsignals()
+    return options
+
+def start_children(options, count, finished):
+    r, w = os.pipe()
+    for i in range(count):
+        pid = options.fork()
+        if pid == 0:
+            os.close(w)
+            os.read(r, 1) # returns when the parent closes its end
+            os._exit(0)
+        options.pidhistory[pid] = Child(finished)
+    os.close(r)
+    return w
+
+def old_reap(d, recursionguard=0):
+    if recursionguard == 100:
+        return
+    pid, sts = d.options.waitpid()
+    if pid:
+        d.options.pidhistory.pop(pid).finish(pid, sts)
+        old_reap(d, recursionguard + 1)
+
+def run(count, batched):
+    options = make_options()
+    if not batched:
+        options.signal_receiver.close_wakeup()
+    d = AdminService(options)
+    finished = []
+    release = start_children(options, count, finished)
+    time.sleep(0.5)
+
+    signal_map = options.get_signal_map()
+    for fd in signal_map:
+        options.poller.register_readable(fd)
+
+    start = time.time()
+    os.close(release)
+    passes = 0
+    while len(finished) < count:
+        passes += 1
+        r, w = options.poller.poll(1)
+        for fd in r:
+            signal_map[fd].handle_read_event()
+        if batched:
+            d.reap()
+            d.handle_signal()
+        else:
+            old_reap(d)
+            options.get_signal()
+
+    latencies = [t - start for t in finished]
+    latencies.sort()
+    print '%-8s passes: %3d   median: %7.1f ms   max: %7.1f ms' % (
+        batched and 'batched' or 'previous', passes,
+        latencies[len(latencies) / 2] * 1000, latencies[-1] * 1000)
+    options.signal_receiver.close_wakeup()
+    options.poller.close()
+
+def main(count=200):
+    run(count, False)
+    run(count, True)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Compare starting run_detached programs through the cgexec/nice/bash
+ulimit/numactl shell chain with the native launch that applies those
+settings in the forked child and execs the program itself.
+
+Usage: bench_spawn.py [count]
+
+Launches a program <count> times (100 by default) each way, the way the
+run_detached launcher does, and reports how long it took from the launch
+until the program named in the pid file was running, and how many fork()s
+and exec()s each launch took.  The forks and execs are counted with the
+kernel's process events connector when it can be used (it needs root),
+otherwise only forks are counted, from /proc/stat.  nicelevel, ulimit and
+corefiles are always set; affinity and cgroup only when numactl and cgexec
+are installed for the shell chain to use.
+"""
+
+import os
+import sys
+import time
+import shlex
+import errno
+import socket
+import struct
+import signal
+import tempfile
+
+from adminservice.options import RedhawkProcessConfig
+from adminservice.process import daemonize
+
+PROGRAM = '/bin/sleep 100000'
+
+class Logger:
+    def blather(self, msg):
+        pass
+    debug = blather
+
+class Options:
+    def __init__(self, shell_launch):
+        self.shell_launch = shell_launch
+        self.minfds = 1024
+        self.logger = Logger()
+
+class Config:
+    """ Stand-in for a RedhawkProcessConfig with the settings under test """
+    def __init__(self, directory, shell_launch):
+        self.name = 'bench'
+        self.options = Options(shell_launch)
+        self.command = PROGRAM
+        self.run_detached = True
+        self.start_cmd_option = None
+        self.start_pre_script = None
+        self.start_post_script = None
+        self.redirect_stderr = True
+        self.logfile = os.path.join(directory, 'bench.log')
+        self.output_redirect = '>>%s 2>&1' % self.logfile
+        self.pid_file = os.path.join(directory, 'bench.pid')
+        self.nicelevel = '-n 1'
+        self.ulimit = '-n 1024'
+        self.corefiles = '0'
+        self.affinity = None
+        self.cgroup = None
+        if which('numactl'):
+            self.affinity = '-C 0'
+        if which('cgexec'):
+            self.cgroup = '-g cpu:/'
+
+    def make_native_launch(self, addPid=True):
+        return RedhawkProcessConfig.make_native_launch.im_func(self, addPid)
+
+    def get_start_command(self, native=None, addPid=True):
+        return RedhawkProcessConfig.get_start_command.im_func(self, native,
+                                                              addPid)
+
+def which(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, program), os.X_OK):
+            return True
+    return False
+
+class ProcessEvents:
+    """ Counts the fork()s and exec()s of our descendants with the process
+    events connector """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 11)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.sock.bind((os.getpid(), 1))
+        listen = struct.pack('I', 1) # PROC_CN_MCAST_LISTEN
+        msg = struct.pack('IIIIHH', 1, 1, 0, 0, len(listen), 0) + listen
+        self.sock.send(struct.pack('IHHII', 16 + len(msg), 3, 0, 0,
+                                   os.getpid()) + msg)
+        self.sock.setblocking(0)
+        self.reset()
+
+    def reset(self):
+        self.drain(False)
+        self.tracked = {os.getpid(): True}
+        self.forks = 0
+        self.execs = 0
+
+    def drain(self, count=True):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error, why:
+                if why.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not count or len(data) < 52:
+                continue
+            what = struct.unpack('I', data[36:40])[0]
+            if what == 1: # PROC_EVENT_FORK
+                ppid, ptgid, pid, tgid = struct.unpack('IIII', data[52:68])
+                if self.tracked.has_key(ptgid) and pid == tgid:
+                    self.tracked[tgid] = True
+                    self.forks += 1
+            elif what == 2: # PROC_EVENT_EXEC
+                pid, tgid = struct.unpack('II', data[52:60])
+                if self.tracked.has_key(tgid):
+                    self.execs += 1
+
+class ForkCounter:
+    """ Counts every fork() on the machine from /proc/stat """
+    execs = None
+
+    def __init__(self):
+        self.reset()
+
+    def read(self):
+        for line in open('/proc/stat'):
+            if line.startswith('processes '):
+                return int(line.split()[1])
+
+    def reset(self):
+        self.start = self.read()
+        self.forks = 0
+
+    def drain(self):
+        self.forks = self.read() - self.start
+
+def running(pid_file, argv):
+    """ The pid of the program once it runs argv, else None """
+    try:
+        pid = int(open(pid_file).read().strip())
+        cmdline = open('/proc/%d/cmdline' % pid).read().split('\0')[:-1]
+    except (IOError, ValueError):
+        return None
+    if cmdline == argv:
+        return pid
+    return None
+
+def launch(config, native):
+    """ Launch the program like the run_detached launcher does and return
+    (seconds until it was running, its pid) """
+    argv = shlex.split(config.get_start_command(native))
+    program = shlex.split(PROGRAM)
+    if os.path.exists(config.pid_file):
+        os.remove(config.pid_file)
+    start = time.time()
+    launcher = os.fork()
+    if launcher == 0:
+        try:
+            daemonize(None, None, argv, os.environ.copy(), native=native)
+        finally:
+            os._exit(0)
+    os.waitpid(launcher, 0)
+    while True:
+        pid = running(config.pid_file, program)
+        if pid is not None:
+            return time.time() - start, pid
+        if time.time() - start > 10:
+            raise RuntimeError('program did not start: %r' % argv)
+        time.sleep(0.0005)
+
+def run(label, config, counter, count):
+    native, why_not = config.make_native_launch()
+    if not config.options.shell_launch and native is None:
+        print '%-6s not possible: %s' % (label, why_not)
+        return
+    counter.reset()
+    times = []
+    for i in range(count):
+        elapsed, pid = launch(config, native)
+        times.append(elapsed)
+        os.kill(pid, signal.SIGKILL)
+    counter.drain()
+    times.sort()
+    msg = '%-6s median %6.2f ms   mean %6.2f ms   forks %5.1f' % (
+        label, times[len(times) / 2] * 1000, sum(times) / len(times) * 1000,
+        counter.forks / float(count))
+    if counter.execs is not None:
+        msg += '   execs %5.1f' % (counter.execs / float(count))
+    print msg + ' per launch'
+
+def main(count=100):
+    directory = tempfile.mkdtemp(prefix='bench_spawn')
+    try:
+        counter = ProcessEvents()
+    except socket.error:
+        counter = ForkCounter()
+        print 'process events unavailable, counting all forks on the machine'
+    try:
+        shell = Config(directory, True)
+        print 'shell command: %s' % shell.get_start_command()
+        run('shell', shell, counter, count)
+        run('native', Config(directory, False), counter, count)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
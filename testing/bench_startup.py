@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Compare how long adminserviced takes to read its configuration when it
+starts (or restarts on SIGHUP) with and without a config snapshot.
+
+Usage: bench_startup.py [nodes] [runs]
+
+Writes <nodes> node configs (2000 by default), one .ini file each, spread
+over 50 domains with a domain manager each, to a temporary config
+directory using the domain/node/waveform defaults from etc/redhawk/init.d.
+Then makes a new ServerOptions and realize()s it, the way main() does for
+every start and restart, <runs> times (3 by default) for each case and
+reports the median:
+
+  no snapshot  no config snapshot exists, every .ini file is parsed
+  snapshot     the snapshot the previous start wrote is loaded
+  one edit     one node's .ini file changed since the snapshot was written
+"""
+
+import os
+import sys
+import pwd
+import grp
+import time
+import shutil
+import tempfile
+
+from adminservice.options import ServerOptions
+
+DOMAINS = 50
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULTS = os.path.join(HERE, '..', 'etc', 'redhawk', 'init.d')
+
+ADMINSERVICED = """\
+[adminserviced]
+logfile=%(root)s/adminserviced.log
+pidfile=%(root)s/adminserviced.pid
+config_dir=%(root)s/etc
+childlogdir=%(root)s/log
+childpiddir=%(root)s/run
+config_snapshot=%(root)s/run/adminserviced.snapshot
+"""
+
+def write(filename, text):
+    f = open(filename, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+def make_tree(root, nodes):
+    """ Write the config tree; return the name of adminserviced.defaults """
+    etc = os.path.join(root, 'etc')
+    for name in ('init.d', 'domains.d', 'nodes.d', 'waveforms.d'):
+        os.makedirs(os.path.join(etc, name))
+    os.mkdir(os.path.join(root, 'log'))
+    for name in ('domain-mgrs', 'device-mgrs', 'waveforms'):
+        os.makedirs(os.path.join(root, 'run', name))
+    user = pwd.getpwuid(os.getuid())[0]
+    group = grp.getgrgid(os.getgid())[0]
+    for name in ('domain.defaults', 'node.defaults', 'waveform.defaults'):
+        # run them as whoever runs the benchmark
+        lines = []
+        for line in open(os.path.join(DEFAULTS, name)):
+            if line.startswith('user='):
+                line = 'user=%s\n' % user
+            elif line.startswith('group='):
+                line = 'group=%s\n' % group
+            lines.append(line)
+        write(os.path.join(etc, 'init.d', name), ''.join(lines))
+    for i in range(DOMAINS):
+        write(os.path.join(etc, 'domains.d', 'd%02d.ini' % i),
+              '[domain:D%02d_mgr]\nDOMAIN_NAME=D%02d\n' % (i, i))
+    for i in range(nodes):
+        write(os.path.join(etc, 'nodes.d', 'n%04d.ini' % i),
+              '[node:N%04d]\nDOMAIN_NAME=D%02d\nNODE_NAME=N%04d\n'
+              % (i, i % DOMAINS, i))
+    config = os.path.join(etc, 'init.d', 'adminserviced.defaults')
+    write(config, ADMINSERVICED % {'root': root})
+    return config
+
+def realize(config):
+    """ Seconds a new ServerOptions took to realize(), and its number of
+    process configs """
+    start = time.time()
+    options = ServerOptions()
+    options.realize(['-c', config])
+    elapsed = time.time() - start
+    count = 0
+    for group in options.process_group_configs:
+        count += len(group.process_configs)
+    return elapsed, count
+
+def run(label, config, runs, before):
+    times = []
+    for i in range(runs):
+        before(i)
+        elapsed, count = realize(config)
+        times.append(elapsed)
+    times.sort()
+    print '%-12s median %8.1f ms   (%d process configs)' % (
+        label, times[len(times) / 2] * 1000, count)
+
+def main(nodes=2000, runs=3):
+    os.environ.setdefault('SDRROOT', '/var/redhawk/sdr')
+    os.environ.setdefault('OSSIEHOME', '/usr/local/redhawk')
+    root = tempfile.mkdtemp(prefix='bench_startup')
+    try:
+        config = make_tree(root, nodes)
+        snapshot = os.path.join(root, 'run', 'adminserviced.snapshot')
+        edited = os.path.join(root, 'etc', 'nodes.d', 'n0000.ini')
+
+        def remove_snapshot(i):
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+        def keep_snapshot(i):
+            pass
+
+        def edit_node(i):
+            f = open(edited, 'a')
+            f.write('startretries=%d\n' % (i + 1))
+            f.close()
+
+        run('no snapshot', config, runs, remove_snapshot)
+        run('snapshot', config, runs, keep_snapshot)
+        run('one edit', config, runs, edit_node)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    args = [ int(arg) for arg in sys.argv[1:3] ]
+    main(*args)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Check that child log output is in the file as soon as
+LogBatcher.flush() returns, with and without an AsyncLogWriter, and
+that a full writer queue never drops it.
+
+Usage: test_childlog_flush.py
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from adminservice import loggers
+
+class ChildLogFlushTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test_childlog_flush')
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer is not None:
+            self.writer.stop()
+        shutil.rmtree(self.root)
+
+    def make_log(self, batcher, name='p-stdout.log'):
+        filename = os.path.join(self.root, name)
+        childlog = loggers.getLogger(filename, loggers.LevelsByName.INFO,
+                                     '%(message)s', True, 1024 * 1024, 10,
+                                     batcher=batcher)
+        return filename, childlog
+
+    def start_writer(self, maxsize=10000, policy='block'):
+        self.writer = loggers.AsyncLogWriter(maxsize, policy)
+        self.writer.start()
+        return self.writer
+
+    def block_writer(self, level):
+        """ Keep the writer thread busy until the returned Event is set;
+        returns once the writer has started on it """
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait(10)
+        self.writer.submit(level, block)
+        started.wait(10)
+        self.assertTrue(started.isSet())
+        return release
+
+    def read(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_read_back_inline(self):
+        batcher = loggers.LogBatcher(interval=60)
+        filename, childlog = self.make_log(batcher)
+        childlog.info('hello\n')
+        self.assertEqual(self.read(filename), '')
+        batcher.flush()
+        self.assertEqual(self.read(filename), 'hello\n')
+
+    def test_read_back_with_writer(self):
+        batcher = loggers.LogBatcher(interval=60)
+        batcher.writer = self.start_writer()
+        filename, childlog = self.make_log(batcher)
+        # keep the writer thread busy, so the batch is still queued when
+        # flush() hands it over
+        self.writer.submit(loggers.LevelsByName.INFO, time.sleep, 0.3)
+        childlog.info('hello\n')
+        childlog.info('world\n')
+        batcher.flush()
+        self.assertEqual(self.read(filename), 'hello\nworld\n')
+
+    def test_batches_never_dropped(self):
+        batcher = loggers.LogBatcher(interval=60)
+        batcher.writer = self.start_writer(maxsize=2, policy='drop-oldest')
+        filename, childlog = self.make_log(batcher)
+        # keep the writer busy with something that can't be dropped either
+        release = self.block_writer(None)
+        for i in range(5):
+            childlog.info('%d\n' % i)
+            batcher.write() # one batch per pass, as check() would
+        release.set()
+        batcher.flush()
+        self.assertEqual(self.read(filename), '0\n1\n2\n3\n4\n')
+        self.assertEqual(self.writer.get_info()['dropped'], 0)
+
+    def test_main_log_records_dropped(self):
+        writer = self.start_writer(maxsize=2, policy='drop-debug')
+        release = self.block_writer(loggers.LevelsByName.INFO)
+        written = []
+        writer.submit(loggers.LevelsByName.DEBG, written.append, 'debug')
+        writer.submit(loggers.LevelsByName.INFO, written.append, 'info')
+        writer.submit(loggers.LevelsByName.WARN, written.append, 'warn')
+        release.set()
+        writer.flush()
+        self.assertEqual(written, ['info', 'warn'])
+        self.assertEqual(writer.get_info()['dropped'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""Check that rereading the domain/node/waveform directories, in the same
+daemon or from a config snapshot, only parses the .ini files that are new
+or changed, that the processes of the others keep their configs and
+fingerprints, and that parallel_map reports workers that fail.
+
+Usage: test_configcache.py
+"""
+
+import os
+import pwd
+import grp
+import time
+import shutil
+import tempfile
+import unittest
+
+from adminservice import configcache
+from adminservice.options import ServerOptions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULTS = os.path.join(HERE, '..', 'etc', 'redhawk', 'init.d')
+
+ADMINSERVICED = """\
+[adminserviced]
+logfile=%(root)s/adminserviced.log
+pidfile=%(root)s/adminserviced.pid
+config_dir=%(root)s/etc
+childlogdir=%(root)s/log
+childpiddir=%(root)s/run
+"""
+
+NODE = """\
+[node:%(name)s]
+DOMAIN_NAME=D
+NODE_NAME=%(name)s
+"""
+
+def write(filename, text):
+    f = open(filename, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+class ConfigTreeTests(unittest.TestCase):
+    """ Base for tests that read a config tree of their own """
+
+    def setUp(self):
+        os.environ.setdefault('SDRROOT', '/var/redhawk/sdr')
+        os.environ.setdefault('OSSIEHOME', '/usr/local/redhawk')
+        self.root = tempfile.mkdtemp(prefix='test_configcache')
+        self.etc = os.path.join(self.root, 'etc')
+        for name in ('init.d', 'domains.d', 'nodes.d', 'waveforms.d'):
+            os.makedirs(os.path.join(self.etc, name))
+        os.mkdir(os.path.join(self.root, 'log'))
+        for name in ('domain-mgrs', 'device-mgrs', 'waveforms'):
+            os.makedirs(os.path.join(self.root, 'run', name))
+        # run them as whoever runs the tests
+        user = pwd.getpwuid(os.getuid())[0]
+        group = grp.getgrgid(os.getgid())[0]
+        for name in ('domain.defaults', 'node.defaults', 'waveform.defaults'):
+            lines = []
+            for line in open(os.path.join(DEFAULTS, name)):
+                if line.startswith('user='):
+                    line = 'user=%s\n' % user
+                elif line.startswith('group='):
+                    line = 'group=%s\n' % group
+                lines.append(line)
+            write(os.path.join(self.etc, 'init.d', name), ''.join(lines))
+        write(os.path.join(self.etc, 'domains.d', 'd.ini'),
+              '[domain:D_mgr]\nDOMAIN_NAME=D\n')
+        self.config = os.path.join(self.etc, 'init.d', 'adminserviced.defaults')
+        write(self.config, ADMINSERVICED % {'root': self.root})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def node_file(self, name):
+        return os.path.join(self.etc, 'nodes.d', '%s.ini' % name)
+
+    def write_node(self, name, extra=''):
+        filename = self.node_file(name)
+        write(filename, NODE % {'name': name} + extra)
+        # a later edit has to change the mtime even on coarse filesystems
+        stamp = time.time() - 10
+        os.utime(filename, (stamp, stamp))
+
+    def realize(self):
+        options = ServerOptions()
+        options.realize(['-c', self.config])
+        return options
+
+    def reread(self, options):
+        options.process_config(do_usage=False)
+
+    def get_configs(self, options):
+        """ Return {group name: {process name: process config}} """
+        configs = {}
+        for group in options.process_group_configs:
+            pconfigs = configs.setdefault(group.name, {})
+            for pconfig in group.process_configs:
+                pconfigs[pconfig.name] = pconfig
+        return configs
+
+    def parsed(self, options, subdir='nodes.d'):
+        """ The 'Parsed n of m files' info for subdir, as (n, m) """
+        config_dir = os.path.join(self.etc, subdir)
+        for info in options.parse_infos:
+            words = info.split()
+            if words[:1] == ['Parsed'] and words[-1] == config_dir:
+                return int(words[1]), int(words[3])
+        return None
+
+class ReparseTests(ConfigTreeTests):
+
+    def setUp(self):
+        ConfigTreeTests.setUp(self)
+        self.write_node('n1')
+        self.write_node('n2')
+
+    def test_first_read_parses_every_file(self):
+        options = self.realize()
+        self.assertEqual(self.parsed(options), (2, 2))
+
+    def test_unchanged_files_not_parsed(self):
+        options = self.realize()
+        before = self.get_configs(options)
+        self.reread(options)
+        self.assertEqual(self.parsed(options), (0, 2))
+        after = self.get_configs(options)
+        self.assertEqual(sorted(after.keys()), sorted(before.keys()))
+        for name in ('n1', 'n2'):
+            self.assertEqual(after['D'][name].get_fingerprint(),
+                             before['D'][name].get_fingerprint())
+
+    def test_edited_file_parsed_again(self):
+        options = self.realize()
+        before = self.get_configs(options)
+        self.write_node('n2', 'startretries=3\n')
+        self.reread(options)
+        self.assertEqual(self.parsed(options), (1, 2))
+        after = self.get_configs(options)
+        self.assertEqual(after['D']['n1'].get_fingerprint(),
+                         before['D']['n1'].get_fingerprint())
+        self.assertNotEqual(after['D']['n2'].get_fingerprint(),
+                            before['D']['n2'].get_fingerprint())
+        self.assertEqual(after['D']['n2'].startretries, 3)
+
+    def test_touched_file_keeps_its_configs(self):
+        options = self.realize()
+        before = self.get_configs(options)
+        os.utime(self.node_file('n1'), None)
+        self.reread(options)
+        # read again, but hashed the same, so not parsed
+        self.assertEqual(self.parsed(options), (0, 2))
+        after = self.get_configs(options)
+        self.assertEqual(after['D']['n1'].get_fingerprint(),
+                         before['D']['n1'].get_fingerprint())
+
+    def test_added_file_parsed(self):
+        options = self.realize()
+        self.write_node('n3')
+        self.reread(options)
+        self.assertEqual(self.parsed(options), (1, 3))
+        self.assertTrue(self.get_configs(options)['D'].has_key('n3'))
+
+class SnapshotTests(ConfigTreeTests):
+
+    def setUp(self):
+        ConfigTreeTests.setUp(self)
+        os.environ['TEST_CONFIGCACHE_LEVEL'] = 'INFO'
+        self.write_node('n1')
+        self.write_node('n2',
+                        'DEBUG_LEVEL=%(ENV_TEST_CONFIGCACHE_LEVEL)s\n')
+        self.snapshot = os.path.join(self.root, 'run',
+                                     'adminserviced.snapshot')
+        write(self.config, ADMINSERVICED % {'root': self.root} +
+              'config_snapshot=%s\n' % self.snapshot)
+
+    def tearDown(self):
+        del os.environ['TEST_CONFIGCACHE_LEVEL']
+        ConfigTreeTests.tearDown(self)
+
+    def loaded(self, options):
+        return ('Loaded config snapshot %s' % self.snapshot
+                in options.parse_infos)
+
+    def test_off_by_default(self):
+        write(self.config, ADMINSERVICED % {'root': self.root})
+        self.realize()
+        self.assertFalse(os.path.exists(self.snapshot))
+
+    def test_unchanged_files_loaded(self):
+        first = self.realize()
+        self.assertFalse(self.loaded(first))
+        self.assertTrue(os.path.exists(self.snapshot))
+        second = self.realize()
+        self.assertTrue(self.loaded(second))
+        self.assertEqual(self.parsed(second), (0, 2))
+        self.assertEqual(self.get_configs(second)['D']['n2'].DEBUG_LEVEL,
+                         3) # INFO
+
+    def test_edited_file_invalidated(self):
+        self.realize()
+        self.write_node('n1', 'startretries=3\n')
+        options = self.realize()
+        self.assertTrue(self.loaded(options))
+        self.assertEqual(self.parsed(options), (1, 2))
+        self.assertEqual(self.get_configs(options)['D']['n1'].startretries, 3)
+
+    def test_expansion_change_invalidated(self):
+        first = self.get_configs(self.realize())['D']['n2']
+        os.environ['TEST_CONFIGCACHE_LEVEL'] = 'DEBUG'
+        options = self.realize()
+        self.assertTrue(self.loaded(options))
+        self.assertEqual(self.parsed(options), (1, 2))
+        second = self.get_configs(options)['D']['n2']
+        self.assertEqual(second.DEBUG_LEVEL, 4) # DEBUG
+        self.assertNotEqual(second.get_fingerprint(), first.get_fingerprint())
+
+def square(n):
+    return n * n
+
+def fail_on_three(n):
+    if n == 3:
+        raise KeyError('three')
+    return n
+
+def die_on_three(n):
+    if n == 3:
+        os._exit(1)
+    return n
+
+class ParallelMapTests(unittest.TestCase):
+
+    def test_results_in_order(self):
+        items = range(10)
+        self.assertEqual(configcache.parallel_map(square, items, 3),
+                         map(square, items))
+
+    def test_more_workers_than_items(self):
+        self.assertEqual(configcache.parallel_map(square, [2], 4), [4])
+
+    def test_worker_failure_raised(self):
+        try:
+            configcache.parallel_map(fail_on_three, range(10), 3)
+        except RuntimeError, why:
+            self.assertTrue('failed' in str(why))
+            self.assertTrue("KeyError: 'three'" in str(why))
+        else:
+            self.fail('no RuntimeError')
+
+    def test_worker_death_raised(self):
+        try:
+            configcache.parallel_map(die_on_three, range(10), 3)
+        except RuntimeError, why:
+            self.assertTrue('died' in str(why))
+        else:
+            self.fail('no RuntimeError')
+
+class Settings:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class FingerprintTests(ConfigTreeTests):
+
+    def test_same_settings_hash_the_same(self):
+        first = configcache.fingerprint('node', [
+            ('environment', {'A': '1', 'B': '2'}),
+            ('settings', Settings(x=1, y=[2, 3]))])
+        second = configcache.fingerprint('node', [
+            ('environment', {'B': '2', 'A': '1'}),
+            ('settings', Settings(y=[2, 3], x=1))])
+        self.assertEqual(first, second)
+        third = configcache.fingerprint('domain', [
+            ('environment', {'A': '1', 'B': '2'}),
+            ('settings', Settings(x=1, y=[2, 3]))])
+        self.assertNotEqual(first, third)
+
+    def test_same_file_hashes_the_same_in_another_daemon(self):
+        self.write_node('n1')
+        first = self.get_configs(self.realize())['D']['n1']
+        second = self.get_configs(self.realize())['D']['n1']
+        self.assertEqual(first.get_fingerprint(), second.get_fingerprint())
+
+    def test_unused_environment_leaves_it_alone(self):
+        self.write_node('n1')
+        options = self.realize()
+        before = self.get_configs(options)['D']['n1']
+        os.environ['TEST_CONFIGCACHE_UNUSED'] = 'changed'
+        try:
+            self.reread(options)
+        finally:
+            del os.environ['TEST_CONFIGCACHE_UNUSED']
+        self.assertEqual(self.parsed(options), (0, 1))
+        after = self.get_configs(options)['D']['n1']
+        self.assertEqual(after.get_fingerprint(), before.get_fingerprint())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Check that ConfigWatcher.reload applies a removed group once its
+processes are down, and adds it back with its new config if it was
+configured again before then.
+
+Usage: test_configwatch.py
+"""
+
+import unittest
+
+from adminservice.configwatch import ConfigWatcher
+from adminservice.states import AdminServiceStates
+
+class DummyLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+    warn = error = info
+
+class DummyOptions:
+    config_watch = 'true'
+    mood = AdminServiceStates.RUNNING
+
+    def __init__(self):
+        self.logger = DummyLogger()
+        self.parse_warnings = []
+        self.process_group_configs = []
+        self.reread = [] # process_group_configs for each process_config()
+
+    def process_config(self, do_usage=True):
+        self.process_group_configs = self.reread.pop(0)
+
+class DummyGroupConfig:
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.process_configs = []
+
+class DummyGroup:
+    """ A group whose processes are still stopping until down is set """
+
+    update_in_place = True
+
+    def __init__(self, config):
+        self.config = config
+        self.processes = {} # nothing for stop_group() to stop
+        self.down = False
+        self.updated = []
+
+    def diff_config(self, config):
+        return [], [], []
+
+    def update(self, config):
+        self.updated.append(config)
+
+class DummyAdminServiced:
+    def __init__(self, options):
+        self.options = options
+        self.process_groups = {}
+        self.diffs = [] # (added, changed, removed) for each diff_to_active()
+
+    def diff_to_active(self):
+        return self.diffs.pop(0)
+
+    def add_process_group(self, config):
+        if self.process_groups.has_key(config.name):
+            return False
+        self.process_groups[config.name] = DummyGroup(config)
+        return True
+
+    def remove_process_group(self, name):
+        if not self.process_groups[name].down:
+            return False
+        del self.process_groups[name]
+        return True
+
+class ReloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.options = DummyOptions()
+        self.adminserviced = DummyAdminServiced(self.options)
+        self.watcher = ConfigWatcher(self.adminserviced)
+        self.old = DummyGroupConfig('D', 1)
+        self.adminserviced.add_process_group(self.old)
+
+    def remove(self):
+        """ Reload with group D gone from the config files """
+        self.options.reread.append([])
+        self.adminserviced.diffs.append(([], [], [self.old]))
+        self.watcher.reload(['/etc/redhawk/domains.d/d.ini'])
+
+    def test_removed_once_down(self):
+        self.remove()
+        group = self.adminserviced.process_groups['D']
+        self.assertEqual(self.watcher.removing, {'D': None})
+        group.down = True
+        self.watcher.finish_removals()
+        self.assertFalse(self.adminserviced.process_groups.has_key('D'))
+        self.assertEqual(self.watcher.removing, {})
+
+    def test_added_back_before_down(self):
+        self.remove()
+        group = self.adminserviced.process_groups['D']
+        # configured again while its old processes are still stopping;
+        # the old group is still there, so it's reported as changed
+        new = DummyGroupConfig('D', 2)
+        self.options.reread.append([new])
+        self.adminserviced.diffs.append(([], [new], []))
+        self.watcher.reload(['/etc/redhawk/domains.d/d.ini'])
+        self.assertEqual(self.watcher.removing, {'D': new})
+        self.assertEqual(group.updated, []) # not updated in place
+        self.assertTrue(self.adminserviced.process_groups['D'] is group)
+
+        group.down = True
+        self.watcher.finish_removals()
+        added = self.adminserviced.process_groups['D']
+        self.assertFalse(added is group)
+        self.assertTrue(added.config is new)
+        self.assertEqual(self.watcher.removing, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Check how StartupScheduler works out what a process depends on and
+whether it may start, wait for its dependencies, or give up on them.
+
+Usage: test_startup.py
+"""
+
+import unittest
+
+from adminservice import startup
+from adminservice.states import ProcessStates
+
+class DummyLogger:
+    def info(self, msg):
+        pass
+    trace = debug = warn = info
+
+class DummyOptions:
+    dependency_startup = True
+    startup_parallelism = 8
+
+    def __init__(self):
+        self.logger = DummyLogger()
+
+class DummyConfig:
+    def __init__(self, options, name, config_type, priority,
+                 waitforprevious=None, depends_on=None):
+        self.options = options
+        self.name = name
+        self.config_type = config_type
+        self.priority = priority
+        self.waitforprevious = waitforprevious
+        self.depends_on = depends_on
+
+class DummyProcess:
+    status_pending = False
+    wait_deadline = None
+    group = None
+
+    def __init__(self, config, state=ProcessStates.STOPPED):
+        self.config = config
+        self.state = state
+
+    def __cmp__(self, other):
+        return cmp(self.config.priority, other.config.priority)
+
+    def get_state(self):
+        return self.state
+
+    def should_spawn(self, now):
+        return False
+
+class DummyGroup:
+    def __init__(self, name, processes):
+        self.config = DummyConfig(None, name, None, 0)
+        self.processes = {}
+        for process in processes:
+            process.group = self
+            self.processes[process.config.name] = process
+
+class StartupSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.options = DummyOptions()
+        self.scheduler = startup.StartupScheduler(self.options)
+        self.domain = self.make('D_mgr', 'domain', 100)
+        self.node = self.make('N1', 'node', 400, waitforprevious=45)
+        self.waveform = self.make('W1', 'waveform', 500)
+        self.group = DummyGroup('D', [self.domain, self.node, self.waveform])
+        self.scheduler.register(self.group)
+
+    def make(self, name, config_type, priority, **kw):
+        config = DummyConfig(self.options, name, config_type, priority, **kw)
+        return DummyProcess(config)
+
+    def test_node_depends_on_its_domain_manager(self):
+        self.assertEqual(self.scheduler.get_dependencies(self.node),
+                         [self.domain])
+
+    def test_waveform_depends_on_every_node_without_depends_on(self):
+        self.assertEqual(self.scheduler.get_dependencies(self.waveform),
+                         [self.domain, self.node])
+
+    def test_ready_once_dependencies_run(self):
+        self.domain.state = ProcessStates.RUNNING
+        self.assertEqual(self.scheduler.check_dependencies(self.node, 0),
+                         startup.READY)
+
+    def test_waits_up_to_waitforprevious(self):
+        self.domain.state = ProcessStates.STARTING
+        check = self.scheduler.check_dependencies
+        self.assertEqual(check(self.node, 0), startup.WAITING)
+        self.assertEqual(self.node.wait_deadline, 45)
+        self.assertEqual(check(self.node, 44), startup.WAITING)
+        self.assertEqual(check(self.node, 45), startup.FAILED)
+        self.assertEqual(self.node.wait_deadline, None)
+
+    def test_waits_up_to_max_wait_without_waitforprevious(self):
+        self.domain.state = ProcessStates.STARTING
+        self.node.state = ProcessStates.RUNNING
+        check = self.scheduler.check_dependencies
+        self.assertEqual(check(self.waveform, 0), startup.WAITING)
+        self.assertEqual(self.waveform.wait_deadline,
+                         startup.StartupScheduler.max_wait)
+
+    def test_fails_when_a_dependency_settles(self):
+        self.domain.state = ProcessStates.FATAL
+        self.assertEqual(self.scheduler.check_dependencies(self.node, 0),
+                         startup.FAILED)
+
+if __name__ == '__main__':
+    unittest.main()